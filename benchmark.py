@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""
+Benchmark the installer's own logic and orchestration on a simulated machine.
+
+End-to-end scenarios run `pre-chroot.py` against `lib.simulation` fakes (commands, network,
+questions, ...), subsystem benchmarks time individual pieces of logic. Every benchmark is
+repeated, the results are written as JSON and compared against a stored baseline, the run
+fails if some benchmark got slower than its baseline (by more than the tolerance) or if there is
+no baseline. The committed baseline (benchmark-baseline.json) is measured at the default latency scale.
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+from typing import Any, Callable, Iterator, NamedTuple
+
+# The installer must not touch the real caches, logs or answer file of this machine
+_WORK_DIR = Path(tempfile.mkdtemp(prefix="archdeploy-benchmark-"))
+os.environ.update({
+    "ARCHDEPLOY_CACHE_DIR": str(_WORK_DIR / "cache"),
+    "ARCHDEPLOY_PACKAGE_CACHE": str(_WORK_DIR / "cache" / "pkg"),
+    "ARCHDEPLOY_LOG": str(_WORK_DIR / "install.log"),
+})
+for _name in ("ARCHDEPLOY_ANSWERS", "ARCHDEPLOY_TRACE", "DEBUG"):
+    os.environ.pop(_name, None)
+
+from lib import (  # noqa: E402 (the environment has to be set up first)
+    constants, disk, filesystems, installplan, inventory, mirrors, pacman, partitioning, questions
+)
+from lib.scheduler import Scheduler, Step  # noqa: E402
+from lib.simulation import (  # noqa: E402
+    STOCK_PACMAN_CONF, CommandRule, Network, SimulatedDisk, SimulatedInterface, Simulation
+)
+
+GIB = 1024 ** 3
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "benchmark-baseline.json"
+
+IWCTL_NETWORKS = (
+    "\x1b[1;90m                               Available networks\x1b[0m\n"
+    "\x1b[1;90m--------------------------------------------------------------------------------\x1b[0m\n"
+    "\x1b[1;90m      Network name                      Security            Signal\x1b[0m\n"
+    "\x1b[1;90m--------------------------------------------------------------------------------\x1b[0m\n"
+    "      HomeNet                           psk                 -5200\n"
+    "      Cafe Free Wi-Fi                   open                -7400\n"
+    "      Neighbour                         psk                 -8800\n"
+)
+IWCTL_STATION = (
+    "\x1b[1;90m                                 Station: wlan0\x1b[0m\n"
+    "\x1b[1;90m--------------------------------------------------------------------------------\x1b[0m\n"
+    "\x1b[1;90m  Settable  Property              Value\x1b[0m\n"
+    "\x1b[1;90m--------------------------------------------------------------------------------\x1b[0m\n"
+    "            Scanning              no\n"
+    "            State                 connected\n"
+)
+
+# Latencies of commands on a typical machine (slow mkfs, package downloads, ...)
+COMMAND_RULES = [
+    CommandRule(r"^rfkill --json", output='{"rfkilldevices": []}'),
+    CommandRule(r"iwctl station \S+ scan", latency=0.2),
+    CommandRule(r"iwctl station \S+ get-networks", output=IWCTL_NETWORKS),
+    CommandRule(r"iwctl station \S+ show", latency=0.01, output=IWCTL_STATION),
+    CommandRule(r"iwctl .*station \S+ connect", latency=1.0),
+    CommandRule(r"^timedatectl", latency=0.05),
+    CommandRule(r"^pacman -Sy", latency=1.5),
+    CommandRule(r"--downloadonly", latency=2.0),
+    CommandRule(r"^sfdisk", latency=0.3),
+    CommandRule(r"^udevadm settle", latency=0.1),
+    CommandRule(r"^(mkfs\.|mkswap)", latency=1.0),
+    CommandRule(r"btrfs subvolume create", latency=0.05),
+    CommandRule(r"\bmount ", latency=0.02),
+    CommandRule(r"^swapon", latency=0.02),
+    CommandRule(r"^pacstrap", latency=3.0, output="".join(f"installing package {n}...\n" for n in range(200))),
+    CommandRule(r"^arch-chroot", latency=0.5),
+]
+
+BASE_ANSWERS = {
+    "partitions.format_manually": False,
+    "install.drop_to_shell": False,
+}
+AUTO_PARTITION_ANSWERS = {
+    "partitions.method": "Automatically (erases the whole disk)",
+    "partitions.device": "/dev/sda",
+    "partitions.auto_swap": True,
+    "partitions.auto_swap_size": "8G",
+    "partitions.auto_filesystem": "ext4",
+    "partitions.confirm_wipe": True,
+}
+
+
+def ethernet_scenario(latency_scale: float, seed: int) -> Simulation:
+    """Cable plugged in a second after the start, DHCP takes half a second, the network is flaky."""
+    return Simulation(
+        answers={**BASE_ANSWERS, **AUTO_PARTITION_ANSWERS, "network.method": "Ethernet"},
+        rules=COMMAND_RULES,
+        interfaces=[SimulatedInterface("enp1s0", carrier_after=1.0)],
+        disks=[SimulatedDisk("sda", 512 * GIB)],
+        network=Network(connected=False, dhcp_delay=0.5, flakiness=0.1),
+        latency_scale=latency_scale,
+        seed=seed,
+    )
+
+
+def wifi_scenario(latency_scale: float, seed: int) -> Simulation:
+    """Wi-Fi only machine without NetworkManager, connected with iwctl."""
+    return Simulation(
+        answers={
+            **BASE_ANSWERS, **AUTO_PARTITION_ANSWERS,
+            "network.method": "Wi-Fi",
+            "network.wifi.ssid": "HomeNet",
+            "network.wifi.passphrase": "correct horse battery staple",
+        },
+        rules=COMMAND_RULES,
+        interfaces=[SimulatedInterface("wlan0", type=inventory.InterfaceType.WIRELESS, carrier_after=None)],
+        disks=[SimulatedDisk("sda", 512 * GIB)],
+        network=Network(connected=False, connect_pattern=r"iwctl .*station \S+ connect", dhcp_delay=None),
+        available_commands={"iwctl"},
+        latency_scale=latency_scale,
+        seed=seed,
+    )
+
+
+def efi_scenario(latency_scale: float, seed: int) -> Simulation:
+    """EFI machine with manually made partitions on two disks (EFI, btrfs root, swap, xfs /home, ext4 /srv)."""
+    return Simulation(
+        answers={
+            **BASE_ANSWERS,
+            "partitions.method": "Manually (drop to shell)",
+            "partitions.drop_to_shell": False,
+            "partitions.root": "/dev/nvme0n1p2",
+            "partitions.root_filesystem": "btrfs",
+            "partitions.efi": "/dev/nvme0n1p1",
+            "partitions.efi_mountpoint": "/boot",
+            "partitions.swap": True,
+            "partitions.swap_path": "/dev/nvme0n1p3",
+            "partitions.extra": [True, True, False],
+            "partitions.extra_path": ["/dev/nvme0n1p4", "/dev/sda1"],
+            "partitions.extra_mountpoint": ["/home", "/srv"],
+            "partitions.extra_filesystem": ["xfs", "ext4"],
+            "partitions.confirm": True,
+        },
+        rules=COMMAND_RULES,
+        interfaces=[SimulatedInterface("enp1s0")],
+        disks=[
+            SimulatedDisk("nvme0n1", 1024 * GIB, partitions=[1 * GIB, 400 * GIB, 16 * GIB, 600 * GIB]),
+            SimulatedDisk("sda", 2048 * GIB, rotational=True, partitions=[2047 * GIB]),
+        ],
+        network=Network(connected=True),
+        is_efi=True,
+        latency_scale=latency_scale,
+        seed=seed,
+    )
+
+
+class Scenario(NamedTuple):
+    name: str
+    make_simulation: Callable[[float, int], Simulation]
+    argv: list[str]
+
+
+SCENARIOS = [
+    Scenario("ethernet", ethernet_scenario, ["install"]),
+    Scenario("wifi-iwctl", wifi_scenario, ["install"]),
+    Scenario("efi-multi-partition", efi_scenario, ["install"]),
+]
+
+
+def _load_pre_chroot() -> Any:
+    spec = importlib.util.spec_from_file_location("pre_chroot", Path(__file__).resolve().parent / "pre-chroot.py")
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@contextlib.contextmanager
+def _quiet() -> Iterator[None]:
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def _reset_state() -> None:
+    """Forget everything a previous run left behind (journal, mirror ranking cache, ...)."""
+    shutil.rmtree(constants.CACHE_DIR, ignore_errors=True)
+    constants.CACHE_DIR.mkdir(parents=True)
+
+
+def run_scenario(scenario: Scenario, latency_scale: float, seed: int, verbose: bool) -> float:
+    """Run the whole pre-chroot flow of the scenario once, return how long it took."""
+    pre_chroot = _load_pre_chroot()
+    _reset_state()
+    argv = sys.argv
+    output = contextlib.nullcontext() if verbose else _quiet()
+    with scenario.make_simulation(latency_scale, seed), output:
+        sys.argv = ["pre-chroot.py", *scenario.argv]
+        start = time.perf_counter()
+        try:
+            pre_chroot.main()
+        finally:
+            sys.argv = argv
+        return time.perf_counter() - start
+
+
+# Subsystems, each of them is called repeatedly within a single measurement
+
+def bench_layout() -> None:
+    geometry = partitioning.DeviceGeometry(size=2048 * GIB, physical_block_size=4096, optimal_io_size=1024 ** 2)
+    specs = [
+        partitioning.PartitionSpec(GIB, mountpoint=Path("/boot"), is_efi=True, name="EFI"),
+        partitioning.PartitionSpec(16 * GIB, is_swap=True, name="swap"),
+        partitioning.PartitionSpec(100 * GIB, mountpoint=Path("/"), name="root"),
+        partitioning.PartitionSpec(None, mountpoint=Path("/home"), name="home"),
+    ]
+    partitioning.make_sfdisk_script(partitioning.compute_layout(geometry, specs))
+
+
+_EFI_SCHEME = [
+    ("/dev/nvme0n1p1", "/boot", False, True, "vfat"),
+    ("/dev/nvme0n1p2", "/", False, False, "btrfs"),
+    ("/dev/nvme0n1p3", None, True, False, "swap"),
+    ("/dev/nvme0n1p4", "/home", False, False, "xfs"),
+    ("/dev/sda1", "/srv", False, False, "ext4"),
+]
+
+
+def bench_fstab() -> None:
+    partitions = [
+        disk.Partition(Path(path), None if mountpoint is None else Path(mountpoint), is_swap, is_efi, filesystem)
+        for path, mountpoint, is_swap, is_efi, filesystem in _EFI_SCHEME
+    ]
+    disk.make_fstab(disk.plan_mounts(partitions))
+
+
+_MIRROR_RESULTS = [
+    mirrors.MirrorResult(f"https://mirror{n}.example.org/$repo/os/$arch", 0.01 * (n % 37), 1024 ** 2 * (n % 53 + 1), n)
+    for n in range(1000)
+]
+
+
+def bench_mirror_ranking() -> None:
+    mirrors.format_mirrorlist([result.server for result in mirrors.rank_results(_MIRROR_RESULTS)])
+
+
+def bench_pacman_config() -> None:
+    pacman.set_options(STOCK_PACMAN_CONF, {"ParallelDownloads": ["5"], "CacheDir": ["/a/", "/b/"]})
+
+
+def bench_answers() -> None:
+    partitions = inventory.get().get_partitions()
+    for _ in range(10):
+        questions.device("Pick the / partition", partitions, key="partitions.root")
+        questions.choice("Which filesystem?", choices=filesystems.LINUX_FILESYSTEMS, key="partitions.root_filesystem")
+
+
+def bench_scheduler() -> None:
+    # Layers of 5 independent steps, each depending on the whole previous layer
+    steps: list[Step] = []
+    previous: list[str] = []
+    for layer in range(6):
+        names = [f"step-{layer}-{n}" for n in range(5)]
+        steps += [Step(name, lambda results: None, depends=previous) for name in names]
+        previous = names
+    Scheduler(steps).run()
+
+
+def bench_plan_script() -> None:
+    plan = installplan.InstallPlan()
+    for n in range(200):
+        plan.step = f"step-{n // 20}"
+        plan.add_command(["mount", "-o", "noatime", f"/dev/sda{n}", f"/mnt/dir {n}"], root=True)
+    plan.add_file(Path("/mnt/etc/fstab"), "UUID=1234\t/\text4\tnoatime\t0 1\n" * 50)
+    plan.to_script()
+
+
+class Subsystem(NamedTuple):
+    name: str
+    func: Callable[[], None]
+    iterations: int
+    # Whether the subsystem needs the simulated machine (it runs commands or asks questions)
+    simulated: bool = False
+
+
+SUBSYSTEMS = [
+    Subsystem("layout", bench_layout, 2000),
+    Subsystem("fstab", bench_fstab, 200, simulated=True),
+    Subsystem("mirror-ranking", bench_mirror_ranking, 50),
+    Subsystem("pacman-config", bench_pacman_config, 2000),
+    Subsystem("answers", bench_answers, 50, simulated=True),
+    Subsystem("scheduler", bench_scheduler, 20),
+    Subsystem("plan-script", bench_plan_script, 100),
+]
+
+
+def run_subsystem(subsystem: Subsystem) -> float:
+    """Time the subsystem, return the average duration of a single call."""
+    simulation = efi_scenario(0, 0) if subsystem.simulated else contextlib.nullcontext()
+    with simulation, _quiet():
+        start = time.perf_counter()
+        for _ in range(subsystem.iterations):
+            subsystem.func()
+        return (time.perf_counter() - start) / subsystem.iterations
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f}us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.1f}ms"
+    return f"{seconds:.3f}s"
+
+
+def summarize(kind: str, durations: list[float]) -> dict:
+    return {
+        "kind": kind,
+        "runs": durations,
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "max": max(durations),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Get descriptions of the benchmarks which are slower than in the baseline."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            continue
+        limit = base["median"] * (1 + tolerance)
+        if result["median"] > limit:
+            regressions.append(
+                f"{name}: median {format_duration(result['median'])} exceeds {format_duration(limit)} "
+                f"(baseline {format_duration(base['median'])})"
+            )
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the installer on a simulated machine.")
+    parser.add_argument(
+        "--scenario", action="append", choices=[scenario.name for scenario in SCENARIOS],
+        help="run only given scenario (can be repeated, default: all)",
+    )
+    parser.add_argument("--no-scenarios", action="store_true", help="only run the subsystem benchmarks")
+    parser.add_argument("--no-subsystems", action="store_true", help="only run the end-to-end scenarios")
+    parser.add_argument("--repeat", type=int, default=3, help="how many times to run each benchmark (default: 3)")
+    parser.add_argument(
+        "--latency-scale", type=float, default=1.0,
+        help="multiply all simulated latencies (0 measures the orchestration alone, default: 1)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the simulated flaky network")
+    parser.add_argument("--output", "-o", type=Path, help="write the results as JSON to this file")
+    parser.add_argument(
+        "--baseline", type=Path, default=DEFAULT_BASELINE,
+        help=f"baseline to compare with (default: {DEFAULT_BASELINE})",
+    )
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline (default: 0.25 = 25%%)"
+    )
+    parser.add_argument("--verbose", "-v", action="store_true", help="show the output of the scenarios")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    results: dict[str, dict] = {}
+    failed = False
+
+    scenarios = [] if args.no_scenarios else [s for s in SCENARIOS if args.scenario is None or s.name in args.scenario]
+    for scenario in scenarios:
+        durations = []
+        for run in range(args.repeat):
+            try:
+                durations.append(run_scenario(scenario, args.latency_scale, args.seed + run, args.verbose))
+            except BaseException as exc:
+                print(f"{constants.ERROR_COLOR}Scenario {scenario.name} failed: {exc!r}")
+                traceback.print_exc()
+                failed = True
+                break
+        else:
+            results[f"scenario:{scenario.name}"] = summarize("scenario", durations)
+            print(f"{constants.INFO_COLOR}scenario:{scenario.name}: {format_duration(statistics.median(durations))}")
+
+    if not args.no_subsystems:
+        for subsystem in SUBSYSTEMS:
+            durations = [run_subsystem(subsystem) for _ in range(args.repeat)]
+            results[f"subsystem:{subsystem.name}"] = summarize("subsystem", durations)
+            median = format_duration(statistics.median(durations))
+            print(f"{constants.INFO_COLOR}subsystem:{subsystem.name}: {median}/call")
+
+    report = {
+        "created": time.time(),
+        "python": platform.python_version(),
+        "latency_scale": args.latency_scale,
+        "results": results,
+    }
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f"{constants.NOTE_COLOR}Results written to {args.output}")
+
+    if args.update_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print(f"{constants.SUCCESS_COLOR}Baseline updated: {args.baseline}")
+    elif not args.baseline.exists():
+        print(f"{constants.ERROR_COLOR}Baseline {args.baseline} doesn't exist, create it with --update-baseline")
+        failed = True
+    else:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline.get("latency_scale") != args.latency_scale:
+            print(f"{constants.WARN_COLOR}Baseline was measured with a different latency scale, not comparing")
+        else:
+            regressions = compare(results, baseline, args.tolerance)
+            for regression in regressions:
+                print(f"{constants.ERROR_COLOR}Regression: {regression}")
+            if len(regressions) == 0:
+                print(f"{constants.SUCCESS_COLOR}No regressions against {args.baseline}")
+            failed = failed or len(regressions) != 0
+
+    shutil.rmtree(_WORK_DIR, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
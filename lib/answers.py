@@ -0,0 +1,138 @@
+import json
+import tomllib
+from pathlib import Path
+from typing import Any, Optional
+
+from lib import constants
+
+# Sysfs files identifying the machine, used to pick per-host overrides
+DMI_SERIAL_FILES = [
+    Path("/sys/class/dmi/id/product_serial"),
+    Path("/sys/class/dmi/id/board_serial"),
+    Path("/sys/class/dmi/id/chassis_serial"),
+]
+
+_MISSING = object()
+
+
+class MissingAnswerError(Exception):
+    """Raised when a question has no answer in the answer file (instead of blocking on input)."""
+
+    def __init__(self, key: Optional[str], message: str):
+        if key is None:
+            super().__init__(f"Question '{message}' can't be answered from an answer file (it has no key)")
+        else:
+            super().__init__(f"Answer file has no answer for '{key}' (question: '{message}')")
+        self.key = key
+
+
+def get_host_ids() -> list[str]:
+    """Get identifiers of this machine: MAC addresses of all interfaces and DMI serial numbers."""
+    ids = []
+    for address_file in sorted(Path("/sys/class/net").glob("*/address")):
+        try:
+            address = address_file.read_text().strip().lower()
+        except OSError:
+            continue
+        if address and address != "00:00:00:00:00:00":
+            ids.append(address)
+    for serial_file in DMI_SERIAL_FILES:
+        try:
+            serial = serial_file.read_text().strip()
+        except OSError:
+            continue
+        if serial:
+            ids.append(serial)
+    return ids
+
+
+def _flatten(data: dict, prefix: str = "") -> dict[str, Any]:
+    """Flatten nested tables into dotted keys (`[partitions] root = ...` becomes `partitions.root`)."""
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+class AnswerFile:
+    """
+    Answers for questions, keyed by the question's key.
+
+    The file is TOML (`.toml`) or JSON. Answers under `hosts.<id>` override the global
+    ones for the machine with that MAC address or DMI serial number. A list answer to
+    a question which is asked repeatedly is consumed one item per asking.
+    """
+
+    def __init__(self, path: Path, host_ids: Optional[list[str]] = None):
+        self.path = path
+        if path.suffix == ".toml":
+            data = tomllib.loads(path.read_text())
+        else:
+            data = json.loads(path.read_text())
+
+        hosts = {str(host_id).lower(): answers for host_id, answers in data.pop("hosts", {}).items()}
+        self.answers = _flatten(data)
+        self.host_id = None
+        for host_id in get_host_ids() if host_ids is None else host_ids:
+            if host_id.lower() in hosts:
+                self.host_id = host_id
+                self.answers.update(_flatten(hosts[host_id.lower()]))
+                break
+        self._consumed: dict[str, int] = {}
+
+    def get(self, key: Optional[str], sequence: bool = True) -> Any:
+        """
+        Get the answer for given key, or `_MISSING` if there isn't one.
+
+        With `sequence`, list answers are consumed one item at a time.
+        """
+        if key is None or key not in self.answers:
+            return _MISSING
+        answer = self.answers[key]
+        if not sequence or not isinstance(answer, list):
+            return answer
+
+        index = self._consumed.get(key, 0)
+        if index >= len(answer):
+            return _MISSING
+        self._consumed[key] = index + 1
+        return answer[index]
+
+
+_answer_file: Optional[AnswerFile] = None
+
+
+def get_answer_file() -> Optional[AnswerFile]:
+    """Get the loaded answer file, if unattended mode is enabled."""
+    global _answer_file
+    if _answer_file is None and constants.ANSWER_FILE is not None:
+        _answer_file = AnswerFile(constants.ANSWER_FILE)
+        host_note = f" (with overrides for host {_answer_file.host_id})" if _answer_file.host_id else ""
+        print(f"{constants.NOTE_COLOR}Using answers from {constants.ANSWER_FILE}{host_note}")
+    return _answer_file
+
+
+def is_unattended() -> bool:
+    return get_answer_file() is not None
+
+
+def lookup(key: Optional[str], message: str, sequence: bool = True) -> Any:
+    """Get the answer for given question, raise `MissingAnswerError` if there's none."""
+    answer_file = get_answer_file()
+    assert answer_file is not None
+    answer = answer_file.get(key, sequence)
+    if answer is _MISSING:
+        raise MissingAnswerError(key, message)
+    return answer
+
+
+def get(key: str, default: Any = None, sequence: bool = False) -> Any:
+    """Get a raw answer which isn't tied to any question (e.g. a Wi-Fi passphrase or a partition layout)."""
+    answer_file = get_answer_file()
+    if answer_file is None:
+        return default
+    answer = answer_file.get(key, sequence)
+    return default if answer is _MISSING else answer
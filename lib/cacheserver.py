@@ -0,0 +1,409 @@
+"""
+Caching proxy for the Arch Linux repositories, so that installs on the same network download each package once.
+
+The server acts as a mirror (`Server = http://host:port/$repo/os/$arch`). A package is fetched from
+the upstream mirrors on its first request (concurrent requests for it wait for that single download),
+stored content-addressed and served from disk with sendfile afterwards. Least recently used packages
+are evicted once the cache grows over its size limit. Databases change with every repository update,
+they're passed through without caching. Installers can find the server with a UDP broadcast (`discover`).
+"""
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import posixpath
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from pathlib import Path
+from typing import IO, Optional
+
+from lib import constants, mirrors
+
+DEFAULT_PORT = 7878
+DISCOVERY_PORT = 7879
+DISCOVERY_REQUEST = b"archdeploy-cache-server?"
+# How long (in seconds) installers wait for a cache server to answer the discovery broadcast
+DISCOVERY_TIMEOUT = 1.0
+# Timeout of the connections to the upstream mirrors
+UPSTREAM_TIMEOUT = 30
+DEFAULT_MAX_SIZE = 20 * 1024 ** 3
+# Seconds between saves of the index while packages are being added (it's saved on shutdown too)
+INDEX_SAVE_INTERVAL = 30
+
+# Files which never change once published (packages and their signatures)
+CACHEABLE_MARKER = ".pkg.tar."
+
+
+def server_url(host: str, port: int = DEFAULT_PORT) -> str:
+    """Get the mirrorlist server URL of a cache server."""
+    return f"http://{host}:{port}/$repo/os/$arch"
+
+
+class UpstreamError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class PackageStore:
+    """
+    Content-addressed package storage, evicting the least recently used packages over `max_size` bytes.
+
+    Packages are stored by the SHA-256 of their content (the same package in multiple repositories
+    is stored once), the index maps the requested paths to them, in the order of their last use.
+    """
+
+    def __init__(self, directory: Path, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.objects_dir = directory / "objects"
+        self.tmp_dir = directory / "tmp"
+        self.index_file = directory / "index.json"
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Serializes the writes of the index, which happen outside of `_lock`
+        self._save_lock = threading.Lock()
+        self._last_save = time.monotonic()
+        self._entries: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._load()
+
+    def _blob(self, digest: str) -> Path:
+        return self.objects_dir / digest[:2] / digest
+
+    def _load(self) -> None:
+        try:
+            index = json.loads(self.index_file.read_text())
+        except (OSError, ValueError):
+            index = []
+        # Blobs could have been removed by hand, only keep what's still there
+        for name, digest, size in index:
+            if self._blob(digest).exists():
+                self._entries[name] = (digest, size)
+
+    def save(self) -> None:
+        """Write the index, replacing the previous one atomically."""
+        with self._save_lock:
+            with self._lock:
+                index = [[name, digest, size] for name, (digest, size) in self._entries.items()]
+            with tempfile.NamedTemporaryFile("w", dir=self.directory, suffix=".tmp", delete=False) as file:
+                json.dump(index, file)
+            os.replace(file.name, self.index_file)
+            self._last_save = time.monotonic()
+
+    @property
+    def size(self) -> int:
+        """Size of all of the stored packages, in bytes."""
+        with self._lock:
+            return sum(dict(self._entries.values()).values())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, name: str) -> Optional[tuple[Path, int]]:
+        """Get the path and size of the stored package, marking it as recently used."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            self._entries.move_to_end(name)
+            return self._blob(entry[0]), entry[1]
+
+    def new_file(self) -> IO[bytes]:
+        """Get a temporary file to download a package into, to be passed to `add`."""
+        return tempfile.NamedTemporaryFile(dir=self.tmp_dir, delete=False)
+
+    def add(self, name: str, tmp_path: Path, digest: str, size: int) -> None:
+        """Store a downloaded package (moving the temporary file), evicting old ones if needed."""
+        blob = self._blob(digest)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, blob)
+        with self._lock:
+            self._entries[name] = (digest, size)
+            self._entries.move_to_end(name)
+            self._evict()
+        if time.monotonic() - self._last_save < INDEX_SAVE_INTERVAL:
+            return
+        # The package is stored either way, a failed save is retried with the next one
+        try:
+            self.save()
+        except OSError as exc:
+            print(f"{constants.WARN_COLOR}Unable to save the index of the package cache: {exc}")
+
+    def _evict(self) -> None:
+        sizes = dict(self._entries.values())
+        total = sum(sizes.values())
+        # The most recent package is kept even if it's over the limit by itself
+        while total > self.max_size and len(self._entries) > 1:
+            _, (digest, size) = self._entries.popitem(last=False)
+            if all(entry[0] != digest for entry in self._entries.values()):
+                self._blob(digest).unlink(missing_ok=True)
+                total -= size
+
+
+class _Download:
+    """Download of a package in progress, which other requests for it wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error: Optional[UpstreamError] = None
+
+
+class CacheServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], store: PackageStore, upstreams: list[str]):
+        super().__init__(address, CacheRequestHandler)
+        self.store = store
+        # Root URLs of the upstream mirrors, tried in order
+        self.upstreams = [mirrors.server_root(server) for server in upstreams]
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._downloads: dict[str, _Download] = {}
+
+    def open_upstream(self, name: str, headers: Optional[dict[str, str]] = None, method: str = "GET"):
+        """Open given file at the first upstream mirror which has it."""
+        status, reason = 502, "no upstream mirrors"
+        for root in self.upstreams:
+            request = urllib.request.Request(root + name, headers={"User-Agent": "ArchDeploy", **(headers or {})},
+                                             method=method)
+            try:
+                return urllib.request.urlopen(request, timeout=UPSTREAM_TIMEOUT)
+            except urllib.error.HTTPError as exc:
+                if exc.code == 304:
+                    raise UpstreamError(304, "not modified")
+                # Prefer reporting "not found" over errors of other mirrors
+                if exc.code == 404 or status != 404:
+                    status, reason = exc.code, f"{root}{name}: {exc.reason}"
+            except (OSError, http.client.HTTPException) as exc:
+                if status != 404:
+                    status, reason = 502, f"{root}{name}: {exc}"
+        raise UpstreamError(status, reason)
+
+    def _download(self, name: str) -> None:
+        with self.open_upstream(name) as response:
+            length = response.headers.get("Content-Length")
+            file = self.store.new_file()
+            tmp_path = Path(file.name)
+            try:
+                with file:
+                    digest = hashlib.sha256()
+                    size = 0
+                    while chunk := response.read(1024 ** 2):
+                        digest.update(chunk)
+                        file.write(chunk)
+                        size += len(chunk)
+                # A connection closed early can look like the end of the file, never store a partial package
+                if length is not None and length.isdigit() and size != int(length):
+                    raise UpstreamError(502, f"download of {name} is incomplete ({size} of {length} bytes)")
+                self.store.add(name, tmp_path, digest.hexdigest(), size)
+            except (OSError, http.client.HTTPException) as exc:
+                raise UpstreamError(502, f"download of {name} failed: {exc!r}")
+            finally:
+                # Already moved into the store if the download succeeded
+                tmp_path.unlink(missing_ok=True)
+
+    def fetch(self, name: str) -> tuple[Path, int]:
+        """Get the stored package, downloading it first if it isn't cached yet."""
+        entry = self.store.lookup(name)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        with self._lock:
+            download = self._downloads.get(name)
+            is_owner = download is None
+            if download is None:
+                download = self._downloads[name] = _Download()
+        if is_owner:
+            self.misses += 1
+            try:
+                self._download(name)
+            except UpstreamError as exc:
+                download.error = exc
+            except Exception as exc:
+                # Whatever went wrong, the waiting requests have to get the error instead of finding nothing
+                download.error = UpstreamError(500, f"download of {name} failed: {exc!r}")
+            finally:
+                with self._lock:
+                    del self._downloads[name]
+                download.done.set()
+        else:
+            download.done.wait()
+
+        if download.error is not None:
+            raise download.error
+        entry = self.store.lookup(name)
+        if entry is None:
+            raise UpstreamError(503, f"{name} was evicted right after the download, the cache is too small")
+        return entry
+
+
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+    server: CacheServer
+    # Keep the connection alive, pacman downloads many files from the same server
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        self._serve(send_body=True)
+
+    def do_HEAD(self) -> None:
+        self._serve(send_body=False)
+
+    def _name(self) -> Optional[str]:
+        """Get the repository path of the requested file, `None` if it points outside of the repositories."""
+        path = posixpath.normpath(self.path.split("?", 1)[0]).lstrip("/")
+        if path in ("", ".") or path.startswith(".."):
+            return None
+        return path
+
+    def _serve(self, send_body: bool) -> None:
+        name = self._name()
+        if name is None:
+            self.send_error(400)
+        elif CACHEABLE_MARKER in posixpath.basename(name):
+            self._serve_cached(name, send_body)
+        else:
+            self._pass_through(name, send_body)
+
+    def _range_start(self, size: int) -> Optional[int]:
+        """Get the offset of an open ended range request (pacman resuming a download), 0 for no range."""
+        requested = self.headers.get("Range", "")
+        if not requested.startswith("bytes=") or not requested.endswith("-"):
+            return 0
+        start = requested[len("bytes="):-1]
+        if not start.isdigit():
+            return 0
+        return int(start) if int(start) < size else None
+
+    def _serve_cached(self, name: str, send_body: bool) -> None:
+        try:
+            path, size = self.server.fetch(name)
+            file = open(path, "rb")
+        except UpstreamError as exc:
+            self.send_error(exc.status, str(exc))
+            return
+        except FileNotFoundError:
+            # Evicted between the lookup and opening it
+            self.send_error(503)
+            return
+
+        with file:
+            start = self._range_start(size)
+            if start is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206 if start else 200)
+            if start:
+                self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(size - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+            if send_body:
+                self.connection.sendfile(file, start, size - start)
+
+    def _pass_through(self, name: str, send_body: bool) -> None:
+        """Proxy a file which changes over time (like a database) without caching it."""
+        headers = {key: self.headers[key] for key in ("If-Modified-Since", "If-None-Match") if key in self.headers}
+        try:
+            response = self.server.open_upstream(name, headers, "GET" if send_body else "HEAD")
+        except UpstreamError as exc:
+            if exc.status == 304:
+                self.send_response(304)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                self.send_error(exc.status, str(exc))
+            return
+
+        with response:
+            self.send_response(response.status)
+            for key in ("Content-Type", "Content-Length", "Last-Modified", "ETag"):
+                if response.headers.get(key) is not None:
+                    self.send_header(key, response.headers[key])
+            if response.headers.get("Content-Length") is None:
+                self.close_connection = True
+            self.end_headers()
+            if send_body:
+                shutil.copyfileobj(response, self.wfile)
+
+    def log_message(self, format: str, *args) -> None:
+        print(f"{constants.NOTE_COLOR}{self.address_string()} {format % args}")
+
+
+class DiscoveryResponder(threading.Thread):
+    """Answer the discovery broadcasts of installers with the port of the cache server."""
+
+    def __init__(self, http_port: int, port: int = DISCOVERY_PORT):
+        super().__init__(name="cache-discovery", daemon=True)
+        self.http_port = http_port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("", port))
+
+    def run(self) -> None:
+        reply = json.dumps({"port": self.http_port}).encode()
+        while True:
+            try:
+                data, address = self.sock.recvfrom(512)
+                if data == DISCOVERY_REQUEST:
+                    self.sock.sendto(reply, address)
+            except OSError:
+                return
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def discover(timeout: float = DISCOVERY_TIMEOUT, port: int = DISCOVERY_PORT) -> Optional[str]:
+    """Find a cache server on the local network, return its mirrorlist server URL or `None`."""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.settimeout(timeout)
+            sock.sendto(DISCOVERY_REQUEST, ("<broadcast>", port))
+            data, (host, _) = sock.recvfrom(512)
+        return server_url(host, int(json.loads(data)["port"]))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def serve(
+    directory: Path = constants.CACHE_DIR / "serve",
+    max_size: int = DEFAULT_MAX_SIZE,
+    port: int = DEFAULT_PORT,
+    upstreams: Optional[list[str]] = None,
+) -> None:
+    """Run the cache server (and answer discovery broadcasts) until interrupted."""
+    if upstreams is None:
+        upstreams = mirrors.read_mirrorlist()
+    store = PackageStore(directory, max_size)
+    server = CacheServer(("", port), store, upstreams)
+    responder = DiscoveryResponder(server.server_port)
+    responder.start()
+    print(
+        f"{constants.INFO_COLOR}Serving the package cache at {constants.CMD_COLOR}"
+        f"{server_url(socket.gethostname(), server.server_port)}{constants.INFO_COLOR} "
+        f"({len(store)} packages, {store.size / 1024 ** 3:.1f}/{max_size / 1024 ** 3:.1f} GiB, "
+        f"{len(upstreams)} upstream mirrors)"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        responder.close()
+        store.save()
+        print(f"{constants.INFO_COLOR}Cache server stopped ({server.hits} hits, {server.misses} misses)")
@@ -1,31 +1,56 @@
+import atexit
 import os
 import pathlib
+import shlex
 import sys
 import subprocess
+import tempfile
+import time
+from collections import deque
+from typing import IO, Callable, Iterator, Optional, Union
 
-from lib import constants, questions
+from lib import constants, installplan, inventory, native, questions, redaction, rootworker, terminal, tracing
 
 # Find proper command for root cmd execution
 HAS_SUDO = pathlib.Path("/usr/bin/sudo").exists()
 HAS_DOAS = pathlib.Path("/usr/bin/doas").exists()
 
+# How many of the last output lines of a streamed command are kept in memory
+STREAM_TAIL_LINES = 50
+
+_root_worker: Optional[rootworker.RootWorker] = None
+_root_worker_failed = False
+
 
 def debug_confirm_run(command: str) -> bool:
     """If DEBUG is on, ask user for confirmation to run given command."""
     if constants.DEBUG:
         cnfrm: bool = questions.confirm(  # type: ignore
             f"{constants.DEBUG_COLOR}[DEBUG] Running command: "
-            f"{constants.CMD_COLOR}{command}"
+            f"{constants.CMD_COLOR}{redaction.redact(command)}",
+            key="debug.confirm_run",
         )
         return cnfrm
     else:
         return True
 
 
-def run_cmd(cmd: str, capture_out: bool = False, enable_debug: bool = True) -> subprocess.CompletedProcess:
-    """Run given command."""
+def run_cmd(
+    cmd: str, capture_out: bool = False, enable_debug: bool = True, read_only: bool = False
+) -> subprocess.CompletedProcess:
+    """
+    Run given command.
+
+    When an install plan is being recorded, the command is only added to it, unless it's
+    `read_only` (it only inspects the system, which the install decisions may depend on).
+    """
+    plan = installplan.get()
+    if plan is not None and not read_only:
+        return plan.record(cmd, root=False, capture_out=capture_out)
+
     args = {}
-    if capture_out:
+    # Background work can't write to the terminal directly, its output is passed through (deferred) sys.stdout
+    if capture_out or terminal.in_background():
         args.update({"stdout": subprocess.PIPE, "stderr": subprocess.STDOUT})
     else:
         # If we aren't capturing output, it will be eachoed, this however won't reset colorama's color
@@ -34,32 +59,249 @@ def run_cmd(cmd: str, capture_out: bool = False, enable_debug: bool = True) -> s
         sys.stdout.flush()
 
     if not enable_debug or debug_confirm_run(cmd):
-        return subprocess.run(cmd, shell=True, **args)
+        with tracing.span(cmd, tracing.COMMAND, argv=cmd) as span_args:
+            if capture_out:
+                proc = subprocess.run(cmd, shell=True, **args)
+            elif terminal.in_background():
+                proc = _echo_output(subprocess.run(cmd, shell=True, **args))
+            else:
+                # Output goes straight to the terminal, don't let background workers write over it
+                with terminal.busy():
+                    proc = subprocess.run(cmd, shell=True, **args)
+            _trace_result(span_args, proc)
+        return proc
     else:
         # If debug confirm returned False, end with error code 1
         return subprocess.CompletedProcess(cmd, returncode=1)
 
 
-def run_root_cmd(cmd: str, capture_out: bool = False, enable_debug: bool = True) -> subprocess.CompletedProcess:
-    """Run given command as root."""
-    if os.getuid() != 0:
-        # Use available root escalation tool to run given cmd
-        if HAS_SUDO:
-            root_cmd = f"sudo {cmd}"
-        elif HAS_DOAS:
-            root_cmd = f"doas {cmd}"
-        else:
-            # We need to escape double quotes here, because we use them with su command
-            print(
-                f"{constants.DEBUG_COLOR}Neither sudo nor doas were found, falling back "
-                "to su to execute root commands (enter root password, not user password)"
-            )
-            cmd = cmd.replace('"', r'\"')
-            root_cmd = f'su -c "{cmd}"'
-
-        return run_cmd(root_cmd, capture_out, enable_debug)
+def _echo_output(proc: subprocess.CompletedProcess) -> subprocess.CompletedProcess:
+    """Write out captured output, as if the command wasn't captured."""
+    sys.stdout.write(constants.RESET_COLOR + proc.stdout.decode(errors="replace"))
+    proc.stdout = None
+    return proc
+
+
+def _trace_result(span_args: dict, proc: subprocess.CompletedProcess) -> None:
+    span_args["exit_code"] = proc.returncode
+    span_args["output_bytes"] = len(proc.stdout) if proc.stdout is not None else None
+
+
+def get_root_prefix(interactive: bool = True) -> Optional[list[str]]:
+    """
+    Get the argv prefix needed to run a command as root.
+
+    With `interactive=False`, only return a prefix which won't ask for a password
+    (useful for background commands), or `None` if there is no such option.
+    """
+    if os.getuid() == 0:
+        return []
+    if HAS_SUDO:
+        return ["sudo"] if interactive else ["sudo", "-n"]
+    if HAS_DOAS:
+        return ["doas"] if interactive else ["doas", "-n"]
+    return ["su", "-c"] if interactive else None
+
+
+# Characters which need a shell to be interpreted (redirections, pipes, globs, variables, ...)
+SHELL_METACHARACTERS = set("|&;<>()$`*?~{}[]\\\n")
+
+
+def to_argv(cmd: Union[str, list[str]]) -> list[str]:
+    """Convert given command into an argv list, only commands using shell syntax are passed to `sh -c`."""
+    if isinstance(cmd, list):
+        return cmd
+    if SHELL_METACHARACTERS.isdisjoint(cmd):
+        return shlex.split(cmd)
+    return ["sh", "-c", cmd]
+
+
+def _get_root_worker() -> Optional[rootworker.RootWorker]:
+    """Get the persistent privileged worker, starting it on first use. Return `None` if it can't run."""
+    global _root_worker, _root_worker_failed
+
+    if _root_worker is not None and _root_worker.alive:
+        return _root_worker
+    if _root_worker_failed:
+        return None
+
+    root_prefix = get_root_prefix()
+    if root_prefix == ["su", "-c"]:
+        print(
+            f"{constants.DEBUG_COLOR}Neither sudo nor doas were found, falling back "
+            "to su to execute root commands (enter root password, not user password)"
+        )
+    try:
+        with terminal.busy():
+            _root_worker = rootworker.RootWorker(root_prefix or [])
+    except OSError:
+        print(f"{constants.WARN_COLOR}Unable to start privileged worker, root commands will be ran one by one.")
+        _root_worker_failed = True
+        return None
+    atexit.register(_root_worker.close)
+    return _root_worker
+
+
+def run_root_cmd(
+    cmd: Union[str, list[str]],
+    capture_out: bool = False,
+    enable_debug: bool = True,
+    read_only: bool = False,
+) -> subprocess.CompletedProcess:
+    """
+    Run given command as root.
+
+    Commands are executed by a persistent privileged worker, so that the escalation
+    (and possibly the password prompt) only happens once for the whole install.
+    Like with `run_cmd`, only `read_only` commands are ran when recording an install plan.
+    """
+    plan = installplan.get()
+    if plan is not None and not read_only:
+        return plan.record(cmd, root=True, capture_out=capture_out)
+
+    if os.getuid() == 0:
+        return run_cmd(cmd if isinstance(cmd, str) else shlex.join(cmd), capture_out, enable_debug, read_only)
+
+    cmd_str = cmd if isinstance(cmd, str) else shlex.join(cmd)
+    worker = _get_root_worker()
+    if worker is None:
+        return _run_escalated_cmd(cmd_str, capture_out, enable_debug)
+
+    if enable_debug and not debug_confirm_run(cmd_str):
+        return subprocess.CompletedProcess(cmd, returncode=1)
+
+    argv = to_argv(cmd)
+    try:
+        with tracing.span(cmd_str, tracing.COMMAND, argv=argv, root=True) as span_args:
+            if capture_out:
+                proc = worker.run(argv, capture_out=True)
+            elif terminal.in_background():
+                proc = _echo_output(worker.run(argv, capture_out=True))
+            else:
+                sys.stdout.write(constants.RESET_COLOR)
+                sys.stdout.flush()
+                with terminal.busy():
+                    proc = worker.run(argv, capture_out=False)
+            _trace_result(span_args, proc)
+    except OSError:
+        print(f"{constants.WARN_COLOR}Privileged worker exited unexpectedly, running the command directly.")
+        return _run_escalated_cmd(cmd_str, capture_out, enable_debug=False)
+    return subprocess.CompletedProcess(cmd, proc.returncode, proc.stdout)
+
+
+def _escalate_cmd(cmd: str) -> str:
+    """Prefix given command with available root escalation tool."""
+    if HAS_SUDO:
+        return f"sudo {cmd}"
+    elif HAS_DOAS:
+        return f"doas {cmd}"
     else:
-        return run_cmd(cmd, capture_out, enable_debug)
+        # We need to escape double quotes here, because we use them with su command
+        cmd = cmd.replace('"', r'\"')
+        return f'su -c "{cmd}"'
+
+
+def _run_escalated_cmd(cmd: str, capture_out: bool = False, enable_debug: bool = True) -> subprocess.CompletedProcess:
+    """Run given command as root by spawning the root escalation tool for it directly."""
+    return run_cmd(_escalate_cmd(cmd), capture_out, enable_debug)
+
+
+class StreamedProcess:
+    """
+    A running command with its output streamed line by line.
+
+    Iterating over the process yields the output lines as they're produced, they're
+    also written to the install log. Only the last `tail_size` lines are kept in memory
+    (in `tail`), for error reporting. Once the output is exhausted, `returncode` is set.
+    """
+
+    def __init__(
+        self,
+        args: Union[str, list[str]],
+        lines: Iterator[bytes],
+        wait: Callable[[], int],
+        tail_size: int = STREAM_TAIL_LINES,
+    ):
+        self.args = args
+        self.returncode: Optional[int] = None
+        self.tail: deque[str] = deque(maxlen=tail_size)
+        self.output_bytes = 0
+        self._lines = lines
+        self._wait = wait
+        self._start = time.perf_counter()
+
+    def __iter__(self) -> Iterator[str]:
+        cmd_str = self.args if isinstance(self.args, str) else shlex.join(self.args)
+        with _open_log() as log:
+            log.write(f"$ {redaction.redact(cmd_str)}\n")
+            for raw_line in self._lines:
+                self.output_bytes += len(raw_line)
+                line = raw_line.decode(errors="replace").rstrip("\n")
+                log.write(line + "\n")
+                log.flush()
+                self.tail.append(line)
+                yield line
+            self.returncode = self._wait()
+            log.write(f"[exit code: {self.returncode}]\n")
+        tracing.record_span(
+            cmd_str, tracing.COMMAND, self._start, time.perf_counter(),
+            argv=self.args, exit_code=self.returncode, output_bytes=self.output_bytes,
+        )
+
+    def wait(self) -> int:
+        """Consume the rest of the output, return the exit code."""
+        for _ in self:
+            pass
+        assert self.returncode is not None
+        return self.returncode
+
+
+def _open_log() -> IO[str]:
+    try:
+        return open(constants.INSTALL_LOG, "a")
+    except OSError:
+        return open(os.devnull, "w")
+
+
+def _popen_lines(cmd: str) -> tuple[Iterator[bytes], Callable[[], int]]:
+    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    assert proc.stdout is not None
+    return iter(proc.stdout), proc.wait
+
+
+def stream_cmd(cmd: Union[str, list[str]], root: bool = False, enable_debug: bool = True) -> StreamedProcess:
+    """Run given command (as root if `root` is set), streaming its output instead of buffering it."""
+    plan = installplan.get()
+    if plan is not None:
+        plan.add_command(cmd, root)
+        return StreamedProcess(cmd, iter([]), lambda: 0)
+
+    cmd_str = cmd if isinstance(cmd, str) else shlex.join(cmd)
+    if enable_debug and not debug_confirm_run(cmd_str):
+        return StreamedProcess(cmd, iter([]), lambda: 1)
+
+    if not root or os.getuid() == 0:
+        return StreamedProcess(cmd, *_popen_lines(cmd_str))
+
+    worker = _get_root_worker()
+    if worker is None:
+        return StreamedProcess(cmd, *_popen_lines(_escalate_cmd(cmd_str)))
+    return StreamedProcess(cmd, *worker.stream(to_argv(cmd)))
+
+
+def write_root_file(path: pathlib.Path, content: str, mode: str = "644") -> subprocess.CompletedProcess:
+    """Write given content to a file which may only be writable by root."""
+    plan = installplan.get()
+    if plan is not None:
+        plan.add_file(path, content, mode)
+        return subprocess.CompletedProcess(["install", "-m", mode, "-", str(path)], 0)
+
+    with tempfile.NamedTemporaryFile("w", prefix="archdeploy-", delete=False) as file:
+        file.write(content)
+    try:
+        return run_root_cmd(f"install -m {mode} {shlex.quote(file.name)} {shlex.quote(str(path))}")
+    finally:
+        os.unlink(file.name)
 
 
 def drop_to_shell(enable_debug: bool = False) -> None:
@@ -67,12 +309,20 @@ def drop_to_shell(enable_debug: bool = False) -> None:
         f"{constants.INFO_COLOR}Dropping to shell. After you made the desired changes, "
         f"use {constants.CMD_COLOR}exit{constants.INFO_COLOR} to return."
     )
+    if installplan.is_active():
+        print(f"{constants.WARN_COLOR}Changes made from the shell can't be a part of the install plan, skipping it.")
+        return
     run_cmd("exec ${SHELL}", enable_debug=enable_debug)
+    # Anything could have been changed from the shell (partitions, interfaces, ...)
+    inventory.invalidate()
 
 
 def command_exists(cmd) -> bool:
     """Check if given command can be executed."""
     parts = cmd.split()
     executable = parts[0] if parts[0] not in ("sudo", "source", ".") else parts[1]
-    proc = run_cmd(f"command -v {executable}", capture_out=True)
+    if native.which(executable) is not None:
+        return True
+    # Shell builtins, functions and aliases aren't in PATH, only the shell itself can tell
+    proc = run_cmd(f"command -v {executable}", capture_out=True, read_only=True)
     return proc.returncode == 0
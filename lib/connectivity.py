@@ -0,0 +1,252 @@
+import abc
+import http.client
+import queue
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+from typing import Optional
+
+# How long to trust a successful check before probing again
+CACHE_TTL = 10
+# Overall deadline for a single connectivity check
+DEFAULT_TIMEOUT = 4
+
+
+class Probe(abc.ABC):
+    """Base class for a single connectivity probe."""
+
+    @abc.abstractmethod
+    def run(self, timeout: float) -> bool:
+        """Probe the connection, return whether it works, giving up after `timeout` seconds."""
+
+
+class DNSProbe(Probe):
+    """Succeeds if given hostname can be resolved."""
+
+    def __init__(self, hostname: str):
+        self.hostname = hostname
+
+    def run(self, timeout: float) -> bool:
+        # getaddrinfo has no timeout of its own, the caller's deadline covers it
+        try:
+            return len(socket.getaddrinfo(self.hostname, None)) != 0
+        except OSError:
+            return False
+
+    def __repr__(self) -> str:
+        return f"<DNSProbe {self.hostname}>"
+
+
+class TCPProbe(Probe):
+    """Succeeds if a TCP connection to given host and port can be established."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+
+    def run(self, timeout: float) -> bool:
+        try:
+            with socket.create_connection((self.host, self.port), timeout=timeout):
+                return True
+        except OSError:
+            return False
+
+    def __repr__(self) -> str:
+        return f"<TCPProbe {self.host}:{self.port}>"
+
+
+class HTTPProbe(Probe):
+    """
+    Succeeds if a HEAD request to given URL gets any response below 500.
+
+    Connections are kept in a pool and reused by later checks, so that repeated
+    checks don't need to go through DNS, TCP and TLS handshakes again.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        parsed = urllib.parse.urlsplit(url)
+        self.https = parsed.scheme == "https"
+        self.host = parsed.hostname or ""
+        self.port = parsed.port or (443 if self.https else 80)
+        self.path = parsed.path or "/"
+        if parsed.query:
+            self.path += "?" + parsed.query
+
+        self._pool: list[http.client.HTTPConnection] = []
+        self._pool_lock = threading.Lock()
+
+    def _get_pooled_connection(self, timeout: float) -> Optional[http.client.HTTPConnection]:
+        with self._pool_lock:
+            if len(self._pool) == 0:
+                return None
+            conn = self._pool.pop()
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn
+
+    def _new_connection(self, timeout: float) -> http.client.HTTPConnection:
+        if self.https:
+            return http.client.HTTPSConnection(
+                self.host, self.port, timeout=timeout, context=ssl.create_default_context()
+            )
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _release_connection(self, conn: http.client.HTTPConnection) -> None:
+        with self._pool_lock:
+            self._pool.append(conn)
+
+    def _request(self, conn: http.client.HTTPConnection) -> bool:
+        conn.request("HEAD", self.path, headers={"Connection": "keep-alive"})
+        response = conn.getresponse()
+        response.read()
+        if response.will_close:
+            conn.close()
+        else:
+            self._release_connection(conn)
+        return response.status < 500
+
+    def run(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        conn = self._get_pooled_connection(timeout)
+        if conn is not None:
+            try:
+                return self._request(conn)
+            except (OSError, http.client.HTTPException):
+                # Pooled connection may have been closed by the server in the meantime, retry with a new one
+                conn.close()
+            # Only within what's left, a server which stopped answering mustn't be waited for twice
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return False
+
+        conn = self._new_connection(timeout)
+        try:
+            return self._request(conn)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            return False
+
+    def close(self) -> None:
+        with self._pool_lock:
+            for conn in self._pool:
+                conn.close()
+            self._pool.clear()
+
+    def __repr__(self) -> str:
+        return f"<HTTPProbe {self.url}>"
+
+
+# DNS resolution alone isn't a part of the defaults, since a local resolver can answer
+# from its cache while there's no route anywhere; it's still available for custom probe sets.
+DEFAULT_PROBES: list[Probe] = [
+    HTTPProbe("https://ping.archlinux.org"),
+    HTTPProbe("http://ping.archlinux.org"),
+    TCPProbe("archlinux.org", 443),
+    TCPProbe("1.1.1.1", 443),
+]
+
+
+class ConnectivityChecker:
+    """
+    Check internet connectivity by racing multiple probes against each other.
+
+    The first successful probe decides the result, probes which are still running
+    are abandoned. Each probe runs in a daemon thread, so that a probe stuck on
+    a black-holed route can't block the installer, not even on exit.
+    Successful results are cached for `cache_ttl` seconds.
+    """
+
+    def __init__(self, probes: list[Probe], timeout: float = DEFAULT_TIMEOUT, cache_ttl: float = CACHE_TTL):
+        self.probes = probes
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self._last_success: Optional[float] = None
+
+    @staticmethod
+    def _run_probe(probe: Probe, timeout: float, results: "queue.Queue[bool]") -> None:
+        try:
+            results.put(probe.run(timeout))
+        except Exception:
+            results.put(False)
+
+    def invalidate(self) -> None:
+        """Forget the cached result, next check will probe again."""
+        self._last_success = None
+
+    def check(self, use_cache: bool = True, timeout: Optional[float] = None) -> bool:
+        """Check the connection, return `True` as soon as any of the probes succeeds."""
+        if use_cache and self._last_success is not None:
+            if time.monotonic() - self._last_success < self.cache_ttl:
+                return True
+
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        results: "queue.Queue[bool]" = queue.Queue()
+        for probe in self.probes:
+            thread = threading.Thread(target=self._run_probe, args=(probe, timeout, results), daemon=True)
+            thread.start()
+
+        for _ in self.probes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                result = results.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if result is True:
+                self._last_success = time.monotonic()
+                return True
+
+        self._last_success = None
+        return False
+
+    def close(self) -> None:
+        for probe in self.probes:
+            if isinstance(probe, HTTPProbe):
+                probe.close()
+
+
+_default_checker: Optional[ConnectivityChecker] = None
+_checkers: dict[str, ConnectivityChecker] = {}
+
+
+def get_checker(host: Optional[str] = None) -> ConnectivityChecker:
+    """Get a (shared) checker for given URL, or the default checker with multiple probes."""
+    global _default_checker
+
+    if host is None:
+        if _default_checker is None:
+            _default_checker = ConnectivityChecker(DEFAULT_PROBES)
+        return _default_checker
+
+    if host not in _checkers:
+        _checkers[host] = ConnectivityChecker([make_probe(host)])
+    return _checkers[host]
+
+
+def make_probe(target: str) -> Probe:
+    """Make a probe for given target, `http(s)://...` URLs use HTTP, `host:port` uses TCP and others DNS."""
+    if target.startswith(("http://", "https://")):
+        return HTTPProbe(target)
+    host, sep, port = target.rpartition(":")
+    if sep and port.isdigit():
+        return TCPProbe(host, int(port))
+    return DNSProbe(target)
+
+
+def check(host: Optional[str] = None, use_cache: bool = True, timeout: Optional[float] = None) -> bool:
+    """Check if system is connected to the internet."""
+    return get_checker(host).check(use_cache=use_cache, timeout=timeout)
+
+
+def invalidate() -> None:
+    """Forget all cached results, e.g. after the network configuration changed."""
+    for checker in [_default_checker, *_checkers.values()]:
+        if checker is not None:
+            checker.invalidate()
+
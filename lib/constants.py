@@ -7,6 +7,44 @@ from lib.colors import ANSIColor
 IS_EFI = pathlib.Path("/sys/firmware/efi/efivars").exists()
 DEBUG = os.getenv("DEBUG", False)
 
+# Answer file (TOML/JSON) for unattended installs, all questions are answered from it
+ANSWER_FILE = pathlib.Path(os.environ["ARCHDEPLOY_ANSWERS"]) if os.getenv("ARCHDEPLOY_ANSWERS") else None
+
+# Output of streamed commands (like pacstrap) is recorded here
+INSTALL_LOG = pathlib.Path(os.getenv("ARCHDEPLOY_LOG", "/tmp/archdeploy-install.log"))
+
+# If set, timing of every step, command and question is traced and exported to this file (Chrome trace JSON)
+TRACE_FILE = pathlib.Path(os.environ["ARCHDEPLOY_TRACE"]) if os.getenv("ARCHDEPLOY_TRACE") else None
+
+# Persistent cache for data reusable between installs (point this to a USB stick to share it)
+CACHE_DIR = pathlib.Path(
+    os.getenv("ARCHDEPLOY_CACHE_DIR", pathlib.Path(os.getenv("XDG_CACHE_HOME", "~/.cache"), "archdeploy"))
+).expanduser()
+
+PACMAN_CONF = pathlib.Path("/etc/pacman.conf")
+MIRRORLIST = pathlib.Path("/etc/pacman.d/mirrorlist")
+# Package cache server (`pre-chroot.py cache-serve`) put first in the mirrorlist, its URL or `auto` to discover it
+CACHE_SERVER = os.getenv("ARCHDEPLOY_CACHE_SERVER")
+# How long (in seconds) is a mirror ranking reused before the mirrors get probed again
+MIRROR_CACHE_TTL = int(os.getenv("ARCHDEPLOY_MIRROR_CACHE_TTL", 6 * 60 * 60))
+
+# Packages installed into the new system with pacstrap
+BASE_PACKAGES = ["base", "linux", "linux-firmware", "python"]
+# Amount of packages pacman downloads at the same time (applies to pacstrap and the installed system)
+PARALLEL_DOWNLOADS = int(os.getenv("ARCHDEPLOY_PARALLEL_DOWNLOADS", 5))
+# Directory where downloaded packages are kept, so that later installs don't need to download them again
+PACKAGE_CACHE_DIR = pathlib.Path(os.getenv("ARCHDEPLOY_PACKAGE_CACHE", CACHE_DIR / "pkg")).expanduser()
+# If set, install without network from the packages in this directory or partition (see `--offline`)
+OFFLINE_SOURCE = pathlib.Path(os.environ["ARCHDEPLOY_OFFLINE"]) if os.getenv("ARCHDEPLOY_OFFLINE") else None
+# Skip verifying the offline packages, only for when the keyring of the live system is too old for them
+OFFLINE_SKIP_SIGNATURES = os.getenv("ARCHDEPLOY_OFFLINE_SKIP_SIGNATURES", "").strip().lower() in (
+    "1", "true", "yes", "on"
+)
+# Write raw disk images with O_DIRECT, bypassing the page cache (faster on some devices, slower on others)
+DIRECT_IO = os.getenv("ARCHDEPLOY_DIRECT_IO", "").strip().lower() in ("1", "true", "yes", "on")
+# Directory with prebuilt system images (`pre-chroot.py build`), deployed instead of running pacstrap
+IMAGE_DIR = pathlib.Path(os.getenv("ARCHDEPLOY_IMAGE_DIR", CACHE_DIR / "images")).expanduser()
+
 # Define specific colors for certain actions
 SUCCESS_COLOR = ANSIColor.RESET + ANSIColor.GREEN
 ERROR_COLOR = ANSIColor.RESET + ANSIColor.RED + ANSIColor.BOLD
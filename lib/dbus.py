@@ -0,0 +1,366 @@
+"""
+Minimal D-Bus client, enough to call methods of system services and to receive their signals.
+
+The wire protocol is spoken directly over the bus socket (EXTERNAL authentication, little endian
+messages), so that no D-Bus bindings have to be installed on the live system.
+"""
+import itertools
+import os
+import select
+import socket
+import struct
+import time
+import urllib.parse
+from collections import deque
+from typing import Any, NamedTuple, Optional
+
+SYSTEM_BUS_ADDRESS = os.getenv("DBUS_SYSTEM_BUS_ADDRESS", "unix:path=/run/dbus/system_bus_socket")
+
+BUS_NAME = "org.freedesktop.DBus"
+BUS_PATH = "/org/freedesktop/DBus"
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+OBJECT_MANAGER_INTERFACE = "org.freedesktop.DBus.ObjectManager"
+
+# Message types
+METHOD_CALL = 1
+METHOD_RETURN = 2
+ERROR = 3
+SIGNAL = 4
+
+NO_REPLY_EXPECTED = 0x1
+
+# Header fields
+FIELD_PATH = 1
+FIELD_INTERFACE = 2
+FIELD_MEMBER = 3
+FIELD_ERROR_NAME = 4
+FIELD_REPLY_SERIAL = 5
+FIELD_DESTINATION = 6
+FIELD_SENDER = 7
+FIELD_SIGNATURE = 8
+
+FIELD_TYPES = {
+    FIELD_PATH: "o", FIELD_INTERFACE: "s", FIELD_MEMBER: "s", FIELD_ERROR_NAME: "s",
+    FIELD_REPLY_SERIAL: "u", FIELD_DESTINATION: "s", FIELD_SENDER: "s", FIELD_SIGNATURE: "g",
+}
+
+ALIGNMENT = {
+    "y": 1, "b": 4, "n": 2, "q": 2, "i": 4, "u": 4, "x": 8, "t": 8, "d": 8, "h": 4,
+    "s": 4, "o": 4, "g": 1, "a": 4, "(": 8, "{": 8, "v": 1,
+}
+# Struct formats of the fixed size types
+FIXED_TYPES = {"y": "B", "b": "I", "n": "h", "q": "H", "i": "i", "u": "I", "x": "q", "t": "Q", "d": "d", "h": "I"}
+
+# Fixed part of the header, up to (and including) the length of the header fields array
+HEADER_START = struct.Struct("<BBBBIII")
+
+
+class DBusError(Exception):
+    """Error reply to a method call (or a broken connection)."""
+
+
+class Variant(NamedTuple):
+    """Value with an explicit signature, for passing variants in method calls."""
+    signature: str
+    value: Any
+
+
+def _type_end(signature: str, index: int) -> int:
+    """Get the index after the complete type starting at given index of the signature."""
+    code = signature[index]
+    if code == "a":
+        return _type_end(signature, index + 1)
+    if code in "({":
+        close = ")" if code == "(" else "}"
+        index += 1
+        while signature[index] != close:
+            index = _type_end(signature, index)
+    return index + 1
+
+
+def split_signature(signature: str) -> list[str]:
+    """Split given signature into its complete types, e.g. `sa{sv}as` into `s`, `a{sv}` and `as`."""
+    types = []
+    index = 0
+    while index < len(signature):
+        end = _type_end(signature, index)
+        types.append(signature[index:end])
+        index = end
+    return types
+
+
+class _Writer:
+    def __init__(self):
+        self.data = bytearray()
+
+    def align(self, alignment: int) -> None:
+        self.data += bytes(-len(self.data) % alignment)
+
+    def write(self, signature: str, value: Any) -> None:
+        code = signature[0]
+        self.align(ALIGNMENT[code])
+        if code in FIXED_TYPES:
+            self.data += struct.pack("<" + FIXED_TYPES[code], value)
+        elif code in "so":
+            encoded = value.encode()
+            self.data += struct.pack("<I", len(encoded)) + encoded + b"\0"
+        elif code == "g":
+            encoded = value.encode()
+            self.data += bytes([len(encoded)]) + encoded + b"\0"
+        elif code == "v":
+            self.write("g", value.signature)
+            self.write(value.signature, value.value)
+        elif code == "a":
+            element = signature[1:]
+            length_offset = len(self.data)
+            self.data += bytes(4)
+            # Padding after the length isn't part of the array length
+            self.align(ALIGNMENT[element[0]])
+            start = len(self.data)
+            for item in (value.items() if element[0] == "{" else value):
+                self.write(element, item)
+            struct.pack_into("<I", self.data, length_offset, len(self.data) - start)
+        elif code in "({":
+            for item_signature, item in zip(split_signature(signature[1:-1]), value):
+                self.write(item_signature, item)
+        else:
+            raise ValueError(f"Unsupported D-Bus type {code!r}")
+
+
+class _Reader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.offset = 0
+
+    def align(self, alignment: int) -> None:
+        self.offset += -self.offset % alignment
+
+    def read(self, signature: str) -> Any:
+        """Read a value of the type at the start of given signature, variants are read as their plain value."""
+        code = signature[0]
+        self.align(ALIGNMENT[code])
+        if code in FIXED_TYPES:
+            fmt = "<" + FIXED_TYPES[code]
+            (value,) = struct.unpack_from(fmt, self.data, self.offset)
+            self.offset += struct.calcsize(fmt)
+            return bool(value) if code == "b" else value
+        if code in "sog":
+            if code == "g":
+                length = self.data[self.offset]
+                self.offset += 1
+            else:
+                length = self.read("u")
+            value = self.data[self.offset:self.offset + length].decode(errors="replace")
+            self.offset += length + 1
+            return value
+        if code == "v":
+            return self.read(self.read("g"))
+        if code == "a":
+            length = self.read("u")
+            element = signature[1:]
+            self.align(ALIGNMENT[element[0]])
+            end = self.offset + length
+            items = []
+            while self.offset < end:
+                items.append(self.read(element))
+            return dict(items) if element[0] == "{" else items
+        if code in "({":
+            return tuple(self.read(item_signature) for item_signature in split_signature(signature[1:-1]))
+        raise ValueError(f"Unsupported D-Bus type {code!r}")
+
+
+class Message(NamedTuple):
+    type: int
+    serial: int
+    fields: dict[int, Any]
+    body: tuple
+
+    @property
+    def path(self) -> Optional[str]:
+        return self.fields.get(FIELD_PATH)
+
+    @property
+    def interface(self) -> Optional[str]:
+        return self.fields.get(FIELD_INTERFACE)
+
+    @property
+    def member(self) -> Optional[str]:
+        return self.fields.get(FIELD_MEMBER)
+
+    @property
+    def sender(self) -> Optional[str]:
+        return self.fields.get(FIELD_SENDER)
+
+    @property
+    def reply_serial(self) -> Optional[int]:
+        return self.fields.get(FIELD_REPLY_SERIAL)
+
+
+def encode_message(
+    message_type: int, serial: int, fields: dict[int, Any], signature: str = "", args: tuple = (), flags: int = 0
+) -> bytes:
+    body = _Writer()
+    for arg_signature, arg in zip(split_signature(signature), args):
+        body.write(arg_signature, arg)
+    if signature:
+        fields = {**fields, FIELD_SIGNATURE: signature}
+
+    header = _Writer()
+    header.data += struct.pack("<BBBBII", ord("l"), message_type, flags, 1, len(body.data), serial)
+    header.write("a(yv)", [(code, Variant(FIELD_TYPES[code], value)) for code, value in fields.items()])
+    header.align(8)
+    return bytes(header.data + body.data)
+
+
+def decode_message(data: bytes) -> Message:
+    if data[0:1] != b"l":
+        raise DBusError("Big endian D-Bus messages aren't supported")
+    reader = _Reader(data)
+    _, message_type, _, _, _, serial = (reader.read(code) for code in "yyyyuu")
+    fields = dict(reader.read("a(yv)"))
+    reader.align(8)
+    body = tuple(reader.read(arg_signature) for arg_signature in split_signature(fields.get(FIELD_SIGNATURE, "")))
+    return Message(message_type, serial, fields, body)
+
+
+def _message_size(data: bytes) -> Optional[int]:
+    """Get the size of the message at the start of given data, `None` if even its header isn't complete."""
+    if len(data) < HEADER_START.size:
+        return None
+    _, _, _, _, body_length, _, fields_length = HEADER_START.unpack_from(data)
+    header_length = HEADER_START.size + fields_length
+    return header_length + (-header_length % 8) + body_length
+
+
+def _parse_address(address: str) -> list[str]:
+    """Get the socket addresses of given bus address (`unix:path=...` or `unix:abstract=...`, `;` separated)."""
+    sockets = []
+    for entry in address.split(";"):
+        transport, _, options = entry.partition(":")
+        if transport != "unix":
+            continue
+        for option in options.split(","):
+            key, _, value = option.partition("=")
+            if key == "path":
+                sockets.append(urllib.parse.unquote(value))
+            elif key == "abstract":
+                sockets.append("\0" + urllib.parse.unquote(value))
+    return sockets
+
+
+class Connection:
+    """Connection to a message bus (the system bus by default)."""
+
+    def __init__(self, address: str = SYSTEM_BUS_ADDRESS, timeout: float = 5):
+        self.timeout = timeout
+        self.sock = self._connect(address)
+        self._serial = itertools.count(1)
+        self._buffer = bytearray()
+        # Messages received while waiting for a method reply, returned by `receive` later
+        self._queue: deque[Message] = deque()
+        try:
+            self._authenticate()
+            (self.unique_name,) = self.call(BUS_NAME, BUS_PATH, BUS_NAME, "Hello")
+        except (OSError, DBusError):
+            self.close()
+            raise
+
+    def _connect(self, address: str) -> socket.socket:
+        error: OSError = FileNotFoundError(f"No usable socket in D-Bus address {address!r}")
+        for sock_address in _parse_address(address):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(sock_address)
+                return sock
+            except OSError as exc:
+                sock.close()
+                error = exc
+        raise error
+
+    def _authenticate(self) -> None:
+        uid = str(os.getuid()).encode().hex()
+        self.sock.sendall(b"\0AUTH EXTERNAL " + uid.encode() + b"\r\n")
+        response = b""
+        while not response.endswith(b"\r\n"):
+            chunk = self.sock.recv(256)
+            if not chunk:
+                raise DBusError("Connection closed during authentication")
+            response += chunk
+        if not response.startswith(b"OK "):
+            raise DBusError(f"Authentication rejected: {response.decode(errors='replace').strip()}")
+        self.sock.sendall(b"BEGIN\r\n")
+
+    def __enter__(self) -> "Connection":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def send(self, message_type: int, fields: dict[int, Any], signature: str = "", args: tuple = (),
+             flags: int = 0) -> int:
+        """Send a message, return its serial."""
+        serial = next(self._serial)
+        self.sock.sendall(encode_message(message_type, serial, fields, signature, args, flags))
+        return serial
+
+    def _read_message(self, timeout: float) -> Optional[Message]:
+        deadline = time.monotonic() + timeout
+        while True:
+            size = _message_size(self._buffer)
+            if size is not None and len(self._buffer) >= size:
+                message = decode_message(bytes(self._buffer[:size]))
+                del self._buffer[:size]
+                return message
+
+            remaining = deadline - time.monotonic()
+            readable, _, _ = select.select([self.sock], [], [], max(remaining, 0))
+            if not readable:
+                return None
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise DBusError("Connection closed by the bus")
+            self._buffer += chunk
+
+    def receive(self, timeout: float) -> Optional[Message]:
+        """Get the next message which isn't a method reply, `None` if none arrives within `timeout` seconds."""
+        if self._queue:
+            return self._queue.popleft()
+        return self._read_message(timeout)
+
+    def call(
+        self, destination: str, path: str, interface: str, member: str, signature: str = "", args: tuple = ()
+    ) -> tuple:
+        """Call given method, return the body of the reply."""
+        serial = self.send(METHOD_CALL, {
+            FIELD_PATH: path, FIELD_INTERFACE: interface, FIELD_MEMBER: member, FIELD_DESTINATION: destination,
+        }, signature, args)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            message = self._read_message(deadline - time.monotonic())
+            if message is None:
+                raise DBusError(f"No reply to {interface}.{member} in {self.timeout}s")
+            if message.reply_serial != serial:
+                self._queue.append(message)
+                continue
+            if message.type == ERROR:
+                detail = f": {message.body[0]}" if message.body else ""
+                raise DBusError(f"{message.fields.get(FIELD_ERROR_NAME)}{detail}")
+            return message.body
+
+    def add_match(self, **rule: str) -> None:
+        """Subscribe to the messages matching given rule (e.g. `type="signal", sender=...`)."""
+        rule_str = ",".join(f"{key}='{value}'" for key, value in rule.items())
+        self.call(BUS_NAME, BUS_PATH, BUS_NAME, "AddMatch", "s", (rule_str,))
+
+    def get_property(self, destination: str, path: str, interface: str, name: str) -> Any:
+        (value,) = self.call(destination, path, PROPERTIES_INTERFACE, "Get", "ss", (interface, name))
+        return value
+
+    def get_managed_objects(self, destination: str, path: str = "/") -> dict[str, dict[str, dict[str, Any]]]:
+        """Get all objects of given service, with the properties of their interfaces."""
+        (objects,) = self.call(destination, path, OBJECT_MANAGER_INTERFACE, "GetManagedObjects")
+        return objects
@@ -1,43 +1,132 @@
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import NamedTuple, Optional, Union
 
-from lib import constants, commands, questions
+from lib import answers, constants, commands, filesystems, installplan, inventory, partitioning, questions
 
 
 class Partition:
-    def __init__(self, path: Path, mountpoint: Optional[Path] = None, is_swap: bool = False, is_efi: bool = False):
+    def __init__(
+        self,
+        path: Path,
+        mountpoint: Optional[Path] = None,
+        is_swap: bool = False,
+        is_efi: bool = False,
+        filesystem: Optional[str] = None,
+        formatted: bool = False,
+    ):
         self.path = path
         self.mountpoint = mountpoint
         self.is_swap = is_swap
         self.is_efi = is_efi
+        # Partitions which already have their filesystem (e.g. from a cloned disk image) aren't formatted again
+        self.formatted = formatted
+        # Profile of the device the partition is on, read from sysfs when first needed
+        self._profile: Optional[filesystems.DeviceProfile] = None
+
+        if filesystem is None:
+            filesystem = "swap" if is_swap else "vfat" if is_efi else "ext4"
+        self.filesystem = filesystems.get_filesystem(filesystem)
 
         if self.mountpoint is not None and self.is_swap:
             raise ValueError("Swap partitions can't have a hard-coded mountpoint")
-        if self.mountpoint == "/" and self.is_efi:
+        if self.mountpoint == Path("/") and self.is_efi:
             raise ValueError("EFI partition can't have a mountpoint of '/' (root)")
 
     def as_tuple(self) -> tuple:
         """Get the partition in a form of a tuple."""
-        if self.mountpoint == "/":
-            return (self.path, "ROOT (/)")
+        if self.mountpoint == Path("/"):
+            return (self.path, f"ROOT (/) [{self.filesystem.name}]")
         elif self.is_efi:
             return (self.path, f"EFI ({self.mountpoint})")
         elif self.is_swap:
             return (self.path, "SWAP (-)")
         else:
-            return (self.path, self.mountpoint)
+            return (self.path, f"{self.mountpoint} [{self.filesystem.name}]")
+
+    @property
+    def profile(self) -> filesystems.DeviceProfile:
+        if self._profile is None:
+            device = self.path
+            if installplan.is_active() and not device.exists():
+                # Partitions of an install plan aren't created yet, their disk is what matters anyway
+                disk = inventory.get().get_parent_disk(device)
+                if disk is not None:
+                    device = disk.path
+            self._profile = filesystems.read_profile(device)
+        return self._profile
+
+    @property
+    def mount_options(self) -> list[str]:
+        return self.filesystem.mount_options(self.profile)
 
-    def format(self):
+    def format(self, capture_out: bool = False) -> list[subprocess.CompletedProcess]:
         """Perform all necessary actions for formatting given partition."""
-        if self.is_swap:
-            commands.run_root_cmd(f"mkswap {self.path}")
-            commands.run_root_cmd(f"swapon {self.path}")
-            return
-        if self.is_efi:
-            commands.run_root_cmd(f"mkfs.fat -F32 {self.path}")
-            return
-        commands.run_root_cmd(f"mkfs.ext4 {self.path}")
-        return
+        procs = [commands.run_root_cmd(self.filesystem.mkfs_argv(self.path, self.profile), capture_out)]
+        if procs[-1].returncode != 0:
+            return procs
+        procs += self.filesystem.post_format(self.path, self.mountpoint, capture_out)
+        return procs
+
+    def get_device(self) -> Path:
+        """Get the path to the physical disk device holding this partition."""
+        name = self.path.resolve().name
+        sys_path = Path("/sys/class/block", name)
+
+        # Partitions are represented as subdirectories of their disk in sysfs
+        if sys_path.joinpath("partition").is_file():
+            return Path("/dev", sys_path.resolve().parent.name)
+
+        # Device mapper/md devices (LVM, LUKS, RAID) are backed by slave devices,
+        # follow those back to the physical disk
+        slaves_path = sys_path.joinpath("slaves")
+        if slaves_path.is_dir():
+            slaves = sorted(slaves_path.iterdir())
+            if len(slaves) != 0:
+                return Partition(Path("/dev", slaves[0].name)).get_device()
+
+        return Path("/dev", name)
+
+    def to_dict(self) -> dict:
+        """Get a JSON serializable representation of the partition."""
+        return {
+            "path": str(self.path),
+            "mountpoint": None if self.mountpoint is None else str(self.mountpoint),
+            "is_swap": self.is_swap,
+            "is_efi": self.is_efi,
+            "filesystem": self.filesystem.name,
+            "formatted": self.formatted,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Partition":
+        mountpoint = None if data["mountpoint"] is None else Path(data["mountpoint"])
+        return cls(
+            Path(data["path"]),
+            mountpoint=mountpoint,
+            is_swap=data["is_swap"],
+            is_efi=data["is_efi"],
+            filesystem=data.get("filesystem"),
+            formatted=data.get("formatted", False),
+        )
+
+    def get_filesystem_info(self) -> dict[str, str]:
+        """Get the identity of the filesystem on this partition (UUID, TYPE, ...) as reported by blkid."""
+        proc = commands.run_root_cmd(
+            f"blkid -o export {self.path}", capture_out=True, enable_debug=False, read_only=True
+        )
+        if proc.returncode != 0 or proc.stdout is None:
+            return {}
+        info = {}
+        for line in proc.stdout.decode().splitlines():
+            key, sep, value = line.partition("=")
+            if sep:
+                info[key] = value
+        return info
 
     def __str__(self) -> str:
         part_tuple = self.as_tuple()
@@ -54,38 +143,53 @@ class Partition:
             print(" " * indent + line)
 
 
-def get_partition_scheme() -> list[Partition]:
+def get_partition_scheme(partitions: Optional[list[Partition]] = None) -> list[Partition]:
     """
     Obtain all mountpoints with partitions.
-    Output will be stored in a dictionary
+
+    If `partitions` were already made by the automated partitioner, they're used directly.
     """
-    if questions.confirm("Do you wish to drop to shell before configuring partition scheme?"):
+    if partitions is not None:
+        print(f"{constants.INFO_COLOR}Using partition scheme from the automated partitioner:")
+        Partition.print_partition_table(partitions, indent=4)
+        return partitions
+
+    if questions.confirm(
+        "Do you wish to drop to shell before configuring partition scheme?", key="partitions.drop_to_shell"
+    ):
         commands.drop_to_shell()
 
     part_scheme = []
-    root_partition = questions.path(
-        f"Enter {constants.CMD_COLOR}/{constants.RESET_COLOR} partition path (usually /dev/sdXY)",
+    partitions = inventory.get().get_partitions()
+    root_partition = questions.device(
+        f"Pick the {constants.CMD_COLOR}/{constants.RESET_COLOR} partition", partitions, key="partitions.root"
     )
-    part_scheme.append(Partition(root_partition, mountpoint=Path("/")))
+    root_filesystem = _ask_filesystem("/", key="partitions.root_filesystem")
+    part_scheme.append(Partition(root_partition, mountpoint=Path("/"), filesystem=root_filesystem))
 
     if constants.IS_EFI:
-        efi_partition = questions.path("Enter the partition path for the EFI partition (usually /dev/sdXY)")
+        efi_partition = questions.device("Pick the EFI partition", partitions, key="partitions.efi")
         efi_mountpoint = questions.choice(
             "Which mountpoint do you want to use for the EFI partition?",
-            choices=[Path("/boot"), Path("/efi"), "Other"]
+            choices=[Path("/boot"), Path("/efi"), "Other"],
+            key="partitions.efi_mountpoint",
         )
         if efi_mountpoint == "Other":
-            efi_mountpoint = questions.path("Enter the EFI mountpoint path: ", exists=False)
-        part_scheme.append(Partition(efi_partition, mountpoint=efi_mountpoint))
+            efi_mountpoint = questions.path(
+                "Enter the EFI mountpoint path: ", exists=False, key="partitions.efi_mountpoint_path"
+            )
+        part_scheme.append(Partition(efi_partition, mountpoint=efi_mountpoint, is_efi=True))
 
-    if questions.confirm("Do you want swap partition?"):
-        swap_partition = questions.path("Enter swap partition path (usually /dev/sdXY): ")
+    if questions.confirm("Do you want swap partition?", key="partitions.swap"):
+        swap_partition = questions.device("Pick the swap partition", partitions, key="partitions.swap_path")
         part_scheme.append(Partition(swap_partition, is_swap=True))
 
     while True:
-        if questions.confirm("Do you want to define some other mountpoint?"):
-            partition = questions.path("Enter the partition path (usually /dev/sdXY): ")
-            mountpoint = questions.path("Enter the mountpoint (on new machine): ", exists=False)
+        if questions.confirm("Do you want to define some other mountpoint?", key="partitions.extra"):
+            partition = questions.device("Pick the partition", partitions, key="partitions.extra_path")
+            mountpoint = questions.path(
+                "Enter the mountpoint (on new machine): ", exists=False, key="partitions.extra_mountpoint"
+            )
 
             for existing_partition in part_scheme:
                 if existing_partition.path == partition:
@@ -96,33 +200,223 @@ def get_partition_scheme() -> list[Partition]:
                     existing_partition.mountpoint = mountpoint
                     break
             else:
-                part_scheme.append(Partition(partition, mountpoint=mountpoint))
+                filesystem = _ask_filesystem(mountpoint, key="partitions.extra_filesystem")
+                part_scheme.append(Partition(partition, mountpoint=mountpoint, filesystem=filesystem))
         else:
             break
 
     print(f"{constants.INFO_COLOR}Your current partition table scheme:")
     Partition.print_partition_table(part_scheme, indent=4)
 
-    if questions.confirm("Does this look correct?"):
+    if questions.confirm("Does this look correct?", key="partitions.confirm"):
         return part_scheme
+    elif questions.is_unattended():
+        # Asking again would only get the same answers
+        raise questions.MissingAnswerError("partitions.confirm", "Partition scheme from the answer file was rejected")
     else:
         print(f"{constants.INFO_COLOR}Re-running mountpoint obtainer")
         return get_partition_scheme()
 
 
-def partition_disk():
-    """Make the necessary partitions """
-    # TODO: Automate partitioning
+def _ask_filesystem(mountpoint: Union[Path, str], key: str) -> str:
+    return questions.choice(
+        f"Which filesystem do you want to use for {constants.CMD_COLOR}{mountpoint}{constants.RESET_COLOR}?",
+        choices=filesystems.LINUX_FILESYSTEMS,
+        key=key,
+    )
+
+
+def _get_layout(device: Path) -> list[partitioning.PartitionSpec]:
+    """Get the partition layout for given device, from the answer file or by asking the user."""
+    layout = answers.get("partitions.layout")
+    if layout is not None:
+        return [partitioning.PartitionSpec.from_dict(spec) for spec in layout]
+
+    swap_size = None
+    if questions.confirm("Do you want a swap partition?", key="partitions.auto_swap"):
+        swap_size = partitioning.parse_size(
+            questions.text("Enter the swap size", default="4G", key="partitions.auto_swap_size")
+        )
+    root_filesystem = _ask_filesystem("/", key="partitions.auto_filesystem")
+    return partitioning.default_layout(swap_size, root_filesystem)
+
+
+def _partition_automatically() -> Optional[list[Partition]]:
+    disks = [disk for disk in inventory.get().disks.values() if not disk.read_only]
+    device = questions.device("Pick the disk to partition", disks, key="partitions.device")
+    geometry = partitioning.read_geometry(device)
+    try:
+        layout = partitioning.compute_layout(geometry, _get_layout(device))
+    except ValueError as exc:
+        print(f"{constants.ERROR_COLOR}{exc}")
+        if questions.is_unattended():
+            raise
+        return partition_disk()
+
+    print(
+        f"{constants.INFO_COLOR}Planned partitions on {device} "
+        f"(aligned to {geometry.alignment // 1024}KiB):"
+    )
+    for planned in layout:
+        size_mib = planned.size * geometry.logical_block_size // partitioning.MIB
+        print(f"    {planned.number}. {planned.spec.name or ''} {size_mib}MiB -> {planned.spec.mountpoint or '-'}")
+
+    if not questions.confirm(
+        f"{constants.WARN_COLOR}This will ERASE ALL DATA on {device}, continue?", key="partitions.confirm_wipe"
+    ):
+        if questions.is_unattended():
+            raise questions.MissingAnswerError("partitions.confirm_wipe", "Wiping the disk was refused")
+        return partition_disk()
+
+    try:
+        partitioned_device = partitioning.apply_layout(device, layout)
+    except OSError as exc:
+        print(f"{constants.ERROR_COLOR}{exc}")
+        if questions.is_unattended():
+            raise
+        return partition_disk()
+
+    return _make_partitions(partitioned_device, layout)
+
+
+def _make_partitions(device: Path, layout: list[partitioning.PlannedPartition]) -> list[Partition]:
+    return [
+        Partition(
+            partitioning.partition_path(device, planned.number),
+            mountpoint=planned.spec.mountpoint,
+            is_swap=planned.spec.is_swap,
+            is_efi=planned.spec.is_efi,
+            filesystem=planned.spec.filesystem,
+        )
+        for planned in layout
+        # BIOS boot partition is only used by GRUB directly, it doesn't have a filesystem
+        if not planned.spec.is_bios_boot
+    ]
+
+
+def partition_target(device: Path) -> list[Partition]:
+    """
+    Partition a target device without asking anything (for multi-target installs).
+
+    The layout comes from the answer file, or the default layout (without swap) is used.
+    """
+    layout_answer = answers.get("partitions.layout")
+    if layout_answer is not None:
+        specs = [partitioning.PartitionSpec.from_dict(spec) for spec in layout_answer]
+    else:
+        specs = partitioning.default_layout(root_filesystem=answers.get("partitions.auto_filesystem"))
+    layout = partitioning.compute_layout(partitioning.read_geometry(device), specs)
+    return _make_partitions(partitioning.apply_layout(device, layout), layout)
+
+
+def _image_partitions(device: Path) -> list[Partition]:
+    """
+    Get the partitions of a cloned disk image, with mountpoints from their GPT partition types.
+
+    The only generic Linux partition (or the first one) is used as root, if there's no partition with
+    the discoverable root type.
+    """
+    table = partitioning.read_partition_table(device)
+    types = [entry["type"].upper() for entry in table]
+    has_root = partitioning.TYPE_ROOT_X86_64 in types
+    partitions = []
+    for entry, part_type in zip(table, types):
+        path = Path(entry["node"])
+        fstype = partitioning.blkid_type(path)
+        filesystem = filesystems.find_by_fstype(fstype) if fstype is not None else None
+
+        if part_type == partitioning.TYPE_EFI:
+            mountpoint: Optional[Path] = Path("/boot")
+        elif part_type in partitioning.DISCOVERABLE_MOUNTPOINTS:
+            mountpoint = partitioning.DISCOVERABLE_MOUNTPOINTS[part_type]
+        elif part_type == partitioning.TYPE_LINUX and not has_root:
+            mountpoint = Path("/")
+            has_root = True
+        elif part_type != partitioning.TYPE_SWAP:
+            if part_type != partitioning.TYPE_BIOS_BOOT:
+                print(f"{constants.WARN_COLOR}Don't know where to mount {path} (type {part_type}), skipping it")
+            continue
+        else:
+            mountpoint = None
+
+        if filesystem is None:
+            print(f"{constants.WARN_COLOR}{path} has no known filesystem ({fstype}), skipping it")
+            continue
+        partitions.append(Partition(
+            path,
+            mountpoint=mountpoint,
+            is_swap=part_type == partitioning.TYPE_SWAP,
+            is_efi=part_type == partitioning.TYPE_EFI,
+            filesystem=filesystem.name,
+            formatted=True,
+        ))
+    return partitions
+
+
+def _clone_image() -> Optional[list[Partition]]:
+    image = questions.path("Enter the path to the raw disk image", key="partitions.image")
+    disks = [disk for disk in inventory.get().disks.values() if not disk.read_only]
+    device = questions.device("Pick the disk to write the image to", disks, key="partitions.device")
+    if not questions.confirm(
+        f"{constants.WARN_COLOR}This will ERASE ALL DATA on {device}, continue?", key="partitions.confirm_wipe"
+    ):
+        if questions.is_unattended():
+            raise questions.MissingAnswerError("partitions.confirm_wipe", "Wiping the disk was refused")
+        return partition_disk()
+
+    print(f"{constants.NOTE_COLOR}Writing {image} to {device}...")
+    try:
+        partitioned_device = partitioning.write_raw_image(image, device)
+        return _image_partitions(partitioned_device)
+    except OSError as exc:
+        print(f"{constants.ERROR_COLOR}{exc}")
+        if questions.is_unattended():
+            raise
+        return partition_disk()
+
+
+def partition_disk() -> Optional[list[Partition]]:
+    """
+    Make the necessary partitions.
+
+    Return the made partitions when partitioned automatically (or cloned from a disk image),
+    `None` if the user partitioned the disks manually.
+    """
+    choice = questions.choice(
+        "How do you wish to partition the disks?",
+        choices=[
+            "Automatically (erases the whole disk)",
+            "Clone a raw disk image (erases the whole disk)",
+            "Manually (drop to shell)",
+        ],
+        key="partitions.method",
+    )
+    if choice == "Automatically (erases the whole disk)":
+        return _partition_automatically()
+    if choice == "Clone a raw disk image (erases the whole disk)":
+        return _clone_image()
+
     print(f"{constants.INFO_COLOR}Please partition the disks manually")
     commands.drop_to_shell()
+    return None
 
 
 def format_partitions(partitions: list[Partition]) -> None:
     """Properly format given partitions accordingly to their mountpoint."""
+    formatted = [partition for partition in partitions if partition.formatted]
+    if len(formatted) != 0:
+        print(
+            f"{constants.NOTE_COLOR}Keeping existing filesystems on "
+            + ", ".join(str(partition.path) for partition in formatted)
+        )
+        partitions = [partition for partition in partitions if not partition.formatted]
+        if len(partitions) == 0:
+            return
+
     print(
         f"{constants.INFO_COLOR}Running automated partition formatter. "
-        "This will apply EXT4 formatting to each partition apart from SWAP "
-        "and EFI (which will be FAT32)."
+        "This will create the chosen filesystem on each partition (SWAP "
+        "and EFI partitions will get swap and FAT32), tuned for the device it's on."
     )
     print(f"{constants.WARN_COLOR}If you want to use a different formatting "
           "or if your partitions are already pre-formatted, do not proceed with the "
@@ -130,18 +424,239 @@ def format_partitions(partitions: list[Partition]) -> None:
           )
 
     if questions.confirm(
-        "Do you wish to drop to shell and format your partitions manually? (will skip automated formatter)"
+        "Do you wish to drop to shell and format your partitions manually? (will skip automated formatter)",
+        key="partitions.format_manually",
     ):
         commands.drop_to_shell()
         if questions.confirm(
-            "Did you create a filesystem on all of the partitions and created and activated swap (if you have swap)?"
+            "Did you create a filesystem on all of the partitions and created swap (if you have swap)?",
+            key="partitions.formatted_manually",
         ):
             return
         return format_partitions(partitions)
 
+    results = _run_format_jobs(partitions)
+    failed = [result.partition for result in results if result.returncode != 0]
+    while len(failed) != 0:
+        print(
+            f"{constants.ERROR_COLOR}Formatting failed for: "
+            + ", ".join(str(partition.path) for partition in failed)
+        )
+        choice = questions.choice(
+            "How do you wish to continue?",
+            choices=["Retry formatting failed partitions", "Drop to shell and fix this manually", "Continue anyway"],
+            key="partitions.format_failed",
+        )
+        if choice == "Retry formatting failed partitions":
+            results = _run_format_jobs(failed)
+            failed = [result.partition for result in results if result.returncode != 0]
+        elif choice == "Drop to shell and fix this manually":
+            commands.drop_to_shell()
+            return
+        else:
+            return
+
+
+def format_target(partitions: list[Partition]) -> None:
+    """Format given partitions without asking anything, raise `OSError` if any of them fails."""
+    results = _run_format_jobs([partition for partition in partitions if not partition.formatted])
+    failed = [result.partition for result in results if result.returncode != 0]
+    if len(failed) != 0:
+        raise OSError("Formatting failed for: " + ", ".join(str(partition.path) for partition in failed))
+
+
+class FormatResult(NamedTuple):
+    partition: Partition
+    returncode: int
+    output: str
+    duration: float
+
+
+def _format_device_partitions(partitions: list[Partition]) -> list[FormatResult]:
+    """Format partitions which are all on the same disk, one after another."""
+    results = []
+    for partition in partitions:
+        start = time.perf_counter()
+        procs = partition.format(capture_out=True)
+        duration = time.perf_counter() - start
+
+        output = "".join(proc.stdout.decode(errors="replace") for proc in procs if proc.stdout is not None)
+        returncode = next((proc.returncode for proc in procs if proc.returncode != 0), 0)
+        results.append(FormatResult(partition, returncode, output, duration))
+    return results
+
+
+def _run_format_jobs(partitions: list[Partition]) -> list[FormatResult]:
+    """
+    Format given partitions, running partitions on different disks concurrently.
+
+    Partitions on the same disk are formatted in order, since running mkfs on them
+    at the same time would only make the disk seek between them. Output of each
+    job is captured and printed separately once all jobs finish, followed by
+    the timing summary.
+    """
+    by_device: dict[Path, list[Partition]] = {}
+    for partition in partitions:
+        by_device.setdefault(partition.get_device(), []).append(partition)
+
+    print(
+        f"{constants.NOTE_COLOR}Formatting {len(partitions)} partition(s) "
+        f"on {len(by_device)} device(s), this may take a while..."
+    )
+
+    # DEBUG confirmations prompt the user for each command, don't interleave those prompts,
+    # an install plan has to list the commands in the same order every time
+    max_workers = 1 if constants.DEBUG or installplan.is_active() else max(len(by_device), 1)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_format_device_partitions, parts) for parts in by_device.values()]
+        device_results = [future.result() for future in futures]
+    total_time = time.perf_counter() - start
+
+    results = [result for results in device_results for result in results]
+    results.sort(key=lambda result: partitions.index(result.partition))
+
+    for result in results:
+        status_color = constants.SUCCESS_COLOR if result.returncode == 0 else constants.ERROR_COLOR
+        print(f"{status_color}==> {result.partition} (exit code {result.returncode})")
+        sys.stdout.write(constants.RESET_COLOR + result.output)
+
+    print(f"{constants.INFO_COLOR}Formatting timing summary:")
+    for result in results:
+        print(f"    {result.partition.path}: {result.duration:.2f}s")
+    print(f"    Total: {total_time:.2f}s (sequential would take ~{sum(r.duration for r in results):.2f}s)")
+    return results
+
+
+class MountEntry(NamedTuple):
+    partition: Partition
+    # Path on the new machine, `None` for swap
+    target: Optional[Path]
+    options: list[str]
+
+    @property
+    def depth(self) -> int:
+        return -1 if self.target is None else len(self.target.parts)
+
+
+def plan_mounts(partitions: list[Partition]) -> list[MountEntry]:
+    """Get everything that needs to be mounted (including subvolumes) sorted by mountpoint depth."""
+    plan = []
     for partition in partitions:
-        partition.format()
+        options = partition.mount_options
+        if partition.is_swap:
+            plan.append(MountEntry(partition, None, options))
+            continue
+        subvolumes = partition.filesystem.subvolumes(partition.mountpoint)
+        if len(subvolumes) == 0:
+            plan.append(MountEntry(partition, partition.mountpoint, options))
+        for name, target in subvolumes:
+            plan.append(MountEntry(partition, target, [*options, f"subvol=/{name}"]))
+    plan.sort(key=lambda entry: entry.depth)
+    return plan
+
+
+def _get_mounts() -> dict[Path, str]:
+    """Get currently mounted filesystems (mountpoint -> source)."""
+    mounts = {}
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            source, target = line.split()[:2]
+            # Spaces and other special characters are octal escaped
+            mounts[Path(target.encode().decode("unicode_escape"))] = source
+    return mounts
+
+
+def _get_active_swaps() -> set[Path]:
+    with open("/proc/swaps") as f:
+        return {Path(line.split()[0]).resolve() for line in f.readlines()[1:]}
+
+
+def _mount_entry(mountpoint: Path, entry: MountEntry, mounts: dict[Path, str]) -> subprocess.CompletedProcess:
+    partition = entry.partition
+    if entry.target is None:
+        if partition.path.resolve() in _get_active_swaps():
+            return subprocess.CompletedProcess(["swapon", str(partition.path)], 0)
+        return commands.run_root_cmd(["swapon", "--options", ",".join(entry.options), str(partition.path)])
+
+    target = mountpoint / entry.target.relative_to("/")
+    if target in mounts:
+        # Already mounted by a previous (interrupted) run
+        if Path(mounts[target]).resolve() != partition.path.resolve():
+            print(f"{constants.WARN_COLOR}{target} is already mounted from {mounts[target]}, leaving it as is")
+        return subprocess.CompletedProcess(["mount", str(target)], 0)
+
+    return commands.run_root_cmd(
+        f"mkdir -p {shlex.quote(str(target))} && "
+        f"mount -o {shlex.quote(','.join(entry.options))} {shlex.quote(str(partition.path))} {shlex.quote(str(target))}"
+    )
+
+
+def mount_partitions(mountpoint: Path, partitions: list[Partition]) -> list[MountEntry]:
+    """
+    Mount given partitions under `mountpoint` and activate swap, return the mount plan.
+
+    Mountpoints are mounted level by level, so that each one is only mounted after
+    the mountpoint it's nested in. Entries on the same level are independent of each
+    other and are mounted concurrently.
+    """
+    plan = plan_mounts(partitions)
+    mounts = _get_mounts()
+
+    # Nesting level is the number of other mountpoints above the mountpoint
+    levels: dict[int, list[MountEntry]] = {}
+    for entry in plan:
+        level = sum(
+            1 for other in plan
+            if other.target is not None and entry.target is not None
+            and other.target != entry.target and entry.target.is_relative_to(other.target)
+        )
+        levels.setdefault(level, []).append(entry)
+
+    print(f"{constants.NOTE_COLOR}Mounting {len(plan)} filesystem(s) under {mountpoint}...")
+    sequential = constants.DEBUG or installplan.is_active()
+    max_workers = 1 if sequential else max(max(len(entries) for entries in levels.values()), 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for level in sorted(levels):
+            entries = levels[level]
+            procs = list(executor.map(lambda entry: _mount_entry(mountpoint, entry, mounts), entries))
+            for entry, proc in zip(entries, procs):
+                if proc.returncode != 0:
+                    raise OSError(f"Unable to mount {entry.partition.path} on {entry.target or 'swap'}")
+    return plan
+
+
+def make_fstab(plan: list[MountEntry]) -> str:
+    """Make the fstab for the new machine from the mount plan, identifying filesystems by their UUID."""
+    lines = ["# Static information about the filesystems.", "# See fstab(5) for details.", ""]
+    uuids: dict[Path, str] = {}
+    for entry in plan:
+        partition = entry.partition
+        if partition.path not in uuids:
+            # When planning, the filesystems don't exist yet (blkid would report the ones they replace)
+            uuids[partition.path] = "" if installplan.is_active() else partition.get_filesystem_info().get("UUID", "")
+        # Without a UUID (e.g. blkid failed) fall back to the device path, which may change between boots
+        source = f"UUID={uuids[partition.path]}" if uuids[partition.path] else str(partition.path)
+        target = "none" if entry.target is None else str(entry.target).replace(" ", "\\040")
+        if not partition.filesystem.fsck:
+            fsck_pass = 0
+        else:
+            fsck_pass = 1 if entry.target == Path("/") else 2
+
+        lines.append(f"# {partition.path}")
+        lines.append(
+            f"{source}\t{target}\t{partition.filesystem.fstype}\t{','.join(entry.options)}\t0 {fsck_pass}"
+        )
+        lines.append("")
+    return "\n".join(lines)
 
 
-def mount_partitions(mountpoint: Path, partitions: list[Partition]):
-    pass
+def write_fstab(mountpoint: Path, plan: list[MountEntry]) -> None:
+    fstab = mountpoint / "etc" / "fstab"
+    commands.write_root_file(fstab, make_fstab(plan))
+    if installplan.is_active():
+        # The planned fstab uses device paths, swap them for UUIDs once the plan created the filesystems
+        for path in dict.fromkeys(entry.partition.path for entry in plan):
+            commands.run_root_cmd(
+                f'sed -i "s|^{path}\\t|UUID=$(blkid -s UUID -o value {path})\\t|" {shlex.quote(str(fstab))}'
+            )
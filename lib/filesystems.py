@@ -0,0 +1,283 @@
+import abc
+import shlex
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional, Union
+
+from lib import commands, inventory
+
+# Block size used by ext4 (and for stride calculations)
+EXT4_BLOCK_SIZE = 4096
+# Parity disks for RAID levels, used to get the amount of data disks in a stripe
+RAID_PARITY_DISKS = {"raid4": 1, "raid5": 1, "raid6": 2}
+
+
+class DeviceProfile(NamedTuple):
+    """Performance relevant characteristics of the device a filesystem is created on."""
+    rotational: bool = True
+    discard_granularity: int = 0  # bytes, 0 means no discard support
+    raid_chunk_size: int = 0  # bytes, 0 means not a (striped) RAID
+    raid_data_disks: int = 0
+    optimal_io_size: int = 0
+
+    @property
+    def supports_discard(self) -> bool:
+        return self.discard_granularity != 0
+
+    @property
+    def is_striped(self) -> bool:
+        return self.raid_chunk_size != 0 and self.raid_data_disks > 1
+
+
+def _read_sysfs(path: Path, default: str = "") -> str:
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return default
+
+
+def read_profile(device: Path) -> DeviceProfile:
+    """Read the profile of given block device (or partition) from sysfs."""
+    sys_path = Path("/sys/class/block", device.resolve().name)
+    if not sys_path.exists():
+        return DeviceProfile()
+    # Partitions don't have their own queue, it's on the disk they're on
+    disk_path = sys_path.resolve().parent if sys_path.joinpath("partition").exists() else sys_path
+    queue = disk_path / "queue"
+
+    raid_chunk_size = raid_data_disks = 0
+    md_path = disk_path / "md"
+    if md_path.is_dir():
+        level = _read_sysfs(md_path / "level")
+        raid_disks = int(_read_sysfs(md_path / "raid_disks", "0") or 0)
+        raid_chunk_size = int(_read_sysfs(md_path / "chunk_size", "0") or 0)
+        if level == "raid10":
+            raid_data_disks = raid_disks // 2
+        elif level == "raid0":
+            raid_data_disks = raid_disks
+        else:
+            raid_data_disks = raid_disks - RAID_PARITY_DISKS.get(level, raid_disks)
+
+    return DeviceProfile(
+        rotational=_read_sysfs(queue / "rotational", inventory.DEFAULT_ROTATIONAL) == "1",
+        discard_granularity=int(_read_sysfs(queue / "discard_granularity", "0") or 0),
+        raid_chunk_size=raid_chunk_size,
+        raid_data_disks=raid_data_disks,
+        optimal_io_size=int(_read_sysfs(queue / "optimal_io_size", "0") or 0),
+    )
+
+
+class Filesystem(abc.ABC):
+    """Base for filesystem backends, picking mkfs and mount options for a device profile."""
+
+    name: str
+    # Type used in fstab
+    fstype: str
+    # Whether the filesystem should be checked on boot (fstab pass number), some have no real fsck
+    fsck: bool = True
+
+    @abc.abstractmethod
+    def mkfs_argv(self, device: Path, profile: DeviceProfile) -> list[str]:
+        """Get the mkfs command creating the filesystem on given device."""
+
+    def mount_options(self, profile: DeviceProfile) -> list[str]:
+        return ["noatime"]
+
+    def subvolumes(self, mountpoint: Optional[Path]) -> list[tuple[str, Path]]:
+        """Get subvolumes (name, mountpoint) to create, for filesystems which support them."""
+        return []
+
+    def post_format(
+        self, device: Path, mountpoint: Optional[Path], capture_out: bool = False
+    ) -> list[subprocess.CompletedProcess]:
+        """Perform any setup needed after mkfs (e.g. creating subvolumes)."""
+        return []
+
+    def grow(self, device: Path, capture_out: bool = False) -> list[subprocess.CompletedProcess]:
+        """Grow the filesystem to fill the whole (enlarged) partition."""
+        return []
+
+
+def _with_temporary_mount(
+    device: Path, make_cmd: Callable[[str], Union[str, list[str]]], capture_out: bool = False
+) -> list[subprocess.CompletedProcess]:
+    """Mount the device on a temporary directory, run a command made for that directory and unmount it again."""
+    # Named after the device rather than random, so that it's the same when an install plan is replayed
+    tmp_mount = str(Path(tempfile.gettempdir(), f"archdeploy-mnt-{device.name}"))
+    tmp_arg = shlex.quote(tmp_mount)
+    procs = [commands.run_root_cmd(f"mkdir -p {tmp_arg} && mount {shlex.quote(str(device))} {tmp_arg}", capture_out)]
+    if procs[0].returncode != 0:
+        return procs
+    procs.append(commands.run_root_cmd(make_cmd(tmp_mount), capture_out))
+    procs.append(commands.run_root_cmd(f"umount {tmp_arg} && rmdir {tmp_arg}", capture_out))
+    return procs
+
+
+FILESYSTEMS: dict[str, Filesystem] = {}
+
+
+def register(cls: type[Filesystem]) -> type[Filesystem]:
+    """Register a filesystem backend class."""
+    FILESYSTEMS[cls.name] = cls()
+    return cls
+
+
+def get_filesystem(name: str) -> Filesystem:
+    try:
+        return FILESYSTEMS[name]
+    except KeyError:
+        raise ValueError(f"Unknown filesystem: {name} (available: {', '.join(FILESYSTEMS)})")
+
+
+def find_by_fstype(fstype: str) -> Optional[Filesystem]:
+    """Find the backend for a filesystem type, as reported by blkid."""
+    return next((filesystem for filesystem in FILESYSTEMS.values() if filesystem.fstype == fstype), None)
+
+
+@register
+class Ext4(Filesystem):
+    name = "ext4"
+    fstype = "ext4"
+
+    def mkfs_argv(self, device: Path, profile: DeviceProfile) -> list[str]:
+        # Force is needed so that mkfs doesn't stop on an interactive prompt when it finds an existing filesystem
+        argv = ["mkfs.ext4", "-F"]
+        extended = []
+        if not profile.rotational:
+            # Don't zero out inode tables and the journal on SSDs, kernel does it lazily if needed
+            extended += ["lazy_itable_init=1", "lazy_journal_init=1"]
+        if profile.is_striped:
+            stride = max(profile.raid_chunk_size // EXT4_BLOCK_SIZE, 1)
+            extended += [f"stride={stride}", f"stripe_width={stride * profile.raid_data_disks}"]
+        if extended:
+            argv += ["-E", ",".join(extended)]
+        return [*argv, str(device)]
+
+    def mount_options(self, profile: DeviceProfile) -> list[str]:
+        # Longer commit interval batches more writes together, at the cost of losing up to a minute on crash
+        return ["noatime", "commit=60"]
+
+    def grow(self, device: Path, capture_out: bool = False) -> list[subprocess.CompletedProcess]:
+        # resize2fs refuses to resize a filesystem which wasn't checked since it was last mounted
+        procs = [commands.run_root_cmd(["e2fsck", "-f", "-p", str(device)], capture_out)]
+        if procs[0].returncode > 1:  # 1 means errors were corrected
+            return procs
+        return [*procs, commands.run_root_cmd(["resize2fs", str(device)], capture_out)]
+
+
+@register
+class XFS(Filesystem):
+    name = "xfs"
+    fstype = "xfs"
+    fsck = False
+
+    def mkfs_argv(self, device: Path, profile: DeviceProfile) -> list[str]:
+        argv = ["mkfs.xfs", "-f"]
+        if profile.is_striped:
+            argv += ["-d", f"su={profile.raid_chunk_size},sw={profile.raid_data_disks}"]
+        if not profile.supports_discard:
+            argv += ["-K"]
+        return [*argv, str(device)]
+
+    def grow(self, device: Path, capture_out: bool = False) -> list[subprocess.CompletedProcess]:
+        # XFS can only be grown while mounted
+        return _with_temporary_mount(device, lambda mountpoint: ["xfs_growfs", mountpoint], capture_out)
+
+
+@register
+class Btrfs(Filesystem):
+    name = "btrfs"
+    fstype = "btrfs"
+    fsck = False
+
+    # Subvolume layout used when btrfs is the root filesystem
+    ROOT_SUBVOLUMES = [
+        ("@", Path("/")),
+        ("@home", Path("/home")),
+        ("@log", Path("/var/log")),
+        ("@pkg", Path("/var/cache/pacman/pkg")),
+        ("@snapshots", Path("/.snapshots")),
+    ]
+
+    def mkfs_argv(self, device: Path, profile: DeviceProfile) -> list[str]:
+        return ["mkfs.btrfs", "-f", str(device)]
+
+    def mount_options(self, profile: DeviceProfile) -> list[str]:
+        options = ["noatime", "compress=zstd:1"]
+        if not profile.rotational:
+            options.append("ssd")
+            if profile.supports_discard:
+                options.append("discard=async")
+        return options
+
+    def subvolumes(self, mountpoint: Optional[Path]) -> list[tuple[str, Path]]:
+        if mountpoint == Path("/"):
+            return self.ROOT_SUBVOLUMES
+        return []
+
+    def post_format(
+        self, device: Path, mountpoint: Optional[Path], capture_out: bool = False
+    ) -> list[subprocess.CompletedProcess]:
+        subvolumes = self.subvolumes(mountpoint)
+        if len(subvolumes) == 0:
+            return []
+
+        return _with_temporary_mount(
+            device,
+            lambda mountpoint: " && ".join(
+                f"btrfs subvolume create {shlex.quote(f'{mountpoint}/{name}')}" for name, _ in subvolumes
+            ),
+            capture_out,
+        )
+
+    def grow(self, device: Path, capture_out: bool = False) -> list[subprocess.CompletedProcess]:
+        return _with_temporary_mount(
+            device, lambda mountpoint: ["btrfs", "filesystem", "resize", "max", mountpoint], capture_out
+        )
+
+
+@register
+class F2FS(Filesystem):
+    name = "f2fs"
+    fstype = "f2fs"
+
+    def mkfs_argv(self, device: Path, profile: DeviceProfile) -> list[str]:
+        return ["mkfs.f2fs", "-f", "-O", "extra_attr,inode_checksum,sb_checksum,compression", str(device)]
+
+    def mount_options(self, profile: DeviceProfile) -> list[str]:
+        # The compression feature alone only compresses files marked with `chattr +c`, the extension makes it all files
+        return ["noatime", "compress_algorithm=zstd:3", "compress_chksum", "compress_extension=*"]
+
+    def grow(self, device: Path, capture_out: bool = False) -> list[subprocess.CompletedProcess]:
+        return [commands.run_root_cmd(["resize.f2fs", str(device)], capture_out)]
+
+
+@register
+class VFAT(Filesystem):
+    name = "vfat"
+    fstype = "vfat"
+
+    def mkfs_argv(self, device: Path, profile: DeviceProfile) -> list[str]:
+        return ["mkfs.fat", "-F32", str(device)]
+
+    def mount_options(self, profile: DeviceProfile) -> list[str]:
+        # The EFI partition holds the kernel and initramfs, nobody but root should be able to read it
+        return ["noatime", "fmask=0077", "dmask=0077"]
+
+
+@register
+class Swap(Filesystem):
+    name = "swap"
+    fstype = "swap"
+    fsck = False
+
+    def mkfs_argv(self, device: Path, profile: DeviceProfile) -> list[str]:
+        return ["mkswap", str(device)]
+
+    def mount_options(self, profile: DeviceProfile) -> list[str]:
+        return ["discard"] if profile.supports_discard else ["defaults"]
+
+
+# Filesystems which can be picked for regular (non-EFI, non-swap) partitions
+LINUX_FILESYSTEMS = ["ext4", "btrfs", "xfs", "f2fs"]
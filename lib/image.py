@@ -0,0 +1,113 @@
+import hashlib
+import json
+import shlex
+import time
+from pathlib import Path
+from typing import Optional
+
+from lib import commands, constants, pacman
+
+IMAGE_SUFFIX = ".tar.zst"
+# Pointer to the most recently built image in the image directory
+LATEST_LINK = "latest" + IMAGE_SUFFIX
+
+# Per-machine state which must not be shared by all machines deployed from an image,
+# it's removed from the staging root before packing and recreated by `fixup`
+MACHINE_STATE = [
+    Path("etc/machine-id"),
+    Path("etc/hostname"),
+    # pacman-key --init generates a local signing key, every machine needs its own
+    Path("etc/pacman.d/gnupg"),
+]
+
+# Keep ownership, permissions, ACLs and extended attributes (file capabilities) intact
+TAR_OPTIONS = ["--numeric-owner", "--xattrs", "--xattrs-include=*", "--acls"]
+
+
+def hash_image(path: Path, chunk_size: int = 1024 ** 2) -> str:
+    sha256 = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def pack(staging: Path, image_dir: Path = constants.IMAGE_DIR) -> Path:
+    """
+    Pack the staging root into a zstd compressed tarball, named by the hash of its content.
+
+    Identical builds end up as the same image, so they're only stored once.
+    """
+    image_dir.mkdir(parents=True, exist_ok=True)
+    partial = image_dir / f"partial-{int(time.time())}{IMAGE_SUFFIX}"
+    tar_cmd = shlex.join(["tar", *TAR_OPTIONS, "-C", str(staging), "-cf", "-", "."])
+    # Without pipefail, a failing tar would go unnoticed as long as zstd compressed whatever it got
+    proc = commands.run_root_cmd(
+        ["bash", "-o", "pipefail", "-c", f"{tar_cmd} | zstd -T0 -12 -q -o {shlex.quote(str(partial))}"]
+    )
+    if proc.returncode != 0:
+        commands.run_root_cmd(["rm", "-f", str(partial)], enable_debug=False)
+        raise OSError(f"Unable to pack {staging} into an image")
+
+    image = image_dir / f"{hash_image(partial)}{IMAGE_SUFFIX}"
+    partial.replace(image)
+    latest = image_dir / LATEST_LINK
+    latest.unlink(missing_ok=True)
+    latest.symlink_to(image.name)
+    return image
+
+
+def build(
+    staging: Path = constants.CACHE_DIR / "staging",
+    packages: list[str] = constants.BASE_PACKAGES,
+    image_dir: Path = constants.IMAGE_DIR,
+) -> Path:
+    """Install given packages into a staging root once and pack it into an image, return its path."""
+    commands.run_root_cmd(["rm", "-rf", str(staging)])
+    commands.run_root_cmd(["mkdir", "-p", str(staging)])
+    if pacman.pacstrap(staging, packages).returncode != 0:
+        raise OSError("pacstrap into the staging root failed")
+    pacman.configure_target(staging)
+    commands.run_root_cmd(["rm", "-rf", *(str(staging / path) for path in MACHINE_STATE)])
+
+    print(f"{constants.NOTE_COLOR}Packing {staging} into an image...")
+    image = pack(staging, image_dir)
+    image.with_name(image.name.removesuffix(IMAGE_SUFFIX) + ".json").write_text(json.dumps({
+        "packages": packages,
+        "created": time.time(),
+        "size": image.stat().st_size,
+    }, indent=2))
+    commands.run_root_cmd(["rm", "-rf", str(staging)])
+    print(f"{constants.SUCCESS_COLOR}Image built: {image}")
+    return image
+
+
+def find_image(image: Optional[Path] = None, image_dir: Path = constants.IMAGE_DIR) -> Path:
+    """Get the image to deploy, the most recently built one if `image` isn't given."""
+    if image is None:
+        image = image_dir / LATEST_LINK
+    if not image.exists():
+        raise FileNotFoundError(f"Image {image} doesn't exist, build one first")
+    return image.resolve()
+
+
+def deploy(root: Path, image: Path) -> None:
+    """
+    Extract the image onto the mounted root.
+
+    The image is read sequentially exactly once, zstd verifies the frame checksums while decompressing.
+    """
+    print(f"{constants.NOTE_COLOR}Extracting {image.name} onto {root}...")
+    tar_cmd = shlex.join(["tar", *TAR_OPTIONS, "-xpf", "-", "-C", str(root)])
+    proc = commands.run_root_cmd(["bash", "-o", "pipefail", "-c", f"zstd -dc -q {shlex.quote(str(image))} | {tar_cmd}"])
+    if proc.returncode != 0:
+        raise OSError(f"Unable to extract {image} onto {root}")
+
+
+def fixup(root: Path, hostname: str) -> None:
+    """Recreate the per-machine state which isn't a part of the image."""
+    commands.write_root_file(root / "etc" / "hostname", f"{hostname}\n")
+    commands.run_root_cmd(["systemd-machine-id-setup", f"--root={root}"])
+    commands.run_root_cmd(
+        f"arch-chroot {shlex.quote(str(root))} sh -c 'pacman-key --init && pacman-key --populate archlinux'"
+    )
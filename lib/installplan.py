@@ -0,0 +1,172 @@
+"""
+Install plan: the commands an install would run, recorded instead of executed.
+
+While a plan is active (see `start`), `commands` records every command and root file write
+into it, only commands which merely read the state of the system still run. The plan can be
+printed for review, exported as JSON (to diff plans of different hosts), or emitted as a single
+self-contained POSIX shell script, which escalates once and runs the whole install without Python.
+Secrets (see `redaction`) are masked when printing and in JSON, the script needs the real content.
+"""
+import json
+import shlex
+import subprocess
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional, Union
+
+from lib import constants, redaction
+
+# Delimiter of here-documents in the script, extended when the content happens to contain it
+HEREDOC_DELIMITER = "ARCHDEPLOY_EOF"
+
+SCRIPT_HEADER = """\
+#!/bin/sh
+# Install plan generated by ArchDeploy, review it before running, it erases the target disks!
+set -eu
+if [ "$(id -u)" -ne 0 ]; then
+    if command -v sudo >/dev/null 2>&1; then exec sudo sh "$0" "$@"; fi
+    if command -v doas >/dev/null 2>&1; then exec doas sh "$0" "$@"; fi
+    exec su root -c 'exec sh "$0"' "$0"
+fi"""
+
+
+def heredoc(content: str) -> str:
+    """Get a quoted here-document redirection feeding given content (ending with a newline) to stdin."""
+    delimiter = HEREDOC_DELIMITER
+    while delimiter in content.splitlines():
+        delimiter += "_"
+    return f"<<'{delimiter}'\n{content}{delimiter}"
+
+
+class PlannedCommand(NamedTuple):
+    step: Optional[str]
+    cmd: str
+    root: bool
+
+    def to_dict(self) -> dict:
+        return {"step": self.step, "type": "command", "cmd": redaction.redact(self.cmd), "root": self.root}
+
+    def to_shell(self) -> str:
+        return self.cmd
+
+    def describe(self) -> str:
+        return f"{'#' if self.root else '$'} {redaction.redact(self.cmd)}"
+
+
+class PlannedFile(NamedTuple):
+    step: Optional[str]
+    path: Path
+    content: str
+    mode: str
+
+    def to_dict(self) -> dict:
+        return {
+            "step": self.step, "type": "file", "path": str(self.path), "mode": self.mode,
+            "content": redaction.redact(self.content),
+        }
+
+    def to_shell(self) -> str:
+        path = shlex.quote(str(self.path))
+        if self.content.endswith("\n"):
+            write = f"cat > {path} {heredoc(self.content)}"
+        else:
+            # Here-documents always end with a newline, keep the content exact
+            write = f"printf '%s' {shlex.quote(self.content)} > {path}"
+        return f"{write}\nchmod {self.mode} {path}"
+
+    def describe(self) -> str:
+        return f"# write {self.path} (mode {self.mode}, {len(self.content.splitlines())} lines)"
+
+
+PlanEntry = Union[PlannedCommand, PlannedFile]
+
+
+class InstallPlan:
+    """Commands and file writes of an install, in the order they would be done."""
+
+    def __init__(self):
+        self.entries: list[PlanEntry] = []
+        # Step the recorded entries belong to, set by the scheduler (which runs steps one by one when planning)
+        self.step: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def add_command(self, cmd: Union[str, list[str]], root: bool) -> None:
+        cmd_str = cmd if isinstance(cmd, str) else shlex.join(cmd)
+        with self._lock:
+            self.entries.append(PlannedCommand(self.step, cmd_str, root))
+
+    def add_file(self, path: Path, content: str, mode: str = "644") -> None:
+        with self._lock:
+            self.entries.append(PlannedFile(self.step, path, content, mode))
+
+    def record(self, cmd: Union[str, list[str]], root: bool, capture_out: bool = False) -> subprocess.CompletedProcess:
+        """Record given command, return the result of the command as if it succeeded."""
+        self.add_command(cmd, root)
+        return subprocess.CompletedProcess(cmd, 0, b"" if capture_out else None)
+
+    def to_dict(self) -> dict:
+        return {"entries": [entry.to_dict() for entry in self.entries]}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def has_secrets(self) -> bool:
+        """Check if the script of the plan would contain any secrets."""
+        return any(redaction.redact(entry.to_shell()) != entry.to_shell() for entry in self.entries)
+
+    def to_script(self) -> str:
+        """
+        Get the plan as a POSIX shell script, stopping at the first command which fails.
+
+        Secrets aren't masked in the script (it wouldn't work otherwise), check `has_secrets` before sharing it.
+        """
+        lines = [SCRIPT_HEADER]
+        step = None
+        for entry in self.entries:
+            if entry.step != step or len(lines) == 1:
+                step = entry.step
+                lines.append(f"\necho {shlex.quote('==> ' + (step or 'setup'))}")
+            lines.append(entry.to_shell())
+        return "\n".join(lines) + "\n"
+
+    def print(self) -> None:
+        step = None
+        for index, entry in enumerate(self.entries):
+            if entry.step != step or index == 0:
+                step = entry.step
+                print(f"{constants.INFO_COLOR}==> {step or 'setup'}")
+            print(f"    {constants.CMD_COLOR}{entry.describe()}")
+
+
+_active: Optional[InstallPlan] = None
+
+
+def start() -> InstallPlan:
+    """Start recording commands into a new plan instead of running them."""
+    global _active
+    _active = InstallPlan()
+    return _active
+
+
+def get() -> Optional[InstallPlan]:
+    """Get the plan being recorded, `None` when commands are being run."""
+    return _active
+
+
+def is_active() -> bool:
+    return _active is not None
+
+
+@contextmanager
+def step(name: str) -> Iterator[None]:
+    """Attribute the entries recorded in the body of the with block to given step."""
+    if _active is None:
+        yield
+        return
+    previous = _active.step
+    _active.step = name
+    try:
+        yield
+    finally:
+        _active.step = previous
@@ -1,109 +1,146 @@
 import json
-import socket
+import shlex
 import time
-import urllib.error
-import urllib.request
 from pathlib import Path
-from typing import Literal, Union
-from enum import Enum
-import textwrap
+from typing import Literal, Optional, Union
 
-from lib import commands, constants, questions
+from lib import answers, commands, connectivity, constants, inventory, linkwatch, native, questions, redaction, wifi
+from lib.inventory import InterfaceType  # noqa: F401 (re-exported)
 
-
-class InterfaceType(Enum):
-    UNKNOWN = "UNKNOWN"
-    PHYSICAL = "PHYSICAL"
-    WIRELESS = "WIRELESS"
-    TUNTAP = "TUN/TAP"
-    BRIDGE = "BRIDGE"
+# How long (in seconds) to wait for the address and routes once associated to a Wi-Fi network
+WIFI_CONFIGURATION_TIMEOUT = 20
 
 
 class Interface:
     """Network interface/device class."""
 
-    def __init__(self, name: str):
+    def __init__(self, name: str, record: Optional[inventory.NetInterface] = None):
         self.name = name
         self.path = Path(f"/sys/class/net/{self.name}")
-        self.type = self.get_type(self.path)
-
-    @staticmethod
-    def get_type(path: Path) -> InterfaceType:
-        """Get the type of interface based on its path."""
-        if path.joinpath("bridge").is_dir():
-            return InterfaceType.BRIDGE
-        elif path.joinpath("tun_flags").is_file():
-            return InterfaceType.TUNTAP
-        elif path.joinpath("device").is_dir():
-            if path.joinpath("wireless").is_dir():
-                return InterfaceType.WIRELESS
-            else:
-                return InterfaceType.PHYSICAL
-        else:
-            return InterfaceType.UNKNOWN
+        if record is None:
+            record = inventory.get().interfaces.get(name)
+        # Snapshot of the interface from the inventory, live state is read through linkwatch
+        self.record = record
+        self.type = InterfaceType.UNKNOWN if record is None else record.type
 
     def is_up(self) -> bool:
         """Check if the interface is UP."""
-        flags_text = self.path.joinpath("flags").read_text().replace("\n", "")
-        flags = int(flags_text, 16)
-        return bool(flags & 1)
+        return linkwatch.is_up(self.name)
+
+    def has_carrier(self) -> bool:
+        """Check if the interface has a link."""
+        return linkwatch.has_carrier(self.name)
 
     def __repr__(self) -> str:
-        return f"<Interface(name={self.name}, type={self.type}, UP={self.is_up()})>"
+        is_up = self.record is not None and self.record.is_up
+        return f"<Interface(name={self.name}, type={self.type}, UP={is_up})>"
 
     @classmethod
     def get_interfaces(cls, skip_loopback: bool = True) -> list["Interface"]:
         interfaces = []
-        for index, interface_name in socket.if_nameindex():
-            if interface_name == "lo" and skip_loopback:
+        for name, record in inventory.get().interfaces.items():
+            if name == "lo" and skip_loopback:
                 continue
 
-            interfaces.append(cls(interface_name))
+            interfaces.append(cls(name, record))
         return interfaces
 
 
-def check_connection(host: str = "https://ping.archlinux.org") -> bool:
-    """Check if system is connected to the internet."""
-    try:
-        urllib.request.urlopen(host)
-    except urllib.error.URLError:
-        return False
-    else:
-        return True
+def check_connection(host: Optional[str] = None, use_cache: bool = True) -> bool:
+    """
+    Check if system is connected to the internet.
+
+    By default, multiple endpoints are probed concurrently and the first success wins,
+    `host` can be used to only probe a single URL (or `host:port` for a plain TCP connect).
+    """
+    return connectivity.check(host, use_cache=use_cache)
+
+
+def _read_rfkill() -> list[native.RfkillDevice]:
+    """Get the RF-KILL switches, natively if possible, otherwise with the `rfkill` command."""
+    devices = native.read_rfkill()
+    if devices is not None:
+        return devices
+    proc = commands.run_root_cmd("rfkill --json", capture_out=True, read_only=True)
+    rfkill_out = json.loads(proc.stdout.decode())
+    return [
+        native.RfkillDevice(device["id"], device["device"], device["type"],
+                            device["soft"] == "blocked", device["hard"] == "blocked")
+        for device_list in rfkill_out.values()
+        for device in device_list
+    ]
 
 
 def unblock_rfkill():
     """Check if any of the interfaces are blocked with RF-KILL, if so, unblock them."""
-    proc = commands.run_root_cmd("rfkill --json", capture_out=True)
-    rfkill_out = json.loads(proc.stdout.decode())
+    for device in _read_rfkill():
+        if device.soft_blocked:
+            print(
+                f"{constants.INFO_COLOR}Device {device.name} (type={device.type}) is soft-blocked with RF-KILL.\n"
+                "This can sometimes happen with live ISOs, unblocking..."
+            )
+            if not native.rfkill_unblock(device.type):
+                commands.run_root_cmd(f"rfkill unblock {device.type}")
+        if device.hard_blocked:
+            print(
+                f"{constants.WARN_COLOR} Device {device.name} (type={device.type}) is hard-blocked with RF-KILL.\n"
+                "This usually implies a hardware switch toggle or something similar, can't unblock. "
+                "This may or may not cause further issues, depending on the device."
+            )
 
-    for device_list in rfkill_out.values():
-        for device in device_list:
-            device_name = device["device"]
-            device_type = device["type"]
-            if device["soft"] == "blocked":
-                print(
-                    f"{constants.INFO_COLOR}Device {device_name} (type={device_type}) is soft-blocked with RF-KILL.\n"
-                    "This can sometimes happen with live ISOs, unblocking..."
-                )
-                commands.run_root_cmd(f"rfkill unblock {device_type}")
-            if device["hard"] == "blocked":
-                print(
-                    f"{constants.WARN_COLOR} Device {device_name} (type={device_type}) is hard-blocked with RF-KILL.\n"
-                    "This usually implies a hardware switch toggle or something similar, can't unblock. "
-                    "This may or may not cause further issues, depending on the device."
-                )
+
+def _wait_for_ethernet(watcher: linkwatch.LinkWatcher, wait_time: float) -> bool:
+    """
+    Wait up to `wait_time` seconds for an Ethernet link to come up and for the connection to work.
+
+    Connectivity is only probed once some physical interface has a carrier, and after that
+    whenever the kernel reports a link, address or route change (e.g. DHCP lease obtained).
+    """
+    interface_names = [
+        interface.name for interface in Interface.get_interfaces()
+        if interface.type == InterfaceType.PHYSICAL
+    ]
+    deadline = time.monotonic() + wait_time
+    while True:
+        remaining = deadline - time.monotonic()
+        if watcher.wait_for_carrier(interface_names, remaining) is None:
+            return False
+        if check_connection():
+            return True
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        watcher.wait_for_change(remaining)
+
+
+def _wait_for_connection(watcher: linkwatch.LinkWatcher, wait_time: float) -> bool:
+    """Wait up to `wait_time` seconds for the connection to work, probing it on every network change."""
+    deadline = time.monotonic() + wait_time
+    while not check_connection():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        watcher.wait_for_change(remaining)
+    return True
+
+
+def _require_attended(key: str, choice: str) -> None:
+    """Fail on a `choice` which needs someone at the terminal (a shell or a TUI) in unattended mode."""
+    if questions.is_unattended():
+        raise questions.MissingAnswerError(key, f"{choice} (there's nobody at the terminal in unattended mode)")
 
 
-def connect_ethernet(wait_time: int = 20, iteration_time: int = 2) -> bool:
+def connect_ethernet(wait_time: int = 20) -> bool:
     """Attempt to connect to the internet using Ethernet."""
+    if check_connection():
+        return True
+
     print(f"{constants.NOTE_COLOR}Please plug in the Ethernet cable, waiting {wait_time}s...")
-    time_elapsed = 0
-    while not check_connection() and time_elapsed < wait_time:
-        time.sleep(iteration_time)
-        time_elapsed += iteration_time
+    with linkwatch.LinkWatcher() as watcher:
+        connected = _wait_for_ethernet(watcher, wait_time)
 
-    if not check_connection():
+    if not connected:
         # The ethernet cable wasn't plugged in within the time limit
         while True:
             choice = questions.choice(
@@ -112,16 +149,18 @@ def connect_ethernet(wait_time: int = 20, iteration_time: int = 2) -> bool:
                     "Drop to shell and connect manually",
                     "Try to connect Ethernet again",
                     "Give up on internet connection"
-                ]
+                ],
+                key="network.ethernet.failed",
             )
             if choice == "Drop to shell and connect manually":
+                _require_attended("network.ethernet.failed", choice)
                 commands.drop_to_shell()
                 if check_connection():
                     return True
                 else:
                     continue
             elif choice == "Try to connect Ethernet again":
-                return connect_ethernet(wait_time * 2, iteration_time)
+                return connect_ethernet(wait_time * 2)
             elif choice == "Give up on internet connection":
                 return False
     return True
@@ -138,14 +177,19 @@ def _ensure_active_interface(interface_type: Union[Literal["WIRELESS"], Literal[
     if this wasn't achieved, return `False`.
     """
     # Make sure we have at least one interface of requested type on this device
-    interfaces = [interface for interface in Interface.get_interfaces() if interface.type == interface_type]
+    interfaces = [
+        interface for interface in Interface.get_interfaces()
+        if interface.type == InterfaceType[interface_type]
+    ]
     if len(interfaces) == 0:
         print(f"{constants.ERROR_COLOR}Couldn't find any interface of {interface_type} type!")
         choice = questions.choice(
             "How do you wish to proceed?",
-            choices=["Drop to shell and correct this", f"Give up on {interface_type} type"]
+            choices=["Drop to shell and correct this", f"Give up on {interface_type} type"],
+            key="network.no_interface",
         )
         if choice == "Drop to shell and correct this":
+            _require_attended("network.no_interface", choice)
             commands.drop_to_shell()
             return _ensure_active_interface(interface_type)
         else:
@@ -156,14 +200,16 @@ def _ensure_active_interface(interface_type: Union[Literal["WIRELESS"], Literal[
         print(f"{constants.ERROR_COLOR}All {interface_type} interfaces are DOWN.")
         bring_up = questions.multi_choice(
             "Choose which interfaces to bring UP (spacebar to select, enter to confirm):",
-            choices=[interface.name for interface in interfaces]
+            choices=[interface.name for interface in interfaces],
+            key="network.bring_up",
         )
         # User didn't pick any interfaces to bring up
         if len(bring_up) == 0:
             print(f"{constants.ERROR_COLOR}You didn't choose any interface(s) to bring up!")
             choice = questions.choice(
                 "How do you wish to continue?",
-                choices=["Choose again", f"Give up on {interface_type} type"]
+                choices=["Choose again", f"Give up on {interface_type} type"],
+                key="network.no_interfaces_chosen",
             )
             if choice == "Choose again":
                 continue
@@ -171,34 +217,47 @@ def _ensure_active_interface(interface_type: Union[Literal["WIRELESS"], Literal[
                 return False
 
         # Try to bring up all selected interfaces
-        for interface_name in bring_up:
-            interface = Interface(interface_name)
-            commands.run_root_cmd(f"ip link set {interface.name} up")
-            while not interface.is_up():
-                print(f"{constants.ERROR_COLOR}Failed to bring interface {interface.name} UP!")
-                choice = questions.choice(
-                    "How do you wish to continue?",
-                    choices=[
-                        f"Drop to shell and bring the interface {interface.name} UP manually",
-                        f"Give up on interface {interface.name}"
-                    ]
-                )
-                if choice == f"Drop to shell and bring the interface {interface.name} UP manually":
-                    commands.drop_to_shell()
-                    continue
-                else:
-                    break
+        with linkwatch.LinkWatcher() as watcher:
+            for interface_name in bring_up:
+                _bring_interface_up(watcher, Interface(interface_name))
 
     # The only way to get here is to pass the while loop condition (some interface is UP)
     return True
 
 
+def _bring_interface_up(watcher: linkwatch.LinkWatcher, interface: Interface, timeout: float = 5) -> bool:
+    """Bring given interface UP, waiting for the kernel to report the change."""
+    if not native.set_link_up(interface.name):
+        commands.run_root_cmd(f"ip link set {interface.name} up")
+    inventory.invalidate()
+    while not watcher.wait_for_up(interface.name, timeout):
+        print(f"{constants.ERROR_COLOR}Failed to bring interface {interface.name} UP!")
+        choice = questions.choice(
+            "How do you wish to continue?",
+            choices=[
+                f"Drop to shell and bring the interface {interface.name} UP manually",
+                f"Give up on interface {interface.name}"
+            ],
+            key="network.interface_up_failed",
+        )
+        if choice == f"Drop to shell and bring the interface {interface.name} UP manually":
+            _require_attended("network.interface_up_failed", choice)
+            commands.drop_to_shell()
+            continue
+        else:
+            return False
+    return True
+
+
 def _pick_wireless_interface() -> Union[Interface, Literal[False]]:
     """
     Get an active wireless interface for wireless connection, if available.
     If we can't get any active wireless interface, end with False (proceed with ethernet).
     """
-    wireless_interfaces = [interface for interface in Interface.get_interfaces() if interface.type == "WIRELESS"]
+    wireless_interfaces = [
+        interface for interface in Interface.get_interfaces()
+        if interface.type == InterfaceType.WIRELESS
+    ]
     active_interfaces = [interface for interface in wireless_interfaces if interface.is_up()]
 
     if len(active_interfaces) == 0:
@@ -209,7 +268,8 @@ def _pick_wireless_interface() -> Union[Interface, Literal[False]]:
                 "Try to fix the issue",
                 "Drop to shell and fix the issue",
                 "Proceed with Ethernet",
-            ]
+            ],
+            key="network.wifi.no_interface",
         )
         if choice == "Try to fix the issue":
             if not _ensure_active_interface("WIRELESS"):
@@ -217,17 +277,19 @@ def _pick_wireless_interface() -> Union[Interface, Literal[False]]:
             # Run this even if we fail, so that we get the inquirer prompt again
             return _pick_wireless_interface()
         elif choice == "Drop to shell and fix the issue":
+            _require_attended("network.wifi.no_interface", choice)
             commands.drop_to_shell()
             return _pick_wireless_interface()
         else:
             return False
     elif len(active_interfaces) == 1:
-        return wireless_interfaces[0]
+        return active_interfaces[0]
     else:
         choice = questions.choice(
             "There are multiple wireless interfaces which are UP, "
             "choose which interface should be use to make the connection.",
-            choices=[interface.name for interface in active_interfaces]
+            choices=[interface.name for interface in active_interfaces],
+            key="network.wifi.interface",
         )
         return Interface(choice)
 
@@ -235,41 +297,55 @@ def _pick_wireless_interface() -> Union[Interface, Literal[False]]:
 def _iwctl_connect(interface: Interface) -> bool:
     """Try to connect to WiFi automatically using iwctl."""
     # Attempt to find some networks
-    print(f"{constants.NOTE_COLOR}Scanning for networks with {interface.name}, waiting 5s...")
-    commands.run_cmd(f"iwctl station {interface.name} scan")
-    time.sleep(5)
-    proc = commands.run_cmd(f"iwctl station {interface.name} get-networks rssi-dbms", capture_out=True)
-    proc_out = proc.stdout.decode()
-    network_lines = [textwrap.dedent(line) for line in proc_out.splitlines()[4:] if len(line) != 0]
+    print(f"{constants.NOTE_COLOR}Scanning for networks with {interface.name}...")
+    with wifi.watch_station(interface.name) as station:
+        commands.run_cmd(f"iwctl station {interface.name} scan")
+        if station.wait_for(wifi.scan_done, wifi.SCAN_TIMEOUT) is None:
+            print(f"{constants.WARN_COLOR}Scan didn't finish in {wifi.SCAN_TIMEOUT}s, using the networks found so far.")
+    proc = commands.run_cmd(
+        f"iwctl station {interface.name} get-networks rssi-dbms", capture_out=True, read_only=True
+    )
+    networks = wifi.parse_networks(proc.stdout.decode(errors="replace"))
 
     # If we didn't found any networks, fail
-    if len(network_lines) == 0:
+    if len(networks) == 0:
         print(f"{constants.ERROR_COLOR}No networks found. Unable to connect to Wi-Fi with iwctl automatically!")
         return False
 
-    # Print out all found networks and store them
     print(f"{constants.INFO_COLOR}Found these networks:")
-    networks = []
-    for line in network_lines:
-        print(line)
-        # use rsplit twice since SSIDs can contain spaces
-        networks.append(line.rsplit(maxsplit=2))
+    for network in networks:
+        print(f"    {network.describe()}")
 
     # Let user pick the network to connect to (from SSIDs)
     ssid = questions.choice(
         "Which network do you wish to connect to (you'll be prompted for the password, if it has one)",
-        choices=[network[0] for network in networks]
+        choices=[network.ssid for network in networks],
+        key="network.wifi.ssid",
     )
 
     # Try to connect (will fail on wrong password)
     print(f"{constants.NOTE_COLOR}Connecting...")
-    commands.run_cmd(f"iwctl station {interface.name} connect '{ssid}'")
-    time.sleep(5)
+    # Unattended installs can't type the passphrase in, give iwd the one from the answer file
+    passphrase = answers.get("network.wifi.passphrase")
+    if passphrase is not None:
+        redaction.add_secret(str(passphrase))
+        if not wifi.store_passphrase(ssid, str(passphrase)):
+            print(f"{constants.ERROR_COLOR}Unable to save the passphrase of {ssid} for iwd!")
+            return False
+    with wifi.watch_station(interface.name) as station:
+        commands.run_cmd(f"iwctl station {interface.name} connect {shlex.quote(ssid)}")
+        state = station.wait_for(wifi.connection_done, wifi.CONNECT_TIMEOUT)
 
-    if not check_connection():
+    if state is None or state.state != "connected":
         print(f"{constants.ERROR_COLOR}iwctl connection failed! (Most likely due to wrong network password).")
         return False
 
+    # Associated, the connection works once the address and routes are configured
+    with linkwatch.LinkWatcher() as watcher:
+        if not _wait_for_connection(watcher, WIFI_CONFIGURATION_TIMEOUT):
+            print(f"{constants.ERROR_COLOR}Connected to {ssid}, but the internet connection isn't available!")
+            return False
+
     return True
 
 
@@ -280,7 +356,8 @@ def connect_wifi() -> bool:
         return connect_ethernet()
 
     # Use TUI from NetworkManager if available, it is relatively easy to connect with this interface for the user.
-    if commands.command_exists("nmtui"):
+    # Nobody would fill it in during an unattended install, which only connects with iwctl.
+    if commands.command_exists("nmtui") and not questions.is_unattended():
         commands.run_cmd("nmtui")
         while not check_connection():
             print(f"{constants.ERROR_COLOR}Internet connection still isn't available")
@@ -291,7 +368,8 @@ def connect_wifi() -> bool:
                     "Try with iwctl",
                     "Drop to shell and connect manually",
                     "Use Ethernet instead"
-                ]
+                ],
+                key="network.wifi.nmtui_failed",
             )
             if opt == "Retry with nmtui":
                 commands.run_cmd("nmtui")
@@ -329,9 +407,11 @@ def connect_wifi() -> bool:
                     "Proceed with Ethernet",
                     "Retry iwctl autoconnection",
                     "Drop to interactive iwctl"
-                ]
+                ],
+                key="network.wifi.iwctl_failed",
                 )
             if choice == "Drop to shell and connect manually":
+                _require_attended("network.wifi.iwctl_failed", choice)
                 commands.drop_to_shell()
                 continue
             elif choice == "Proceed with Ethernet":
@@ -340,6 +420,7 @@ def connect_wifi() -> bool:
                 _iwctl_connect(active_interface)
                 continue
             else:  # interactive iwctl
+                _require_attended("network.wifi.iwctl_failed", choice)
                 print(
                     f"{constants.INFO_COLOR}After you're done, use {constants.CMD_COLOR}exit "
                     f"{constants.INFO_COLOR}to go back, to display iwctl help, use {constants.CMD_COLOR}help"
@@ -355,9 +436,11 @@ def connect_wifi() -> bool:
     while True:
         choice = questions.choice(
             "How do you wish to continue?",
-            choices=["Drop to shell and connect manually", "Proceed with Ethernet"]
+            choices=["Drop to shell and connect manually", "Proceed with Ethernet"],
+            key="network.wifi.no_tools",
         )
         if choice == "Drop to shell and connect manually":
+            _require_attended("network.wifi.no_tools", choice)
             commands.drop_to_shell()
             if check_connection():
                 return True
@@ -376,7 +459,8 @@ def connect_internet() -> bool:
 
         connect_opt = questions.choice(
             "How do you wish to connect to internet?",
-            choices=["Wi-Fi", "Ethernet"]
+            choices=["Wi-Fi", "Ethernet"],
+            key="network.method",
         )
         if connect_opt == "Wi-Fi":
             result = connect_wifi()
@@ -0,0 +1,210 @@
+import threading
+from enum import Enum
+from pathlib import Path
+from typing import Optional
+
+SYS_NET = Path("/sys/class/net")
+SYS_BLOCK = Path("/sys/block")
+# Block devices which can never be install targets
+IGNORED_BLOCK_PREFIXES = ("ram", "zram", "fd")
+# Value of queue/rotational when a device doesn't report it, assuming a HDD only skips SSD specific tuning
+DEFAULT_ROTATIONAL = "1"
+
+
+class InterfaceType(Enum):
+    UNKNOWN = "UNKNOWN"
+    PHYSICAL = "PHYSICAL"
+    WIRELESS = "WIRELESS"
+    TUNTAP = "TUN/TAP"
+    BRIDGE = "BRIDGE"
+
+
+def _read(path: Path, default: str = "") -> str:
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return default
+
+
+def format_size(size: int) -> str:
+    """Format size in bytes in human readable form (`512.0M`, `1.8T`)."""
+    value = float(size)
+    units = ["B", "K", "M", "G", "T"]
+    for unit in units:
+        if value < 1024 or unit == units[-1]:
+            break
+        value /= 1024
+    return f"{value:.1f}{unit}"
+
+
+def get_interface_type(path: Path) -> InterfaceType:
+    """Get the type of interface based on its sysfs path."""
+    if path.joinpath("bridge").is_dir():
+        return InterfaceType.BRIDGE
+    elif path.joinpath("tun_flags").is_file():
+        return InterfaceType.TUNTAP
+    elif path.joinpath("device").is_dir():
+        if path.joinpath("wireless").is_dir() or path.joinpath("phy80211").exists():
+            return InterfaceType.WIRELESS
+        else:
+            return InterfaceType.PHYSICAL
+    else:
+        return InterfaceType.UNKNOWN
+
+
+class NetInterface:
+    """Network interface, as it was when the inventory was taken."""
+    __slots__ = ("name", "index", "type", "mac", "is_up", "has_carrier")
+
+    def __init__(self, name: str, index: int, type: InterfaceType, mac: str, is_up: bool, has_carrier: bool):
+        self.name = name
+        self.index = index
+        self.type = type
+        self.mac = mac
+        self.is_up = is_up
+        self.has_carrier = has_carrier
+
+    @property
+    def is_wireless(self) -> bool:
+        return self.type == InterfaceType.WIRELESS
+
+    @classmethod
+    def scan(cls, path: Path) -> "NetInterface":
+        flags = int(_read(path / "flags", "0") or "0", 16)
+        return cls(
+            name=path.name,
+            index=int(_read(path / "ifindex", "0") or 0),
+            type=get_interface_type(path),
+            mac=_read(path / "address"),
+            is_up=bool(flags & 0x1),  # IFF_UP
+            # Reading carrier of a DOWN interface fails with EINVAL
+            has_carrier=_read(path / "carrier", "0") == "1",
+        )
+
+
+class BlockDevice:
+    """Disk or partition, as it was when the inventory was taken."""
+    __slots__ = ("name", "path", "size", "model", "rotational", "removable", "read_only", "parent", "partitions")
+
+    def __init__(
+        self,
+        name: str,
+        size: int,
+        model: str = "",
+        rotational: bool = False,
+        removable: bool = False,
+        read_only: bool = False,
+        parent: Optional[str] = None,
+    ):
+        self.name = name
+        self.path = Path("/dev", name)
+        self.size = size
+        self.model = model
+        self.rotational = rotational
+        self.removable = removable
+        self.read_only = read_only
+        self.parent = parent
+        self.partitions: list[BlockDevice] = []
+
+    @property
+    def is_partition(self) -> bool:
+        return self.parent is not None
+
+    def describe(self) -> str:
+        """Get a one line description, used when offering the device as a choice."""
+        details = [format_size(self.size)]
+        if self.model:
+            details.append(self.model)
+        details.append("HDD" if self.rotational else "SSD")
+        if self.removable:
+            details.append("removable")
+        return f"{self.path} ({', '.join(details)})"
+
+    def __repr__(self) -> str:
+        return f"<BlockDevice {self.describe()}>"
+
+    @classmethod
+    def scan(cls, path: Path) -> "BlockDevice":
+        queue = path / "queue"
+        disk = cls(
+            name=path.name,
+            # Size in sysfs is always in 512 byte sectors
+            size=int(_read(path / "size", "0") or 0) * 512,
+            model=_read(path / "device" / "model"),
+            rotational=_read(queue / "rotational", DEFAULT_ROTATIONAL) == "1",
+            removable=_read(path / "removable", "0") == "1",
+            read_only=_read(path / "ro", "0") == "1",
+        )
+        for part_path in sorted(path.iterdir()):
+            if not part_path.joinpath("partition").is_file():
+                continue
+            disk.partitions.append(cls(
+                name=part_path.name,
+                size=int(_read(part_path / "size", "0") or 0) * 512,
+                model=disk.model,
+                rotational=disk.rotational,
+                removable=disk.removable,
+                read_only=_read(part_path / "ro", "0") == "1",
+                parent=disk.name,
+            ))
+        return disk
+
+
+class Inventory:
+    """Snapshot of the network interfaces and block devices of this machine."""
+
+    def __init__(self):
+        self.interfaces: dict[str, NetInterface] = {}
+        if SYS_NET.is_dir():
+            records = [NetInterface.scan(path) for path in SYS_NET.iterdir()]
+            self.interfaces = {record.name: record for record in sorted(records, key=lambda record: record.index)}
+
+        self.disks: dict[str, BlockDevice] = {}
+        if SYS_BLOCK.is_dir():
+            for path in sorted(SYS_BLOCK.iterdir()):
+                if path.name.startswith(IGNORED_BLOCK_PREFIXES):
+                    continue
+                disk = BlockDevice.scan(path)
+                # Unattached loop devices and empty card readers
+                if disk.size != 0:
+                    self.disks[disk.name] = disk
+
+    def get_partitions(self) -> list[BlockDevice]:
+        return [partition for disk in self.disks.values() for partition in disk.partitions]
+
+    def get_block_device(self, path: Path) -> Optional[BlockDevice]:
+        name = path.resolve().name
+        for device in [*self.disks.values(), *self.get_partitions()]:
+            if device.name == name:
+                return device
+        return None
+
+    def get_parent_disk(self, path: Path) -> Optional[BlockDevice]:
+        """Get the disk given partition is on, also for partitions which aren't created yet (`/dev/sda1` is on sda)."""
+        name = path.name
+        for disk in self.disks.values():
+            # Same naming as `partitioning.partition_path`
+            prefix = disk.name + ("p" if disk.name[-1].isdigit() else "")
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                return disk
+        return None
+
+
+_inventory: Optional[Inventory] = None
+_lock = threading.Lock()
+
+
+def get() -> Inventory:
+    """Get the inventory snapshot, taking it if there's none (or it was invalidated)."""
+    global _inventory
+    with _lock:
+        if _inventory is None:
+            _inventory = Inventory()
+        return _inventory
+
+
+def invalidate() -> None:
+    """Drop the snapshot, call this after something could have changed the hardware state."""
+    global _inventory
+    with _lock:
+        _inventory = None
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import time
+from pathlib import Path
+from typing import Any, Callable, NamedTuple, Optional
+
+from lib import constants
+
+
+def digest(value: Any) -> str:
+    """Get a stable content hash of given (JSON serializable) value."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def hash_file(path: Path) -> Optional[str]:
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+
+def hash_listing(path: Path) -> Optional[str]:
+    """Hash the names of all entries in given directory."""
+    try:
+        return digest(sorted(entry.name for entry in path.iterdir()))
+    except OSError:
+        return None
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+class Checkpoint(NamedTuple):
+    """
+    Describes how to decide whether a step can be skipped.
+
+    `inputs` returns everything the step depends on (from the results of other steps),
+    `outputs` returns a fingerprint of what the step produced, it's computed right after
+    the step finishes and again on rerun, the step is only skipped if both still match.
+    `serialize`/`deserialize` convert the step's result to and from JSON.
+    """
+    inputs: Callable[[dict[str, Any]], Any] = lambda results: None
+    outputs: Callable[[dict[str, Any], Any], Any] = lambda results, result: None
+    serialize: Callable[[Any], Any] = _identity
+    deserialize: Callable[[Any], Any] = _identity
+
+
+class Journal:
+    """Persistent record of completed install steps, used to skip them when the install is rerun."""
+
+    def __init__(self, path: Path = constants.CACHE_DIR / "install-state.json"):
+        self.path = path
+        try:
+            self.steps: dict[str, dict] = json.loads(path.read_text())["steps"]
+        except (OSError, ValueError, KeyError):
+            self.steps = {}
+
+    def save(self) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps({"steps": self.steps}, indent=2, default=str))
+        except OSError:
+            print(f"{constants.WARN_COLOR}Unable to save install state journal to {self.path}")
+
+    def clear(self) -> None:
+        self.steps = {}
+        self.save()
+
+    def lookup(self, name: str, checkpoint: Checkpoint, results: dict[str, Any]) -> tuple[bool, Any]:
+        """
+        Check if the step was already completed with the same inputs and its outputs still check out.
+
+        Return whether the step can be skipped and its recorded result.
+        """
+        record = self.steps.get(name)
+        if record is None or record["inputs"] != digest(checkpoint.inputs(results)):
+            return False, None
+
+        result = checkpoint.deserialize(record["result"])
+        if record["outputs"] != digest(checkpoint.outputs(results, result)):
+            return False, None
+        return True, result
+
+    def record(self, name: str, checkpoint: Checkpoint, results: dict[str, Any], result: Any) -> None:
+        self.steps[name] = {
+            "inputs": digest(checkpoint.inputs(results)),
+            "outputs": digest(checkpoint.outputs(results, result)),
+            "result": checkpoint.serialize(result),
+            "completed": time.time(),
+        }
+        self.save()
+
+    def invalidate(self, name: str) -> None:
+        if self.steps.pop(name, None) is not None:
+            self.save()
@@ -0,0 +1,164 @@
+import errno
+import select
+import socket
+import struct
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+# Netlink constants (from linux/netlink.h and linux/rtnetlink.h)
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+
+IFF_UP = 0x1
+IFF_LOWER_UP = 0x10000
+
+NLMSGHDR = struct.Struct("=LHHLL")
+IFINFOMSG = struct.Struct("=BxHiII")
+
+# How often to re-read sysfs when netlink isn't available
+SYSFS_POLL_INTERVAL = 0.1
+# How often to report a possible change without netlink, callers re-check state which is costlier than sysfs
+CHANGE_POLL_INTERVAL = 1.0
+
+
+def read_flags(interface_name: str) -> int:
+    """Read the interface flags of given interface from sysfs."""
+    flags_text = Path("/sys/class/net", interface_name, "flags").read_text().strip()
+    return int(flags_text, 16)
+
+
+def is_up(interface_name: str) -> bool:
+    """Check if given interface is administratively UP."""
+    try:
+        return bool(read_flags(interface_name) & IFF_UP)
+    except OSError:
+        return False
+
+
+def has_carrier(interface_name: str) -> bool:
+    """Check if given interface has a link (cable plugged in, associated to an AP, ...)."""
+    try:
+        return Path("/sys/class/net", interface_name, "carrier").read_text().strip() == "1"
+    except OSError:
+        # Reading carrier of an interface which is DOWN fails with EINVAL
+        return False
+
+
+class LinkWatcher:
+    """
+    Watch for link state changes of network interfaces.
+
+    Changes are received from an rtnetlink socket subscribed to link, address
+    and route notifications, so that we react as soon as the kernel reports them.
+    If netlink isn't available, we fall back to detecting the changes from sysfs.
+    """
+
+    def __init__(self):
+        try:
+            self.sock: Optional[socket.socket] = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            self.sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_IFADDR))
+        except (OSError, AttributeError):
+            self.sock = None
+
+    def __enter__(self) -> "LinkWatcher":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _read_events(self, timeout: float) -> Optional[list[int]]:
+        """
+        Wait up to `timeout` seconds for netlink messages.
+
+        Return a list of interface indexes with changed links (possibly empty for address
+        and route changes), or `None` if no message arrived before the timeout.
+        """
+        assert self.sock is not None
+        readable, _, _ = select.select([self.sock], [], [], max(timeout, 0))
+        if not readable:
+            return None
+
+        changed = []
+        while True:
+            try:
+                data = self.sock.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except OSError as exc:
+                # The kernel dropped some messages (ENOBUFS), we'll re-check the state anyway
+                if exc.errno == errno.ENOBUFS:
+                    continue
+                raise
+
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                msg_len, msg_type, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+                if msg_len < NLMSGHDR.size:
+                    break
+                if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+                    _, _, index, _, _ = IFINFOMSG.unpack_from(data, offset + NLMSGHDR.size)
+                    changed.append(index)
+                # Messages are aligned to 4 bytes
+                offset += (msg_len + 3) & ~3
+        return changed
+
+    def wait_for_change(self, timeout: float) -> bool:
+        """
+        Wait until any link, address or route change happens, return `False` on timeout.
+
+        Without netlink, changes can't be seen, so this returns `True` every `CHANGE_POLL_INTERVAL`
+        seconds for the caller to re-check.
+        """
+        if self.sock is None:
+            if timeout <= 0:
+                return False
+            time.sleep(min(CHANGE_POLL_INTERVAL, timeout))
+            return True
+        return self._read_events(timeout) is not None
+
+    def wait_for(
+        self,
+        interface_names: list[str],
+        condition: Callable[[str], bool],
+        timeout: float,
+    ) -> Optional[str]:
+        """
+        Wait until `condition` holds for one of the given interfaces.
+
+        Return the name of the first interface matching the condition,
+        or `None` if none of them did within `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            # Check the state after subscribing, so that we can't miss a change
+            for name in interface_names:
+                if condition(name):
+                    return name
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            if self.sock is None:
+                time.sleep(min(SYSFS_POLL_INTERVAL, remaining))
+            else:
+                self._read_events(remaining)
+
+    def wait_for_carrier(self, interface_names: list[str], timeout: float) -> Optional[str]:
+        """Wait until one of given interfaces has a link, return its name or `None` on timeout."""
+        return self.wait_for(interface_names, has_carrier, timeout)
+
+    def wait_for_up(self, interface_name: str, timeout: float) -> bool:
+        """Wait until given interface is UP, return `False` on timeout."""
+        return self.wait_for([interface_name], is_up, timeout) is not None
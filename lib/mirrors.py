@@ -0,0 +1,239 @@
+import asyncio
+import json
+import os
+import ssl
+import time
+import urllib.parse
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from lib import commands, constants
+
+# Maximum amount of mirrors probed at the same time
+MAX_CONCURRENT_PROBES = 16
+# Deadline for probing a single mirror
+PROBE_TIMEOUT = 5
+# How many bytes of the sample file to download when measuring throughput
+SAMPLE_SIZE = 256 * 1024
+# Mirrors which synced more than this many seconds before the most recently synced one are out of date
+MAX_SYNC_LAG = 3 * 60 * 60
+# How many of the best mirrors to keep in the ranked mirrorlist
+KEEP_MIRRORS = 10
+# Most mirrors ranked when commented out servers have to be used (a stock mirrorlist lists around a thousand)
+MAX_CANDIDATES = 50
+
+
+class MirrorResult(NamedTuple):
+    server: str
+    latency: float
+    throughput: float  # bytes/s
+    last_sync: int
+
+    @property
+    def score(self) -> float:
+        """Expected time to fetch the sample file (lower is better)."""
+        return self.latency + SAMPLE_SIZE / self.throughput
+
+
+def read_mirrorlist(path: Path = constants.MIRRORLIST, include_commented: bool = False) -> list[str]:
+    """Read the server URLs from a mirrorlist, optionally including the commented out ones."""
+    servers = []
+    for line in path.read_text().splitlines():
+        line = line.strip()
+        if line.startswith("#") and not include_commented:
+            continue
+        line = line.lstrip("#").strip()
+        key, sep, value = line.partition("=")
+        if sep and key.strip() == "Server":
+            server = value.strip()
+            if server not in servers:
+                servers.append(server)
+    return servers
+
+
+def format_mirrorlist(servers: list[str]) -> str:
+    lines = ["# Mirrorlist ranked by ArchDeploy", f"# Generated: {time.strftime('%Y-%m-%d %H:%M:%S')}", ""]
+    lines.extend(f"Server = {server}" for server in servers)
+    return "\n".join(lines) + "\n"
+
+
+def prepend_server(server: str, mirrorlist: Path = constants.MIRRORLIST) -> None:
+    """Put given server at the top of the mirrorlist, so that pacman tries it before the others."""
+    lines = [line for line in mirrorlist.read_text().splitlines() if line.strip() != f"Server = {server}"]
+    commands.write_root_file(mirrorlist, "\n".join([f"Server = {server}", *lines]) + "\n")
+
+
+def server_root(server: str) -> str:
+    """Get the root URL of the mirror from a mirrorlist server URL (which ends with `$repo/os/$arch`)."""
+    root = server.split("$repo", 1)[0]
+    return root if root.endswith("/") else root + "/"
+
+
+def _expand_server(server: str, repo: str = "core") -> str:
+    return server.replace("$repo", repo).replace("$arch", os.uname().machine).rstrip("/") + "/"
+
+
+async def _http_get(url: str, max_bytes: int) -> tuple[float, float, bytes]:
+    """
+    Fetch up to `max_bytes` of the body of given URL.
+
+    Return the time to the first byte of the response, time it took to receive
+    the body after that, and the (possibly truncated) body itself.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    https = parsed.scheme == "https"
+    host = parsed.hostname or ""
+    port = parsed.port or (443 if https else 80)
+    path = parsed.path or "/"
+
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(
+        host, port, ssl=ssl.create_default_context() if https else None
+    )
+    try:
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {parsed.netloc}\r\n"
+            "User-Agent: ArchDeploy\r\nConnection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+
+        status_line = await reader.readline()
+        first_byte = time.perf_counter()
+        parts = status_line.decode(errors="replace").split()
+        if len(parts) < 2 or not parts[1].isdigit() or int(parts[1]) != 200:
+            raise ConnectionError(f"Unexpected response from {url}: {status_line!r}")
+
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            key, _, value = line.decode(errors="replace").partition(":")
+            headers[key.strip().lower()] = value.strip().lower()
+
+        body = b""
+        while len(body) < max_bytes:
+            chunk = await reader.read(min(65536, max_bytes - len(body)))
+            if not chunk:
+                break
+            body += chunk
+        end = time.perf_counter()
+    finally:
+        writer.close()
+
+    if headers.get("transfer-encoding") == "chunked":
+        body = _dechunk(body)
+    return first_byte - start, end - first_byte, body
+
+
+def _dechunk(data: bytes) -> bytes:
+    """Decode (possibly truncated) chunked transfer encoding."""
+    body = b""
+    while data:
+        size_line, _, data = data.partition(b"\r\n")
+        size = int(size_line.split(b";")[0] or b"0", 16)
+        if size == 0:
+            break
+        body += data[:size]
+        data = data[size + 2:]
+    return body
+
+
+async def probe_mirror(server: str, sample_size: int = SAMPLE_SIZE) -> Optional[MirrorResult]:
+    """Measure latency, throughput and last sync time of a mirror, return `None` if it's unusable."""
+    try:
+        latency, _, body = await _http_get(server_root(server) + "lastsync", 64)
+        last_sync = int(body.strip())
+        _, transfer_time, sample = await _http_get(_expand_server(server) + "core.db", sample_size)
+    except (OSError, ValueError, asyncio.TimeoutError):
+        return None
+
+    if len(sample) == 0:
+        return None
+    throughput = len(sample) / max(transfer_time, 1e-6)
+    return MirrorResult(server, latency, throughput, last_sync)
+
+
+async def probe_mirrors(
+    servers: list[str],
+    timeout: float = PROBE_TIMEOUT,
+    concurrency: int = MAX_CONCURRENT_PROBES,
+    sample_size: int = SAMPLE_SIZE,
+) -> list[MirrorResult]:
+    """Probe all given mirrors concurrently, return results for those which responded in time."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(server: str) -> Optional[MirrorResult]:
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(probe_mirror(server, sample_size), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+    results = await asyncio.gather(*(probe(server) for server in servers))
+    return [result for result in results if result is not None]
+
+
+def rank_results(results: list[MirrorResult], max_sync_lag: int = MAX_SYNC_LAG) -> list[MirrorResult]:
+    """Drop out of sync mirrors and sort the rest from the fastest one."""
+    if len(results) == 0:
+        return []
+    newest_sync = max(result.last_sync for result in results)
+    in_sync = [result for result in results if newest_sync - result.last_sync <= max_sync_lag]
+    return sorted(in_sync, key=lambda result: result.score)
+
+
+def _load_cached_ranking(cache_file: Path, ttl: int) -> Optional[list[str]]:
+    try:
+        cached = json.loads(cache_file.read_text())
+    except (OSError, ValueError):
+        return None
+    if time.time() - cached.get("timestamp", 0) > ttl:
+        return None
+    return cached.get("servers") or None
+
+
+def _store_ranking(cache_file: Path, servers: list[str]) -> None:
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        cache_file.write_text(json.dumps({"timestamp": time.time(), "servers": servers}))
+    except OSError:
+        print(f"{constants.WARN_COLOR}Unable to store mirror ranking cache to {cache_file}")
+
+
+def rank_mirrors(
+    mirrorlist: Path = constants.MIRRORLIST,
+    cache_file: Path = constants.CACHE_DIR / "mirrors.json",
+    ttl: int = constants.MIRROR_CACHE_TTL,
+    keep: int = KEEP_MIRRORS,
+) -> list[str]:
+    """
+    Rank the mirrors from given mirrorlist and write the best of them back to it.
+
+    The ranking is cached for `ttl` seconds, so that repeated installs skip the probing.
+    Return the ranked servers (empty if ranking failed, in which case the mirrorlist is untouched).
+    """
+    servers = _load_cached_ranking(cache_file, ttl)
+    if servers is not None:
+        print(f"{constants.NOTE_COLOR}Using cached mirror ranking from {cache_file}")
+    else:
+        candidates = read_mirrorlist(mirrorlist)
+        if len(candidates) < keep:
+            # Nothing much to choose from (e.g. the stock mirrorlist has every server commented out)
+            commented = [server for server in read_mirrorlist(mirrorlist, include_commented=True)
+                         if server not in candidates]
+            candidates += commented[:max(MAX_CANDIDATES - len(candidates), 0)]
+        print(f"{constants.NOTE_COLOR}Ranking {len(candidates)} mirrors...")
+        results = rank_results(asyncio.run(probe_mirrors(candidates)))
+        if len(results) == 0:
+            print(f"{constants.WARN_COLOR}No usable mirrors found while ranking, keeping the original mirrorlist.")
+            return []
+
+        servers = [result.server for result in results[:keep]]
+        _store_ranking(cache_file, servers)
+        print(f"{constants.INFO_COLOR}Fastest mirrors:")
+        for result in results[:keep]:
+            print(
+                f"    {result.server} (latency: {result.latency * 1000:.0f}ms, "
+                f"throughput: {result.throughput / 1024:.0f}KiB/s)"
+            )
+
+    commands.write_root_file(mirrorlist, format_mirrorlist(servers))
+    return servers
@@ -0,0 +1,123 @@
+"""
+Native implementations of small system operations, done with syscalls instead of spawning commands.
+
+Every operation here has a command line equivalent, which the callers fall back to whenever
+the native way isn't available (missing device node, insufficient permissions, ...). Operations
+which change the system are never done natively while an install plan is being recorded, so that
+the plan gets the command instead.
+"""
+import fcntl
+import os
+import shutil
+import socket
+import struct
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from lib import installplan, linkwatch, tracing
+
+RFKILL_DEVICE = Path("/dev/rfkill")
+
+# Event layout and operations from linux/rfkill.h, newer kernels append fields we don't need
+RFKILL_EVENT = struct.Struct("=IBBBB")
+RFKILL_EVENT_SIZE_MAX = 64
+RFKILL_OP_ADD = 0
+RFKILL_OP_CHANGE_ALL = 3
+RFKILL_TYPES = ["all", "wlan", "bluetooth", "uwb", "wimax", "wwan", "gps", "fm", "nfc"]
+
+# Interface flag ioctls from linux/sockios.h, `struct ifreq` is the name followed by a union of 24 bytes
+SIOCGIFFLAGS = 0x8913
+SIOCSIFFLAGS = 0x8914
+IFREQ_FLAGS = struct.Struct("=16sH22x")
+
+
+def which(executable: str) -> Optional[str]:
+    """Find given executable in PATH, return its path or `None` if it isn't there."""
+    return shutil.which(executable)
+
+
+class RfkillDevice(NamedTuple):
+    index: int
+    name: str
+    type: str
+    soft_blocked: bool
+    hard_blocked: bool
+
+
+def _rfkill_name(index: int) -> str:
+    try:
+        return Path(f"/sys/class/rfkill/rfkill{index}/name").read_text().strip()
+    except OSError:
+        return f"rfkill{index}"
+
+
+def read_rfkill() -> Optional[list[RfkillDevice]]:
+    """
+    Get the RF-KILL switches with their state, from the events of /dev/rfkill.
+
+    Opening the device makes the kernel queue an ADD event for every existing switch.
+    Return `None` if the device can't be read (the caller should use the `rfkill` command).
+    """
+    try:
+        fd = os.open(RFKILL_DEVICE, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return None
+
+    devices = {}
+    try:
+        while True:
+            try:
+                data = os.read(fd, RFKILL_EVENT_SIZE_MAX)
+            except BlockingIOError:
+                break
+            if len(data) < RFKILL_EVENT.size:
+                break
+            index, type_, op, soft, hard = RFKILL_EVENT.unpack_from(data)
+            if op != RFKILL_OP_ADD:
+                continue
+            type_name = RFKILL_TYPES[type_] if type_ < len(RFKILL_TYPES) else str(type_)
+            devices[index] = RfkillDevice(index, _rfkill_name(index), type_name, bool(soft), bool(hard))
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    return list(devices.values())
+
+
+def rfkill_unblock(type_name: str) -> bool:
+    """Soft-unblock all RF-KILL switches of given type, return whether it could be done natively."""
+    if installplan.is_active() or type_name not in RFKILL_TYPES:
+        return False
+    try:
+        fd = os.open(RFKILL_DEVICE, os.O_WRONLY)
+    except OSError:
+        return False
+    try:
+        with tracing.span(f"rfkill unblock {type_name}", tracing.COMMAND, native=True):
+            event = RFKILL_EVENT.pack(0, RFKILL_TYPES.index(type_name), RFKILL_OP_CHANGE_ALL, 0, 0)
+            return os.write(fd, event) == len(event)
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def set_link_up(interface_name: str) -> bool:
+    """Set the UP flag of given interface with ioctls, return whether it could be done natively."""
+    if installplan.is_active():
+        return False
+    name = interface_name.encode()
+    if len(name) >= 16:
+        return False
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            with tracing.span(f"ip link set {interface_name} up", tracing.COMMAND, native=True):
+                request = fcntl.ioctl(sock, SIOCGIFFLAGS, IFREQ_FLAGS.pack(name, 0))
+                _, flags = IFREQ_FLAGS.unpack(request)
+                if flags & linkwatch.IFF_UP:
+                    return True
+                fcntl.ioctl(sock, SIOCSIFFLAGS, IFREQ_FLAGS.pack(name, flags | linkwatch.IFF_UP))
+    except OSError:
+        # Most likely lack of CAP_NET_ADMIN when not running as root, the command escalates
+        return False
+    return True
@@ -0,0 +1,225 @@
+"""
+Offline installs, from a local package repository built out of cached packages.
+
+The packages come from a directory (by default the shared package cache) or from a partition
+(e.g. a second partition of the install USB stick), which gets mounted read-only. A repository
+database is built for them unless the source already has one. Before installing, the whole
+dependency closure of the packages is checked against the database, so that a missing package
+is reported up front instead of failing pacstrap halfway through.
+"""
+import re
+import shlex
+import shutil
+import tarfile
+import tempfile
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from lib import commands, constants, installplan
+
+REPO_NAME = "archdeploy-offline"
+# Where the repository is built when the source doesn't have one (packages are linked, it may be read-only)
+REPO_DIR = constants.CACHE_DIR / "offline-repo"
+# Where a source partition is mounted (outside of /mnt, that's where the new system goes)
+SOURCE_MOUNTPOINT = Path("/run/archdeploy-offline")
+
+PACKAGE_MARKER = ".pkg.tar."
+DEPENDENCY_NAME_RE = re.compile(r"^[^<>=]+")
+
+
+class PackageFile(NamedTuple):
+    name: str
+    version: str
+    arch: str
+    path: Path
+
+
+def parse_package_filename(path: Path) -> Optional[PackageFile]:
+    """Parse `name-pkgver-pkgrel-arch.pkg.tar.*` package file names, `None` for other files."""
+    if PACKAGE_MARKER not in path.name or path.name.endswith((".sig", ".part")):
+        return None
+    parts = path.name.split(PACKAGE_MARKER, 1)[0].rsplit("-", 3)
+    if len(parts) != 4:
+        return None
+    name, pkgver, pkgrel, arch = parts
+    return PackageFile(name, f"{pkgver}-{pkgrel}", arch, path)
+
+
+def select_packages(directory: Path) -> list[PackageFile]:
+    """Get the package files in given directory, only the newest one of each package."""
+    newest: dict[str, PackageFile] = {}
+    for path in directory.iterdir():
+        package = parse_package_filename(path)
+        if package is None:
+            continue
+        # Caches keep older versions too, the most recently downloaded one is the newest
+        # (comparing the versions properly would need vercmp for every pair)
+        current = newest.get(package.name)
+        if current is None or path.stat().st_mtime > current.path.stat().st_mtime:
+            newest[package.name] = package
+    return sorted(newest.values())
+
+
+def find_database(directory: Path) -> Optional[Path]:
+    """Get the repository database already present in given directory, if there is one."""
+    databases = sorted(directory.glob("*.db"))
+    return databases[0] if databases else None
+
+
+def build_repo(source: Path, repo_dir: Path = REPO_DIR) -> Path:
+    """Build a repository (database and links to the packages) for the packages in `source`, return the database."""
+    packages = select_packages(source)
+    if len(packages) == 0:
+        raise FileNotFoundError(f"There are no packages in {source}")
+    print(f"{constants.NOTE_COLOR}Building a repository of {len(packages)} packages from {source}...")
+
+    files = [
+        path for package in packages
+        for path in (package.path, package.path.with_name(package.path.name + ".sig")) if path.exists()
+    ]
+    if installplan.is_active():
+        # The plan runs elsewhere, the repository has to be built there
+        commands.run_cmd(
+            f"rm -rf {shlex.quote(str(repo_dir))} && mkdir -p {shlex.quote(str(repo_dir))} && "
+            + shlex.join(["ln", "-s", *(str(path.resolve()) for path in files), str(repo_dir)])
+        )
+    else:
+        shutil.rmtree(repo_dir, ignore_errors=True)
+        repo_dir.mkdir(parents=True)
+        for path in files:
+            (repo_dir / path.name).symlink_to(path.resolve())
+    links = [str(repo_dir / package.path.name) for package in packages]
+
+    database = repo_dir / f"{REPO_NAME}.db.tar.gz"
+    proc = commands.run_cmd(shlex.join(["repo-add", "--quiet", str(database), *links]))
+    if proc.returncode != 0:
+        raise OSError(f"Unable to build the repository database in {repo_dir}")
+    return repo_dir / f"{REPO_NAME}.db"
+
+
+class RepoPackage(NamedTuple):
+    name: str
+    version: str
+    depends: list[str]
+    provides: list[str]
+    groups: list[str]
+
+
+def parse_desc(text: str) -> dict[str, list[str]]:
+    """Parse a `desc` file of a repository database (`%FIELD%` lines followed by the values)."""
+    fields: dict[str, list[str]] = {}
+    values: Optional[list[str]] = None
+    for line in text.splitlines():
+        if len(line) > 2 and line.startswith("%") and line.endswith("%"):
+            values = fields.setdefault(line[1:-1], [])
+        elif line and values is not None:
+            values.append(line)
+    return fields
+
+
+def _to_package(fields: dict[str, list[str]]) -> RepoPackage:
+    return RepoPackage(
+        name=fields["NAME"][0],
+        version=fields.get("VERSION", [""])[0],
+        depends=fields.get("DEPENDS", []),
+        provides=fields.get("PROVIDES", []),
+        groups=fields.get("GROUPS", []),
+    )
+
+
+def read_database(database: Path) -> dict[str, RepoPackage]:
+    """Read the packages of a repository database, keyed by their names."""
+    descs = []
+    try:
+        with tarfile.open(database.resolve()) as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith("/desc"):
+                    file = tar.extractfile(member)
+                    assert file is not None
+                    descs.append(file.read().decode(errors="replace"))
+    except tarfile.ReadError:
+        # Compressions which tarfile doesn't support (zstd)
+        with tempfile.TemporaryDirectory(prefix="archdeploy-db-") as tmp_dir:
+            proc = commands.run_cmd(
+                shlex.join(["bsdtar", "-xf", str(database), "-C", tmp_dir]), capture_out=True, read_only=True
+            )
+            if proc.returncode != 0:
+                raise OSError(f"Unable to read the repository database {database}")
+            descs = [path.read_text(errors="replace") for path in Path(tmp_dir).glob("*/desc")]
+
+    packages = [_to_package(parse_desc(desc)) for desc in descs]
+    return {package.name: package for package in packages}
+
+
+def dependency_name(dependency: str) -> str:
+    """Strip the version constraint from a dependency (`glibc>=2.38` to `glibc`)."""
+    match = DEPENDENCY_NAME_RE.match(dependency)
+    return match[0] if match else dependency
+
+
+def find_missing(packages: dict[str, RepoPackage], requested: list[str]) -> dict[str, list[str]]:
+    """
+    Get the dependencies in the closure of the requested packages (or groups) which no package satisfies.
+
+    Return them along with the packages requiring them. Version constraints aren't checked,
+    the repository only holds a single version of each package anyway.
+    """
+    providers = {name: name for name in packages}
+    groups: dict[str, list[str]] = {}
+    for package in packages.values():
+        for provided in package.provides:
+            providers.setdefault(dependency_name(provided), package.name)
+        for group in package.groups:
+            groups.setdefault(group, []).append(package.name)
+
+    missing: dict[str, list[str]] = {}
+    pending = [(name, "requested") for request in requested for name in groups.get(request, [request])]
+    seen: set[str] = set()
+    while pending:
+        dependency, required_by = pending.pop()
+        provider = providers.get(dependency_name(dependency))
+        if provider is None:
+            missing.setdefault(dependency, []).append(required_by)
+        elif provider not in seen:
+            seen.add(provider)
+            pending.extend((child, provider) for child in packages[provider].depends)
+    return missing
+
+
+def mount_source(device: Path, mountpoint: Path = SOURCE_MOUNTPOINT) -> Path:
+    """Mount the partition holding the packages read-only."""
+    commands.run_root_cmd(["mkdir", "-p", str(mountpoint)])
+    if commands.run_root_cmd(["mount", "-o", "ro", str(device), str(mountpoint)]).returncode != 0:
+        raise OSError(f"Unable to mount {device} with the offline packages")
+    return mountpoint
+
+
+def prepare_repo(source: Path, packages: list[str] = constants.BASE_PACKAGES) -> Path:
+    """
+    Get the repository database with the packages from `source` (a directory or a partition).
+
+    Raise `OSError` if some of the packages or their dependencies aren't there.
+    """
+    is_partition = source.resolve().is_block_device()
+    if is_partition and installplan.is_active():
+        raise OSError(
+            f"Can't plan an offline install from partition {source}, its packages are only known once mounted"
+        )
+    directory = mount_source(source) if is_partition else source
+    database = find_database(directory)
+    if database is None:
+        database = build_repo(directory)
+        if installplan.is_active():
+            print(f"{constants.NOTE_COLOR}The offline repository is built when the plan runs, it can't be checked now")
+            return database
+    else:
+        print(f"{constants.NOTE_COLOR}Using the repository {database}")
+
+    missing = find_missing(read_database(database), packages)
+    if missing:
+        print(f"{constants.ERROR_COLOR}The offline repository is missing these packages:")
+        for dependency, required_by in sorted(missing.items()):
+            print(f"    {dependency} {constants.NOTE_COLOR}(required by {', '.join(sorted(set(required_by)))})")
+        raise OSError(f"{len(missing)} packages are missing from the offline repository")
+    print(f"{constants.SUCCESS_COLOR}All of the packages and their dependencies are in the offline repository.")
+    return database
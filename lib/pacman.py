@@ -0,0 +1,143 @@
+import shlex
+import sys
+from pathlib import Path
+from typing import Optional
+
+from lib import commands, constants, installplan, terminal
+
+DEFAULT_CACHE_DIR = Path("/var/cache/pacman/pkg")
+# Packages of offline repositories are verified with their .sig files, the database is built locally and unsigned.
+# The keyring of the live system can't be refreshed without network, if it's too old for the packages,
+# verification can be turned off explicitly.
+OFFLINE_SIG_LEVEL = "Never" if constants.OFFLINE_SKIP_SIGNATURES else "Required DatabaseOptional"
+
+
+def set_options(config: str, options: dict[str, list[str]]) -> str:
+    """
+    Set given options in the `[options]` section of a pacman config.
+
+    Existing (including commented out) occurrences of the options are replaced,
+    options which can appear multiple times (like CacheDir) are passed as multiple values.
+    """
+    lines = config.splitlines()
+    output: list[str] = []
+    section = None
+    inserted = False
+
+    def option_lines() -> list[str]:
+        return [f"{key} = {value}" for key, values in options.items() for value in values]
+
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith("[") and stripped.endswith("]"):
+            if section == "options" and not inserted:
+                output.extend(option_lines())
+                inserted = True
+            section = stripped[1:-1]
+            output.append(line)
+            continue
+
+        if section == "options":
+            key = stripped.lstrip("#").split("=", 1)[0].strip()
+            if key in options:
+                # Put all of the values where the first occurrence of the option was
+                if not inserted:
+                    output.extend(option_lines())
+                    inserted = True
+                continue
+        output.append(line)
+
+    if not inserted:
+        if section == "options":
+            output.extend(option_lines())
+        else:
+            # There's no [options] section at all, add one
+            output[0:0] = ["[options]", *option_lines()]
+    return "\n".join(output) + "\n"
+
+
+def remove_repositories(config: str) -> str:
+    """Remove all repository sections (everything but `[options]`) from a pacman config."""
+    output = []
+    section = None
+    for line in config.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("[") and stripped.endswith("]"):
+            section = stripped[1:-1]
+        if section in (None, "options"):
+            output.append(line)
+    return "\n".join(output) + "\n"
+
+
+def make_config(
+    parallel_downloads: int = constants.PARALLEL_DOWNLOADS,
+    cache_dir: Optional[Path] = constants.PACKAGE_CACHE_DIR,
+    base_config: Path = constants.PACMAN_CONF,
+    offline_repo: Optional[Path] = None,
+) -> str:
+    """
+    Make a pacman config for installing the new system, based on the host's config.
+
+    The shared `cache_dir` comes first, so that packages are downloaded there,
+    the default cache is still kept to reuse packages already present on the host.
+    With `offline_repo` (a repository database), it's the only repository in the config.
+    """
+    options = {"ParallelDownloads": [str(parallel_downloads)]}
+    if cache_dir is not None:
+        options["CacheDir"] = [f"{cache_dir}/", f"{DEFAULT_CACHE_DIR}/"]
+    config = base_config.read_text()
+    if offline_repo is None:
+        return set_options(config, options)
+
+    repo_name = offline_repo.name.removesuffix(".db")
+    return (
+        set_options(remove_repositories(config), options).rstrip("\n")
+        + f"\n\n[{repo_name}]\nSigLevel = {OFFLINE_SIG_LEVEL}\nServer = file://{offline_repo.parent.resolve()}\n"
+    )
+
+
+def write_install_config(path: Path = constants.CACHE_DIR / "pacman.conf", **kwargs) -> Path:
+    """Write the pacman config profile used for pacstrap."""
+    if installplan.is_active():
+        # The plan runs elsewhere, it has to carry the config along
+        commands.run_root_cmd(["mkdir", "-p", str(path.parent)])
+        commands.write_root_file(path, make_config(**kwargs))
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(make_config(**kwargs))
+    return path
+
+
+def pacstrap(
+    root: Path,
+    packages: list[str] = constants.BASE_PACKAGES,
+    config: Optional[Path] = None,
+    cache_dir: Path = constants.PACKAGE_CACHE_DIR,
+):
+    """Install given packages into `root`, using the managed pacman config and the shared package cache."""
+    if config is None:
+        config = write_install_config(cache_dir=cache_dir)
+    commands.run_root_cmd(f"mkdir -p {shlex.quote(str(cache_dir))}")
+
+    # -c makes pacstrap use the cache from the config instead of the target's cache
+    proc = commands.stream_cmd(["pacstrap", "-C", str(config), "-c", str(root), *packages], root=True)
+    sys.stdout.write(constants.RESET_COLOR)
+    with terminal.busy():
+        for line in proc:
+            print(line)
+
+    if proc.returncode != 0:
+        print(f"{constants.ERROR_COLOR}pacstrap failed with exit code {proc.returncode}, last output:")
+        for line in proc.tail:
+            print(f"    {line}")
+        print(f"{constants.NOTE_COLOR}Full output was logged to {constants.INSTALL_LOG}")
+    return proc
+
+
+def configure_target(root: Path, parallel_downloads: int = constants.PARALLEL_DOWNLOADS):
+    """Carry the download settings over to pacman config of the installed system."""
+    target_config = root / constants.PACMAN_CONF.relative_to("/")
+    # When planning, nothing was installed yet, the stock config of the target is the same as the host's one
+    source = constants.PACMAN_CONF if installplan.is_active() else target_config
+    config = set_options(source.read_text(), {"ParallelDownloads": [str(parallel_downloads)]})
+    return commands.write_root_file(target_config, config)
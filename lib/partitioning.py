@@ -0,0 +1,322 @@
+import json
+import math
+import os
+import re
+import shlex
+import sys
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from lib import commands, constants, filesystems, installplan, inventory, rawimage
+
+MIB = 1024 ** 2
+# Partitions are always aligned to at least 1MiB, which is what most tools default to
+MIN_ALIGNMENT = MIB
+# Space reserved at the end of the disk for the backup GPT header and partition entries
+GPT_BACKUP_SIZE = 33 * 512
+
+# GPT partition type GUIDs
+TYPE_EFI = "C12A7328-F81F-11D2-BA4B-00A0C93EC93B"
+TYPE_BIOS_BOOT = "21686148-6449-6E6F-744E-656564454649"
+TYPE_SWAP = "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F"
+TYPE_LINUX = "0FC63DAF-8483-4772-8E79-3D69D8477DE4"
+# Discoverable partitions specification types, used to find mountpoints of partitions in cloned images
+TYPE_ROOT_X86_64 = "4F68BCE3-E8CD-4DB1-96E7-FBCAF984B709"
+TYPE_HOME = "933AC7E1-2EB4-4F13-B844-0E14E2AEF915"
+TYPE_SRV = "3B8F8425-20E0-4F3B-907F-1A25A76F98E8"
+TYPE_VAR = "4D21B016-B534-45C2-A9FB-5C16E091FD2D"
+DISCOVERABLE_MOUNTPOINTS = {
+    TYPE_ROOT_X86_64: Path("/"),
+    TYPE_HOME: Path("/home"),
+    TYPE_SRV: Path("/srv"),
+    TYPE_VAR: Path("/var"),
+}
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": MIB, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+class DeviceGeometry(NamedTuple):
+    size: int  # bytes
+    logical_block_size: int = 512
+    physical_block_size: int = 512
+    minimum_io_size: int = 512
+    optimal_io_size: int = 0
+    alignment_offset: int = 0
+
+    @property
+    def alignment(self) -> int:
+        """Get the alignment (in bytes) to use for partition boundaries."""
+        io_size = self.optimal_io_size or self.minimum_io_size or self.physical_block_size
+        return math.lcm(MIN_ALIGNMENT, io_size, self.logical_block_size)
+
+
+class PartitionSpec(NamedTuple):
+    """Declarative description of a partition, `size` of `None` means the rest of the disk."""
+    size: Optional[int]
+    mountpoint: Optional[Path] = None
+    is_swap: bool = False
+    is_efi: bool = False
+    is_bios_boot: bool = False
+    name: Optional[str] = None
+    filesystem: Optional[str] = None
+
+    @property
+    def type(self) -> str:
+        if self.is_efi:
+            return TYPE_EFI
+        if self.is_bios_boot:
+            return TYPE_BIOS_BOOT
+        if self.is_swap:
+            return TYPE_SWAP
+        return TYPE_LINUX
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PartitionSpec":
+        """Make a spec from a dict (like from the answer file), e.g. `{"size": "512M", "mountpoint": "/boot"}`."""
+        mountpoint = data.get("mountpoint")
+        return cls(
+            size=parse_size(data.get("size")),
+            mountpoint=None if mountpoint is None else Path(mountpoint),
+            is_swap=data.get("swap", False),
+            is_efi=data.get("efi", False),
+            is_bios_boot=data.get("bios_boot", False),
+            name=data.get("name"),
+            filesystem=data.get("filesystem"),
+        )
+
+
+class PlannedPartition(NamedTuple):
+    number: int
+    start: int  # sectors
+    size: int  # sectors
+    spec: PartitionSpec
+
+
+def parse_size(size: Optional[str]) -> Optional[int]:
+    """Parse a size like `512M` or `8G` into bytes, `None`, `"rest"` and `"100%"` mean the rest of the disk."""
+    if size is None or str(size).lower() in ("rest", "100%"):
+        return None
+    match = re.fullmatch(r"\s*(\d+)\s*([KMGT]?)(?:i?B)?\s*", str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size: {size!r}")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+
+
+def _read_int(path: Path, default: int) -> int:
+    try:
+        return int(path.read_text().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def is_block_device(device: Path) -> bool:
+    """Check if given device is a block device, anything else is treated as an image file."""
+    return device.resolve().is_block_device()
+
+
+def read_geometry(device: Path) -> DeviceGeometry:
+    """Read the I/O geometry of given block device from sysfs (image files get the defaults)."""
+    device = device.resolve()
+    if not is_block_device(device):
+        return DeviceGeometry(size=device.stat().st_size)
+
+    sys_path = Path("/sys/class/block", device.name)
+    queue = sys_path / "queue"
+    return DeviceGeometry(
+        # Size in sysfs is always in 512 byte sectors, independent of the block size
+        size=_read_int(sys_path / "size", 0) * 512,
+        logical_block_size=_read_int(queue / "logical_block_size", 512),
+        physical_block_size=_read_int(queue / "physical_block_size", 512),
+        minimum_io_size=_read_int(queue / "minimum_io_size", 512),
+        optimal_io_size=_read_int(queue / "optimal_io_size", 0),
+        alignment_offset=_read_int(sys_path / "alignment_offset", 0),
+    )
+
+
+def compute_layout(geometry: DeviceGeometry, specs: list[PartitionSpec]) -> list[PlannedPartition]:
+    """Compute aligned partition boundaries for given specs, in the order they were given."""
+    alignment = geometry.alignment
+    sector = geometry.logical_block_size
+
+    def align_up(offset: int) -> int:
+        # alignment_offset is where the device's natural alignment starts, it only applies to positions
+        return math.ceil((offset - geometry.alignment_offset) / alignment) * alignment + geometry.alignment_offset
+
+    def align_down(offset: int) -> int:
+        return math.floor((offset - geometry.alignment_offset) / alignment) * alignment + geometry.alignment_offset
+
+    def round_size(size: int) -> int:
+        # Sizes are whole multiples of the alignment, so that every following start stays aligned
+        return math.ceil(size / alignment) * alignment
+
+    usable_end = align_down(geometry.size - GPT_BACKUP_SIZE)
+    if sum(1 for spec in specs if spec.size is None) > 1:
+        raise ValueError("Only a single partition can take the rest of the disk")
+
+    fixed_size = sum(round_size(spec.size) for spec in specs if spec.size is not None)
+    offset = align_up(MIN_ALIGNMENT)
+    rest_size = usable_end - offset - fixed_size
+
+    planned = []
+    for number, spec in enumerate(specs, start=1):
+        size = round_size(spec.size) if spec.size is not None else rest_size // alignment * alignment
+        if size <= 0 or offset + size > usable_end:
+            raise ValueError(f"Partitions don't fit on the device ({geometry.size // MIB}MiB)")
+        planned.append(PlannedPartition(number, offset // sector, size // sector, spec))
+        offset += size
+    return planned
+
+
+def make_sfdisk_script(layout: list[PlannedPartition]) -> str:
+    """Make an sfdisk script creating a new GPT partition table with given partitions."""
+    lines = ["label: gpt"]
+    for partition in layout:
+        line = f"start={partition.start}, size={partition.size}, type={partition.spec.type}"
+        if partition.spec.name is not None:
+            line += f', name="{partition.spec.name}"'
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def partition_path(device: Path, number: int) -> Path:
+    """Get the path of n-th partition on given device (`/dev/sda1`, `/dev/nvme0n1p1`, `/dev/loop0p1`)."""
+    separator = "p" if device.name[-1].isdigit() else ""
+    return device.with_name(f"{device.name}{separator}{number}")
+
+
+def partition_number(node: str) -> int:
+    """Get the number of a partition from its device path (`/dev/nvme0n1p3` is 3)."""
+    match = re.search(r"(\d+)$", node)
+    if match is None:
+        raise ValueError(f"Not a partition: {node}")
+    return int(match.group(1))
+
+
+def default_layout(swap_size: Optional[int] = None, root_filesystem: Optional[str] = None) -> list[PartitionSpec]:
+    """Get the default layout: boot partition (EFI or BIOS boot for GRUB), optional swap and root."""
+    specs = []
+    if constants.IS_EFI:
+        specs.append(PartitionSpec(512 * MIB, mountpoint=Path("/boot"), is_efi=True, name="EFI"))
+    else:
+        specs.append(PartitionSpec(MIB, is_bios_boot=True, name="BIOS boot"))
+    if swap_size is not None:
+        specs.append(PartitionSpec(swap_size, is_swap=True, name="swap"))
+    specs.append(PartitionSpec(None, mountpoint=Path("/"), name="root", filesystem=root_filesystem))
+    return specs
+
+
+def attach_image(image: Path) -> Path:
+    """Attach an image file to a loop device (scanning its partitions), return the loop device."""
+    if installplan.is_active():
+        raise OSError(f"Can't plan an install onto image file {image}, its loop device is only known once attached")
+    proc = commands.run_root_cmd(f"losetup --find --show --partscan {shlex.quote(str(image))}", capture_out=True)
+    if proc.returncode != 0 or proc.stdout is None:
+        raise OSError(f"Unable to attach {image} to a loop device")
+    inventory.invalidate()
+    return Path(proc.stdout.decode().strip())
+
+
+def apply_layout(device: Path, layout: list[PlannedPartition]) -> Path:
+    """
+    Write the whole partition table in a single sfdisk run.
+
+    Image files are attached to a loop device afterwards, return the device holding the partitions.
+    """
+    # The script is passed inline, so that the command stays complete when it's recorded into an install plan
+    proc = commands.run_root_cmd(
+        f"sfdisk --wipe always --wipe-partitions always {shlex.quote(str(device))} "
+        + installplan.heredoc(make_sfdisk_script(layout))
+    )
+    if proc.returncode != 0:
+        raise OSError(f"sfdisk failed to partition {device}")
+
+    if not is_block_device(device):
+        return attach_image(device)
+    # Make sure udev created the device nodes for the new partitions before anyone uses them
+    commands.run_root_cmd("udevadm settle", enable_debug=False)
+    inventory.invalidate()
+    return device
+
+
+def read_partition_table(device: Path) -> list[dict]:
+    """Get the partitions on given device as reported by sfdisk (`node`, `start`, `size`, `type`, ...)."""
+    proc = commands.run_root_cmd(
+        ["sfdisk", "--json", str(device)], capture_out=True, enable_debug=False, read_only=True
+    )
+    if proc.returncode != 0 or proc.stdout is None:
+        raise OSError(f"Unable to read the partition table of {device}")
+    return json.loads(proc.stdout)["partitiontable"].get("partitions", [])
+
+
+def blkid_type(device: Path) -> Optional[str]:
+    """Get the type of the filesystem on given device (`ext4`, `vfat`, ...), `None` if it has none."""
+    proc = commands.run_root_cmd(
+        ["blkid", "-o", "value", "-s", "TYPE", str(device)], capture_out=True, enable_debug=False, read_only=True
+    )
+    if proc.returncode != 0 or proc.stdout is None:
+        return None
+    return proc.stdout.decode().strip() or None
+
+
+def _reread_partitions(device: Path) -> Path:
+    """Let the kernel know about changed partitions, return the device holding them (a loop device for images)."""
+    if not is_block_device(device):
+        return attach_image(device)
+    commands.run_root_cmd(["partx", "--update", str(device)], enable_debug=False)
+    commands.run_root_cmd("udevadm settle", enable_debug=False)
+    inventory.invalidate()
+    return device
+
+
+def grow_last_partition(device: Path) -> Path:
+    """
+    Grow the last partition (and the filesystem on it) to the end of the device.
+
+    Return the device holding the partitions (a loop device for images).
+    """
+    device_arg = shlex.quote(str(device))
+    # The backup GPT header is where the image ended, move it to the real end of the device first
+    commands.run_root_cmd(f"sfdisk --relocate gpt-bak-std {device_arg}")
+    partitions = read_partition_table(device)
+    if len(partitions) == 0:
+        return _reread_partitions(device)
+
+    # Partition numbers needn't follow the order on the disk (or be contiguous)
+    last = max(partitions, key=lambda partition: partition["start"])
+    number = partition_number(last["node"])
+    proc = commands.run_root_cmd(f"echo ', +' | sfdisk --no-reread --no-tell-kernel -N {number} {device_arg}")
+    if proc.returncode != 0:
+        raise OSError(f"Unable to grow partition {number} on {device}")
+
+    partitioned_device = _reread_partitions(device)
+    partition = partition_path(partitioned_device, number)
+    fstype = blkid_type(partition)
+    filesystem = filesystems.find_by_fstype(fstype) if fstype is not None else None
+    if filesystem is not None:
+        print(f"{constants.NOTE_COLOR}Growing {fstype} filesystem on {partition}...")
+        if any(proc.returncode != 0 for proc in filesystem.grow(partition)):
+            print(f"{constants.WARN_COLOR}Unable to grow the filesystem on {partition}, it keeps its original size")
+    return partitioned_device
+
+
+def write_raw_image(image: Path, device: Path, direct: bool = constants.DIRECT_IO) -> Path:
+    """
+    Write a raw disk image to the device (skipping its holes) and grow the last partition to fill it.
+
+    Return the device holding the partitions (a loop device for images).
+    """
+    if installplan.is_active():
+        raise OSError(f"Can't plan writing {image}, the partitions are only known once the image is written")
+    args = ["--direct"] if direct else []
+    if os.access(device, os.W_OK):
+        stats = rawimage.write_image(image, device, direct=direct)
+        print(
+            f"{constants.NOTE_COLOR}Wrote {stats.data_bytes // MIB}MiB of data, "
+            f"skipped {stats.hole_bytes // MIB}MiB of holes in {stats.duration:.2f}s ({stats.method})"
+        )
+        if not stats.holes_zeroed:
+            print(f"{constants.WARN_COLOR}{device} can't zero the holes of the image, they keep its previous content")
+    # The writer runs as root by itself, without the rest of the installer
+    elif commands.run_root_cmd([sys.executable, rawimage.__file__, *args, str(image), str(device)]).returncode != 0:
+        raise OSError(f"Writing {image} to {device} failed")
+    return grow_last_partition(device)
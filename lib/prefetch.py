@@ -0,0 +1,140 @@
+import atexit
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from lib import commands, constants, pacman, terminal
+
+# Minimal amount of seconds between two progress reports
+REPORT_INTERVAL = 15
+
+PACKAGES_COUNT_RE = re.compile(r"^Packages \((\d+)\)")
+DOWNLOADING_RE = re.compile(r"^\s*(\S+) downloading\.\.\.")
+
+
+class PackagePrefetcher(threading.Thread):
+    """
+    Download packages (with their whole dependency closure) into the package cache in the background.
+
+    The download uses `pacman -Syw` with a temporary, empty database, so that
+    dependencies which happen to be installed on the host are downloaded too,
+    and so that it never contends for the host's database lock. Pacstrap then
+    finds all of the packages in the shared cache.
+    """
+
+    def __init__(
+        self,
+        packages: list[str] = constants.BASE_PACKAGES,
+        cache_dir: Path = constants.PACKAGE_CACHE_DIR,
+        config: Optional[Path] = None,
+    ):
+        super().__init__(name="package-prefetch", daemon=True)
+        self.packages = packages
+        self.cache_dir = cache_dir
+        self.config = config
+        self.total: Optional[int] = None
+        self.downloaded = 0
+        self.returncode: Optional[int] = None
+        self.error: Optional[str] = None
+
+        self._proc: Optional[subprocess.Popen] = None
+        self._cancelled = threading.Event()
+        self._last_report = 0.0
+
+    @property
+    def progress(self) -> str:
+        total = "?" if self.total is None else self.total
+        return f"{self.downloaded}/{total} packages"
+
+    def _report(self, message: str, force: bool = False) -> None:
+        now = time.monotonic()
+        if force or now - self._last_report >= REPORT_INTERVAL:
+            # Messages suppressed by an active prompt are simply skipped, a later one will catch up
+            if terminal.print_status(f"[prefetch] {message}"):
+                self._last_report = now
+
+    def run(self) -> None:
+        root_prefix = commands.get_root_prefix(interactive=False)
+        if root_prefix is None:
+            self.error = "no way to run pacman as root without a password prompt"
+            return
+
+        if self.config is None:
+            self.config = pacman.write_install_config(
+                path=constants.CACHE_DIR / "pacman-prefetch.conf", cache_dir=self.cache_dir
+            )
+
+        dbpath = tempfile.mkdtemp(prefix="archdeploy-prefetch-")
+        argv = [
+            *root_prefix, "pacman", "-Syw", "--noconfirm",
+            "--dbpath", dbpath,
+            "--cachedir", str(self.cache_dir),
+            "--config", str(self.config),
+            *self.packages,
+        ]
+        try:
+            self._proc = subprocess.Popen(
+                argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+            )
+            # The process may have been cancelled before it even started
+            if self._cancelled.is_set():
+                self._proc.terminate()
+
+            assert self._proc.stdout is not None
+            for line in self._proc.stdout:
+                if match := PACKAGES_COUNT_RE.match(line):
+                    self.total = int(match.group(1))
+                elif DOWNLOADING_RE.match(line):
+                    self.downloaded += 1
+                    self._report(f"Downloaded {self.progress}")
+            self.returncode = self._proc.wait()
+        except OSError as exc:
+            self.error = str(exc)
+            return
+        finally:
+            # The database is owned by root, only the (shared) cache is kept
+            subprocess.run([*root_prefix, "rm", "-rf", dbpath], stdin=subprocess.DEVNULL)
+
+        if self._cancelled.is_set():
+            self.error = "cancelled"
+        elif self.returncode != 0:
+            self.error = f"pacman exited with code {self.returncode}"
+        else:
+            self._report(f"All {self.progress} downloaded", force=True)
+
+    def cancel(self) -> None:
+        """Stop the download, packages which were already downloaded are kept in the cache."""
+        self._cancelled.set()
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.terminate()
+
+    def wait(self) -> bool:
+        """Wait for the prefetch to finish, return whether all of the packages were downloaded."""
+        if self.is_alive():
+            print(f"{constants.NOTE_COLOR}Waiting for package prefetch to finish ({self.progress} so far)...")
+            self.join()
+        if self.error is not None:
+            print(
+                f"{constants.WARN_COLOR}Package prefetch didn't finish ({self.error}), "
+                "remaining packages will be downloaded by pacstrap."
+            )
+            return False
+        return True
+
+
+def start_prefetch(packages: list[str] = constants.BASE_PACKAGES) -> Optional[PackagePrefetcher]:
+    """Start prefetching given packages in the background."""
+    if shutil.which("pacman") is None:
+        return None
+
+    prefetcher = PackagePrefetcher(packages)
+    # Make sure we never leave a pacman process running behind us (e.g. on Ctrl+C)
+    atexit.register(prefetcher.cancel)
+    prefetcher.start()
+    print(f"{constants.NOTE_COLOR}Started downloading packages in the background.")
+    return prefetcher
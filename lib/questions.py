@@ -1,12 +1,110 @@
+import functools
+import inspect
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Callable, Optional, TypeVar
 
-from lib import constants
+from lib import answers, constants, terminal, tracing
+from lib.answers import MissingAnswerError, is_unattended  # noqa: F401 (re-exported)
+
+T = TypeVar("T")
 
 PREFIX = f"[{constants.CMD_COLOR}?{constants.RESET_COLOR}]{constants.QUESTION_COLOR}"
 PREFIX_FAIL = f"{constants.ERROR_COLOR}>>{constants.QUESTION_COLOR}"
 
 
+def _prompt(convert: Callable[..., Any], sequence: bool = True) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """
+    Make a question answerable from the answer file, using the `key` it's asked with.
+
+    In unattended mode, the answer is converted with `convert(answer, arguments)`, where
+    arguments are the arguments of the question. Questions without an answer fall back to the
+    default they're asked with, or fail instead of blocking if there's none. Otherwise the user
+    is asked, with the terminal marked as busy for the whole duration of the question, which is
+    also traced as user wait.
+    """
+    def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(message: str, *args, key: Optional[str] = None, **kwargs) -> T:
+            if answers.is_unattended():
+                arguments = signature.bind(message, *args, **kwargs)
+                # Only a default passed in by the caller, not the one from the signature (like `confirm`'s)
+                default = arguments.arguments.get("default")
+                arguments.apply_defaults()
+                source = "from answer file"
+                try:
+                    answer = answers.lookup(key, message, sequence)
+                except MissingAnswerError:
+                    if default is None:
+                        raise
+                    answer, source = default, "default"
+                try:
+                    value = convert(answer, arguments.arguments)
+                except (ValueError, TypeError) as exc:
+                    raise ValueError(f"Invalid answer for '{key}': {answer!r} ({exc})") from exc
+                print(f"{PREFIX} {message}: {constants.CMD_COLOR}{value}{constants.NOTE_COLOR} ({source})")
+                return value
+
+            with terminal.busy(), tracing.span(message, tracing.USER_WAIT, question=func.__name__):
+                return func(message, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _convert_text(answer: Any, arguments: dict) -> str:
+    return str(answer)
+
+
+def _convert_confirm(answer: Any, arguments: dict) -> bool:
+    if isinstance(answer, bool):
+        return answer
+    if str(answer).lower() in ("y", "yes"):
+        return True
+    if str(answer).lower() in ("n", "no"):
+        return False
+    raise ValueError("expected a boolean (or yes/no)")
+
+
+def _convert_choice(answer: Any, arguments: dict) -> Any:
+    choices = arguments["choices"]
+    for choice in choices:
+        if str(choice) == str(answer):
+            return choice
+    # Allow picking the choice by its (1-based) number, same as in interactive mode
+    if isinstance(answer, int) and len(choices) >= answer > 0:
+        return choices[answer - 1]
+    raise ValueError(f"expected one of {[str(choice) for choice in choices]}")
+
+
+def _convert_multi_choice(answer: Any, arguments: dict) -> list[Any]:
+    if not isinstance(answer, list):
+        answer = [answer]
+    return [_convert_choice(value, arguments) for value in answer]
+
+
+def _convert_device(answer: Any, arguments: dict) -> Path:
+    devices = arguments["devices"]
+    if isinstance(answer, int) and len(devices) >= answer > 0:
+        return devices[answer - 1].path
+    for device in devices:
+        if str(device.path) == str(answer):
+            return device.path
+    if arguments["allow_other"] and Path(answer).exists():
+        return Path(answer)
+    raise ValueError(f"expected one of {[str(device.path) for device in devices]}")
+
+
+def _convert_path(answer: Any, arguments: dict) -> Path:
+    value = Path(answer)
+    if arguments["exists"] and not value.exists():
+        raise ValueError(f"path {value} doesn't exist")
+    if arguments["make_absolute"]:
+        value = value.absolute()
+    return value
+
+
+@_prompt(_convert_text)
 def text(
         message: str,
         name: str = "value",
@@ -40,6 +138,7 @@ def text(
         return value
 
 
+@_prompt(_convert_confirm)
 def confirm(message: str, name: str = "value", default: bool = False) -> bool:
     suffix = "(y/N): " if default is False else "(Y/n): "
     while True:
@@ -54,6 +153,7 @@ def confirm(message: str, name: str = "value", default: bool = False) -> bool:
             print(f"{PREFIX_FAIL} {name} can only be y/n (yes/no).")
 
 
+@_prompt(_convert_choice)
 def choice(message: str, choices: list[Any], name: str = "choice") -> Any:
     str_choices = {str(choice): choice for choice in choices}
     option_lines = []
@@ -78,6 +178,7 @@ def choice(message: str, choices: list[Any], name: str = "choice") -> Any:
         )
 
 
+@_prompt(_convert_multi_choice, sequence=False)
 def multi_choice(message: str, choices: list[Any], name: str = "choice") -> list[Any]:
     str_choices = {str(choice): choice for choice in choices}
     option_lines = []
@@ -109,6 +210,38 @@ def multi_choice(message: str, choices: list[Any], name: str = "choice") -> list
             return picked
 
 
+@_prompt(_convert_device)
+def device(message: str, devices: list[Any], name: str = "device", allow_other: bool = True) -> Path:
+    """
+    Pick one of given devices (anything with `path` and `describe()`, like inventory block devices).
+
+    With `allow_other`, a path to some other existing device (or image file) can be typed in instead.
+    """
+    str_devices = {str(device.path): device for device in devices}
+    option_lines = []
+    for index, device in enumerate(devices):
+        option_lines.append(f"{index + 1}. - {device.describe()}")
+    if allow_other:
+        option_lines.append("Or enter a path to some other device")
+    option_text = "\n".join(option_lines)
+
+    while True:
+        print(option_text)
+        value = input(f"{PREFIX} {message}: ")
+
+        if value.isdigit():
+            int_value = int(value)
+            if len(devices) >= int_value > 0:
+                return devices[int_value - 1].path
+        if value in str_devices:
+            return str_devices[value].path
+        if allow_other and value != "" and Path(value).exists():
+            return Path(value).absolute()
+
+        print(f"{PREFIX_FAIL} Invalid input for {name}, expected 1-{len(devices)} or a device path.")
+
+
+@_prompt(_convert_path)
 def path(message: str, name: str = "path", exists: bool = True, make_absolute: bool = True) -> Path:
     while True:
         value = input(f"{PREFIX} {message}: ")
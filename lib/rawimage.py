@@ -0,0 +1,231 @@
+"""
+Sparse-aware raw disk image writer.
+
+Only the data ranges of the image (found with SEEK_DATA/SEEK_HOLE) are written,
+holes are skipped and, on block devices, zeroed or discarded by the device itself.
+Devices which can do neither keep their previous content in the holes (reported
+in the stats), which is fine for filesystems, but not for anything reading them raw.
+Data is copied in the kernel (copy_file_range, falling back to sendfile), or with
+large aligned buffers when O_DIRECT is requested.
+
+This module only depends on the standard library, since it's run directly as
+a script (as root) when the target device isn't writable by the installer:
+
+    python3 rawimage.py [--direct] [--no-discard] IMAGE TARGET
+"""
+import argparse
+import errno
+import fcntl
+import mmap
+import os
+import stat
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+# Size of a single copy, large enough to keep the device busy
+CHUNK_SIZE = 64 * 1024 ** 2
+# O_DIRECT needs buffers, offsets and sizes aligned to the logical block size, page size covers all sane devices
+DIRECT_ALIGNMENT = mmap.PAGESIZE
+
+# ioctls from linux/fs.h, taking a (start, length) pair of u64
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127F
+BLKGETSIZE64 = 0x80081272
+
+# Errors meaning that the copy method isn't supported between given files
+UNSUPPORTED_ERRNOS = {errno.EINVAL, errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF}
+
+
+class WriteStats(NamedTuple):
+    data_bytes: int
+    hole_bytes: int
+    method: str
+    duration: float
+    # Whether the holes read back as zeros (like from the image), or still hold whatever was on the device
+    holes_zeroed: bool = True
+
+
+def data_ranges(fd: int, size: int) -> Iterator[tuple[int, int]]:
+    """Get (offset, length) of all data ranges in the file, everything in between is a hole."""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as exc:
+            if exc.errno == errno.ENXIO:
+                # No more data after offset, the rest is a hole
+                return
+            if exc.errno in UNSUPPORTED_ERRNOS:
+                # Filesystem can't report holes, treat everything as data
+                yield offset, size - offset
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+def get_size(fd: int) -> int:
+    """Get the size of a file or a block device."""
+    if stat.S_ISBLK(os.fstat(fd).st_mode):
+        return struct.unpack("Q", fcntl.ioctl(fd, BLKGETSIZE64, b"\0" * 8))[0]
+    return os.fstat(fd).st_size
+
+
+def _copy_kernel(src: int, dst: int, offset: int, length: int, method: str) -> str:
+    """Copy a range without passing it through user space, return the method that worked."""
+    end = offset + length
+    while offset < end:
+        count = min(CHUNK_SIZE, end - offset)
+        if method == "copy_file_range":
+            try:
+                copied = os.copy_file_range(src, dst, count, offset, offset)
+            except OSError as exc:
+                if exc.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                # Block devices (and older kernels) don't support copy_file_range, sendfile splices instead
+                method = "sendfile"
+                continue
+        else:
+            os.lseek(dst, offset, os.SEEK_SET)
+            copied = os.sendfile(dst, src, offset, count)
+        if copied == 0:
+            raise OSError(errno.EIO, f"Unexpected end of image at {offset}")
+        offset += copied
+    return method
+
+
+def _copy_direct(src: int, dst: int, offset: int, length: int, buffer: mmap.mmap) -> None:
+    """Copy a range through an aligned buffer, `dst` has to be opened with O_DIRECT."""
+    end = offset + length
+    while offset < end:
+        count = min(len(buffer), end - offset)
+        view = memoryview(buffer)[:count]
+        read = os.preadv(src, [view], offset)
+        if read == 0:
+            raise OSError(errno.EIO, f"Unexpected end of image at {offset}")
+        os.pwrite(dst, view[:read], offset)
+        view.release()
+        offset += read
+
+
+def _read_queue_limit(device: Path, name: str) -> int:
+    try:
+        return int(Path("/sys/class/block", device.resolve().name, "queue", name).read_text())
+    except (OSError, ValueError):
+        return 0
+
+
+def get_clear_ioctls(device: Path, discard: bool) -> list[int]:
+    """
+    Get the ioctls which let the device clear a range itself, without any data being written.
+
+    Zeroing is preferred, since the range then reads back as zeros, as it would from the image.
+    It's only used when the device offloads it (otherwise the kernel writes zeros, like dd would).
+    Discarding leaves the content undefined, which is fine for blank drives.
+    """
+    ioctls = []
+    if _read_queue_limit(device, "write_zeroes_max_bytes") > 0:
+        ioctls.append(BLKZEROOUT)
+    if discard and _read_queue_limit(device, "discard_max_bytes") > 0:
+        ioctls.append(BLKDISCARD)
+    return ioctls
+
+
+def _clear_range(fd: int, offset: int, length: int, ioctls: list[int]) -> bool:
+    """Let the device clear a range with the first of the ioctls it supports, return if it reads as zeros now."""
+    argument = struct.pack("QQ", offset, length)
+    for request in ioctls:
+        try:
+            fcntl.ioctl(fd, request, argument)
+            return request == BLKZEROOUT
+        except OSError as exc:
+            if exc.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY):
+                raise
+    return False
+
+
+def write_image(image: Path, target: Path, direct: bool = False, discard: bool = True) -> WriteStats:
+    """
+    Write the raw image to the target device (or a regular file standing in for one).
+
+    Regular file targets are truncated first, so holes stay holes in them,
+    their original size is kept if they're larger than the image (like a larger disk).
+    On block devices without zeroing offload, the holes keep the old data (see `WriteStats.holes_zeroed`).
+    """
+    start_time = time.perf_counter()
+    src = os.open(image, os.O_RDONLY)
+    try:
+        size = os.fstat(src).st_size
+        is_block = target.exists() and stat.S_ISBLK(target.stat().st_mode)
+        target_size = target.stat().st_size if target.exists() and not is_block else 0
+        flags = os.O_WRONLY if is_block else os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        dst = os.open(target, flags | (os.O_DIRECT if direct else 0), 0o644)
+        try:
+            if is_block and get_size(dst) < size:
+                raise OSError(errno.ENOSPC, f"{target} is smaller than the image ({size} bytes)")
+            if not is_block:
+                os.ftruncate(dst, max(size, target_size))
+            clear_ioctls = get_clear_ioctls(target, discard) if is_block else []
+            # Tail that's not aligned for O_DIRECT is written through a regular descriptor
+            tail_dst = os.open(target, os.O_WRONLY) if direct else dst
+
+            method = "O_DIRECT" if direct else "copy_file_range"
+            buffer = mmap.mmap(-1, CHUNK_SIZE) if direct else None
+            data_bytes = 0
+            previous_end = 0
+            holes_zeroed = True
+            for offset, length in data_ranges(src, size):
+                if offset > previous_end:
+                    zeroed = _clear_range(dst, previous_end, offset - previous_end, clear_ioctls)
+                    holes_zeroed = holes_zeroed and (zeroed or not is_block)
+                if buffer is not None:
+                    aligned = length - (offset + length) % DIRECT_ALIGNMENT if offset % DIRECT_ALIGNMENT == 0 else 0
+                    if aligned > 0:
+                        _copy_direct(src, dst, offset, aligned, buffer)
+                    if aligned < length:
+                        _copy_kernel(src, tail_dst, offset + aligned, length - aligned, "sendfile")
+                else:
+                    method = _copy_kernel(src, dst, offset, length, method)
+                data_bytes += length
+                previous_end = offset + length
+            if previous_end < size:
+                zeroed = _clear_range(dst, previous_end, size - previous_end, clear_ioctls)
+                holes_zeroed = holes_zeroed and (zeroed or not is_block)
+
+            os.fsync(dst)
+            if tail_dst != dst:
+                os.fsync(tail_dst)
+                os.close(tail_dst)
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
+
+    return WriteStats(data_bytes, size - data_bytes, method, time.perf_counter() - start_time, holes_zeroed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Write a raw disk image, skipping its holes.")
+    parser.add_argument("image", type=Path)
+    parser.add_argument("target", type=Path)
+    parser.add_argument("--direct", action="store_true", help="bypass the page cache (O_DIRECT)")
+    parser.add_argument("--no-discard", action="store_true", help="don't discard skipped ranges on the device")
+    args = parser.parse_args()
+
+    stats = write_image(args.image, args.target, direct=args.direct, discard=not args.no_discard)
+    mib = 1024 ** 2
+    print(
+        f"Wrote {stats.data_bytes // mib}MiB of data, skipped {stats.hole_bytes // mib}MiB of holes "
+        f"in {stats.duration:.2f}s ({stats.method})",
+        file=sys.stderr,
+    )
+    if not stats.holes_zeroed:
+        print(f"{args.target} can't zero the holes, they still hold its previous content", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
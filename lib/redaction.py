@@ -0,0 +1,39 @@
+"""
+Secrets (e.g. a Wi-Fi passphrase from the answer file) which mustn't be shown or written anywhere.
+
+Everything which echoes commands or file contents (traces, the install log, DEBUG confirmations,
+install plans) passes the text through `redact`, which masks the secrets registered so far.
+"""
+import threading
+from typing import Any
+
+PLACEHOLDER = "<redacted>"
+
+_secrets: set[str] = set()
+_secrets_lock = threading.Lock()
+
+
+def add_secret(secret: str) -> None:
+    """Mask given secret in everything redacted from now on."""
+    if secret:
+        with _secrets_lock:
+            _secrets.add(secret)
+
+
+def redact(text: str) -> str:
+    """Replace the registered secrets in given text with a placeholder."""
+    with _secrets_lock:
+        # Longest first, so that a secret containing another one isn't left partially visible
+        secrets = sorted(_secrets, key=len, reverse=True)
+    for secret in secrets:
+        text = text.replace(secret, PLACEHOLDER)
+    return text
+
+
+def redact_value(value: Any) -> Any:
+    """Redact a string or the strings in a list (e.g. the argv of a command), leave other values as they are."""
+    if isinstance(value, str):
+        return redact(value)
+    if isinstance(value, (list, tuple)):
+        return [redact_value(item) for item in value]
+    return value
@@ -0,0 +1,217 @@
+"""
+Persistent privileged worker process.
+
+The worker is started once through the available root escalation tool and then
+executes commands sent to it over a pipe. Requests and responses are JSON lines,
+commands are passed as argv lists, so they're never re-parsed by a shell.
+
+Request:  {"id": 1, "argv": ["mkfs.ext4", "/dev/sda1"], "capture": false, "stream": false}
+Response: {"id": 1, "returncode": 0, "output": "<base64 of captured output>"}
+
+Streamed requests get a {"id": 1, "line": "<base64 of output line>"} message for
+every line of output as it's produced, followed by the final response.
+
+This module only depends on the standard library, since the worker side runs it
+directly as a script (as root, without the rest of the installer on its path).
+"""
+import base64
+import itertools
+import json
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+from pathlib import Path
+from typing import IO, Callable, Iterator, Optional
+
+
+def _error_message(request: dict, exc: Exception) -> bytes:
+    # ValueError for an argv which can't be executed at all (e.g. with a NUL byte)
+    reason = exc.strerror if isinstance(exc, OSError) and exc.strerror else str(exc)
+    return f"{request['argv'][0]}: {reason}\n".encode()
+
+
+def _execute_streamed(request: dict, send: Callable[[dict], None]) -> dict:
+    try:
+        proc = subprocess.Popen(
+            request["argv"], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+    except (OSError, ValueError) as exc:
+        message = _error_message(request, exc)
+        send({"id": request["id"], "line": base64.b64encode(message).decode()})
+        return {"id": request["id"], "returncode": 127, "output": None}
+
+    assert proc.stdout is not None
+    for line in proc.stdout:
+        send({"id": request["id"], "line": base64.b64encode(line).decode()})
+    return {"id": request["id"], "returncode": proc.wait(), "output": None}
+
+
+def _execute(request: dict, stdin_fd: Optional[int]) -> dict:
+    capture = request.get("capture", False)
+    try:
+        proc = subprocess.run(
+            request["argv"],
+            stdin=stdin_fd if stdin_fd is not None and not capture else subprocess.DEVNULL,
+            # Output of non-captured commands goes to our stderr, which is the installer's terminal
+            stdout=subprocess.PIPE if capture else sys.stderr.fileno(),
+            stderr=subprocess.STDOUT,
+        )
+    except (OSError, ValueError) as exc:
+        message = _error_message(request, exc)
+        return {"id": request["id"], "returncode": 127, "output": base64.b64encode(message).decode()}
+
+    output = base64.b64encode(proc.stdout).decode() if capture else None
+    return {"id": request["id"], "returncode": proc.returncode, "output": output}
+
+
+def serve(requests: IO[str] = sys.stdin, responses: IO[str] = sys.stdout) -> None:
+    """Worker side: execute requests until the request pipe is closed."""
+    try:
+        stdin_fd: Optional[int] = os.open("/dev/tty", os.O_RDWR)
+    except OSError:
+        stdin_fd = None
+
+    write_lock = threading.Lock()
+
+    def send(message: dict) -> None:
+        with write_lock:
+            responses.write(json.dumps(message) + "\n")
+            responses.flush()
+
+    def handle(line: str) -> None:
+        request: dict = {}
+        try:
+            request = json.loads(line)
+            if request.get("stream", False):
+                response = _execute_streamed(request, send)
+            else:
+                response = _execute(request, stdin_fd)
+        except Exception as exc:
+            # A broken request mustn't take the worker down, and the client waits for an answer to it
+            if not isinstance(request, dict):
+                request = {}
+            message = base64.b64encode(f"Privileged worker can't handle the request: {exc!r}\n".encode()).decode()
+            response = {"id": request.get("id"), "returncode": 1, "output": message}
+            if request.get("stream", False):
+                # Streamed output only comes in lines
+                send({"id": request.get("id"), "line": message})
+                response["output"] = None
+        send(response)
+
+    send({"ready": True})
+    # Requests are handled concurrently, so that independent commands (e.g. formatting multiple disks) don't wait
+    threads = []
+    for line in requests:
+        thread = threading.Thread(target=handle, args=(line,))
+        thread.start()
+        threads.append(thread)
+
+    # Let commands which are still running finish before exiting
+    for thread in threads:
+        thread.join()
+
+
+class RootWorker:
+    """Client side handle to a running privileged worker."""
+
+    def __init__(self, root_prefix: list[str]):
+        worker_cmd = [sys.executable, str(Path(__file__).absolute())]
+        if root_prefix[-1:] == ["-c"]:
+            # su takes the command as a single string
+            argv = [*root_prefix, shlex.join(worker_cmd)]
+        else:
+            argv = [*root_prefix, *worker_cmd]
+
+        self._proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        self._ids = itertools.count(1)
+        self._pending: dict[int, queue.Queue] = {}
+        self._lock = threading.Lock()
+
+        assert self._proc.stdout is not None
+        handshake = self._proc.stdout.readline()
+        if not handshake or not json.loads(handshake).get("ready"):
+            self._proc.wait()
+            raise OSError("Privileged worker failed to start")
+
+        self._reader = threading.Thread(target=self._read_responses, name="root-worker-reader", daemon=True)
+        self._reader.start()
+
+    def _read_responses(self) -> None:
+        assert self._proc.stdout is not None
+        for line in self._proc.stdout:
+            message = json.loads(line)
+            with self._lock:
+                if "returncode" in message:
+                    messages = self._pending.pop(message["id"], None)
+                else:
+                    messages = self._pending.get(message["id"])
+            # Answers to requests the worker couldn't read the id of have nobody to go to
+            if messages is not None:
+                messages.put(message)
+
+        # Worker died, fail everything which is still waiting
+        with self._lock:
+            for messages in self._pending.values():
+                messages.put(None)
+            self._pending.clear()
+
+    @property
+    def alive(self) -> bool:
+        return self._proc.poll() is None
+
+    def _send(self, request: dict) -> "queue.Queue[Optional[dict]]":
+        messages: "queue.Queue[Optional[dict]]" = queue.Queue()
+        with self._lock:
+            request["id"] = next(self._ids)
+            self._pending[request["id"]] = messages
+            assert self._proc.stdin is not None
+            try:
+                self._proc.stdin.write(json.dumps(request) + "\n")
+                self._proc.stdin.flush()
+            except (OSError, ValueError) as exc:
+                del self._pending[request["id"]]
+                raise OSError("Privileged worker isn't running") from exc
+        return messages
+
+    def run(self, argv: list[str], capture_out: bool = False) -> subprocess.CompletedProcess:
+        """Run given argv as root, wait for it to finish."""
+        response = self._send({"argv": argv, "capture": capture_out}).get()
+        if response is None:
+            raise OSError("Privileged worker exited")
+        stdout = base64.b64decode(response["output"]) if response["output"] is not None else None
+        return subprocess.CompletedProcess(argv, response["returncode"], stdout)
+
+    def stream(self, argv: list[str]) -> tuple[Iterator[bytes], Callable[[], int]]:
+        """
+        Run given argv as root, streaming its output.
+
+        Return an iterator over the output lines and a function which returns
+        the exit code, once the iterator was exhausted.
+        """
+        messages = self._send({"argv": argv, "stream": True})
+        result: dict = {}
+
+        def lines() -> Iterator[bytes]:
+            while (message := messages.get()) is not None:
+                if "returncode" in message:
+                    result.update(message)
+                    return
+                yield base64.b64decode(message["line"])
+            raise OSError("Privileged worker exited")
+
+        def wait() -> int:
+            return result["returncode"]
+
+        return lines(), wait
+
+    def close(self) -> None:
+        if self._proc.stdin is not None and not self._proc.stdin.closed:
+            self._proc.stdin.close()
+        self._proc.wait()
+
+
+if __name__ == "__main__":
+    serve()
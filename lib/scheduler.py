@@ -0,0 +1,235 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterable, Optional, Union
+
+from lib import constants, installplan, terminal, tracing
+from lib.journal import Checkpoint, Journal
+
+# Common resources
+TERMINAL = "terminal"
+NETWORK = "network"
+
+# How many steps can use a resource at the same time (resources not listed here are exclusive)
+DEFAULT_CAPACITIES = {NETWORK: 3}
+
+Results = dict[str, Any]
+Resources = Union[Iterable[str], Callable[[Results], Iterable[str]]]
+
+
+def disk_resource(device: Any) -> str:
+    """Get the resource name for given disk device."""
+    return f"disk:{device}"
+
+
+class StepFailed(Exception):
+    def __init__(self, step: "Step", exc: BaseException):
+        super().__init__(f"Install step '{step.name}' failed: {exc!r}")
+        self.step = step
+        self.exc = exc
+
+
+class Step:
+    """
+    A single install step.
+
+    `func` receives the results of all finished steps (keyed by step name), its return
+    value becomes the result of this step. `resources` are held while the step runs,
+    they can also be a function of the results (e.g. disks from a partition scheme).
+    Steps using the TERMINAL resource are interactive, all other steps run in
+    the background, with their output deferred while the terminal is in use.
+    Steps with a `checkpoint` are recorded in the journal and skipped on rerun,
+    if nothing they depend on changed.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Results], Any],
+        depends: Iterable[str] = (),
+        resources: Resources = (),
+        checkpoint: Optional[Checkpoint] = None,
+    ):
+        self.name = name
+        self.func = func
+        self.depends = list(depends)
+        self.checkpoint = checkpoint
+        self._resources = resources
+
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+
+    def get_resources(self, results: Results) -> set[str]:
+        if callable(self._resources):
+            return set(self._resources(results))
+        return set(self._resources)
+
+    @property
+    def duration(self) -> float:
+        if self.start is None or self.end is None:
+            return 0
+        return self.end - self.start
+
+    def __repr__(self) -> str:
+        return f"<Step {self.name}>"
+
+
+class Scheduler:
+    """
+    Run install steps respecting their dependencies and resources.
+
+    Independent steps run concurrently on a worker pool. Steps are started in the
+    order they were added whenever their dependencies are done and their resources free.
+    """
+
+    def __init__(
+        self,
+        steps: list[Step],
+        max_workers: int = 4,
+        capacities: Optional[dict[str, int]] = None,
+        journal: Optional[Journal] = None,
+    ):
+        self.steps = {step.name: step for step in steps}
+        self.max_workers = max_workers
+        self.capacities = DEFAULT_CAPACITIES if capacities is None else capacities
+        self.journal = journal
+        self.results: Results = {}
+        self.skipped: set[str] = set()
+        # Steps which (possibly) produced something different than in the previous run
+        self.changed: set[str] = set()
+        self._validate()
+
+    def _validate(self) -> None:
+        for step in self.steps.values():
+            for dependency in step.depends:
+                if dependency not in self.steps:
+                    raise ValueError(f"Step '{step.name}' depends on unknown step '{dependency}'")
+
+        # Make sure there are no cycles (they would never finish)
+        visited: set[str] = set()
+        visiting: set[str] = set()
+
+        def visit(name: str) -> None:
+            if name in visiting:
+                raise ValueError(f"Dependency cycle involving step '{name}'")
+            if name in visited:
+                return
+            visiting.add(name)
+            for dependency in self.steps[name].depends:
+                visit(dependency)
+            visiting.remove(name)
+            visited.add(name)
+
+        for name in self.steps:
+            visit(name)
+
+    def _can_skip(self, step: Step) -> tuple[bool, Any]:
+        """Check the journal to see if the step was already done with the same inputs."""
+        if self.journal is None or step.checkpoint is None:
+            return False, None
+        # Anything after a step which ran again has to run again too
+        if any(dependency in self.changed for dependency in step.depends):
+            return False, None
+        return self.journal.lookup(step.name, step.checkpoint, self.results)
+
+    def _run_step(self, step: Step, resources: set[str]) -> Any:
+        step.start = time.perf_counter()
+        try:
+            skip, result = self._can_skip(step)
+            if skip:
+                print(f"{constants.NOTE_COLOR}Skipping '{step.name}', it was already done in a previous run.")
+                self.skipped.add(step.name)
+                return result
+
+            if step.checkpoint is not None or any(dependency in self.changed for dependency in step.depends):
+                self.changed.add(step.name)
+            if self.journal is not None:
+                self.journal.invalidate(step.name)
+            with installplan.step(step.name):
+                if TERMINAL in resources:
+                    result = step.func(self.results)
+                else:
+                    with terminal.background():
+                        result = step.func(self.results)
+
+            if self.journal is not None and step.checkpoint is not None:
+                self.journal.record(step.name, step.checkpoint, self.results, result)
+            return result
+        finally:
+            step.end = time.perf_counter()
+            tracing.record_span(step.name, tracing.STEP, step.start, step.end)
+
+    def run(self) -> Results:
+        """Run all of the steps, return their results. Raise `StepFailed` if any of them fails."""
+        pending = list(self.steps.values())
+        running: dict[Future, tuple[Step, set[str]]] = {}
+        held: dict[str, int] = {}
+        failure: Optional[StepFailed] = None
+
+        def can_start(step: Step) -> Optional[set[str]]:
+            if any(dependency not in self.results for dependency in step.depends):
+                return None
+            resources = step.get_resources(self.results)
+            for resource in resources:
+                if held.get(resource, 0) >= self.capacities.get(resource, 1):
+                    return None
+            return resources
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="step") as executor:
+            while len(pending) != 0 or len(running) != 0:
+                # Once something failed, don't start anything new, just let running steps finish
+                if failure is None:
+                    for step in list(pending):
+                        resources = can_start(step)
+                        if resources is None:
+                            continue
+                        for resource in resources:
+                            held[resource] = held.get(resource, 0) + 1
+                        pending.remove(step)
+                        running[executor.submit(self._run_step, step, resources)] = (step, resources)
+
+                if len(running) == 0:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step, resources = running.pop(future)
+                    for resource in resources:
+                        held[resource] -= 1
+                    if future.exception() is not None:
+                        failure = failure or StepFailed(step, future.exception())  # type: ignore
+                    else:
+                        self.results[step.name] = future.result()
+
+        if failure is not None:
+            raise failure
+        if len(pending) != 0:
+            raise RuntimeError(f"Steps {pending} can never run, they need more of some resource than available")
+        return self.results
+
+    def critical_path(self) -> list[Step]:
+        """Get the chain of dependent steps which determined the total run time."""
+        finish: dict[str, float] = {}
+        previous: dict[str, Optional[str]] = {}
+
+        def visit(name: str) -> float:
+            if name not in finish:
+                step = self.steps[name]
+                longest = max(step.depends, key=visit, default=None)
+                previous[name] = longest
+                finish[name] = step.duration + (finish[longest] if longest is not None else 0)
+            return finish[name]
+
+        if len(self.steps) == 0:
+            return []
+        name: Optional[str] = max(self.steps, key=visit)
+        path = []
+        while name is not None:
+            path.append(self.steps[name])
+            name = previous[name]
+        return path[::-1]
+
+    def print_critical_path(self) -> None:
+        path = self.critical_path()
+        print(f"{constants.INFO_COLOR}Critical path ({sum(step.duration for step in path):.2f}s):")
+        for step in path:
+            print(f"    {step.duration:8.2f}s  {step.name}")
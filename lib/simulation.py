@@ -0,0 +1,412 @@
+"""
+Simulated machine for benchmarking the installer's own logic, without touching the real system.
+
+A `Simulation` swaps everything which talks to the outside world for scriptable fakes:
+commands (`lib.commands`), the connectivity check, network interfaces and link state,
+block devices, mirror probes, package prefetch and the host's pacman config. Questions are
+answered from a scripted answer file. Each fake can be given a latency, so that e.g. a slow
+mkfs or a flaky network can be simulated, and all of the latencies can be scaled at once.
+"""
+import asyncio
+import json
+import random
+import re
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Iterator, NamedTuple, Optional, Union
+
+from lib import (
+    answers, commands, constants, filesystems, internet, inventory, linkwatch, mirrors, native, pacman, partitioning,
+    prefetch, wifi,
+)
+
+# Stock pacman config, as shipped by the pacman package (comments left out)
+STOCK_PACMAN_CONF = """\
+[options]
+HoldPkg = pacman glibc
+Architecture = auto
+CheckSpace
+#ParallelDownloads = 5
+SigLevel = Required DatabaseOptional
+LocalFileSigLevel = Optional
+
+[core]
+Include = /etc/pacman.d/mirrorlist
+
+[extra]
+Include = /etc/pacman.d/mirrorlist
+"""
+
+
+class CommandRule(NamedTuple):
+    """How the simulated system responds to commands matching `pattern` (a regex searched in the command)."""
+    pattern: str
+    latency: float = 0.0
+    returncode: int = 0
+    output: str = ""
+    # The first `failures` matching commands fail (with returncode 1), the rest behave as configured
+    failures: int = 0
+
+
+class SimulatedInterface(NamedTuple):
+    name: str
+    type: inventory.InterfaceType = inventory.InterfaceType.PHYSICAL
+    is_up: bool = True
+    # Seconds after the install started when the link comes up (`None` for never)
+    carrier_after: Optional[float] = 0.0
+
+
+class SimulatedDisk(NamedTuple):
+    name: str
+    size: int
+    rotational: bool = False
+    partitions: list[int] = []  # sizes of the existing partitions
+
+
+class Network(NamedTuple):
+    """Behaviour of the simulated network."""
+    connected: bool = True
+    # Commands after which the machine gets connected (e.g. `iwctl ... connect`)
+    connect_pattern: Optional[str] = None
+    # Seconds after a carrier appears before DHCP connects the machine, `None` for never
+    dhcp_delay: Optional[float] = 0.2
+    check_latency: float = 0.02
+    # Probability that a connectivity check (or a mirror probe) fails even though the machine is connected
+    flakiness: float = 0.0
+    mirrors: int = 50
+    probe_latency: float = 0.1
+
+
+class CommandCall(NamedTuple):
+    cmd: str
+    root: bool
+    duration: float
+
+
+class Simulation:
+    """Fake machine, `with simulation:` swaps the fakes in for the real implementations."""
+
+    def __init__(
+        self,
+        answers: dict[str, Any],
+        rules: list[CommandRule] = [],
+        interfaces: list[SimulatedInterface] = [],
+        disks: list[SimulatedDisk] = [],
+        network: Network = Network(),
+        available_commands: set[str] = {"iwctl"},
+        is_efi: bool = False,
+        answer_latency: float = 0.0,
+        latency_scale: float = 1.0,
+        seed: int = 0,
+    ):
+        self.answers = answers
+        self.rules = rules
+        self.interfaces = {interface.name: interface for interface in interfaces}
+        self.disks = disks
+        self.network = network
+        self.available_commands = available_commands
+        self.is_efi = is_efi
+        self.answer_latency = answer_latency
+        self.latency_scale = latency_scale
+        self.random = random.Random(seed)
+
+        self.calls: list[CommandCall] = []
+        self.files: dict[Path, str] = {}
+        self.connected = network.connected
+        self.start = time.monotonic()
+        self._failures: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._originals: list[tuple[Any, str, Any]] = []
+        self._tmp_dir: Optional[tempfile.TemporaryDirectory] = None
+
+    def sleep(self, latency: float) -> None:
+        if latency > 0:
+            time.sleep(latency * self.latency_scale)
+
+    def elapsed(self) -> float:
+        """Get simulated seconds since the start (latencies are scaled, so is the simulated time)."""
+        if self.latency_scale == 0:
+            # Without latencies, everything which is going to happen already happened
+            return float("inf")
+        return (time.monotonic() - self.start) / self.latency_scale
+
+    # Commands
+
+    def _match(self, cmd: str) -> CommandRule:
+        for rule in self.rules:
+            if re.search(rule.pattern, cmd):
+                return rule
+        return CommandRule(pattern="")
+
+    def execute(self, cmd: Union[str, list[str]], root: bool) -> tuple[int, str]:
+        """Run the command on the simulated machine, return its exit code and output."""
+        cmd_str = cmd if isinstance(cmd, str) else shlex.join(cmd)
+        rule = self._match(cmd_str)
+        start = time.perf_counter()
+        self.sleep(rule.latency)
+        with self._lock:
+            failed = self._failures.get(rule.pattern, 0)
+            if failed < rule.failures:
+                self._failures[rule.pattern] = failed + 1
+            self.calls.append(CommandCall(cmd_str, root, time.perf_counter() - start))
+        if failed < rule.failures:
+            return 1, ""
+        if self.network.connect_pattern is not None and re.search(self.network.connect_pattern, cmd_str):
+            self.connected = True
+        return rule.returncode, rule.output
+
+    def run_cmd(
+        self, cmd: str, capture_out: bool = False, enable_debug: bool = True, read_only: bool = False
+    ) -> subprocess.CompletedProcess:
+        returncode, output = self.execute(cmd, root=False)
+        return subprocess.CompletedProcess(cmd, returncode, output.encode() if capture_out else None)
+
+    def run_root_cmd(
+        self,
+        cmd: Union[str, list[str]],
+        capture_out: bool = False,
+        enable_debug: bool = True,
+        read_only: bool = False,
+    ) -> subprocess.CompletedProcess:
+        returncode, output = self.execute(cmd, root=True)
+        return subprocess.CompletedProcess(cmd, returncode, output.encode() if capture_out else None)
+
+    def stream_cmd(
+        self, cmd: Union[str, list[str]], root: bool = False, enable_debug: bool = True
+    ) -> commands.StreamedProcess:
+        result: list[int] = []
+
+        def lines() -> Iterator[bytes]:
+            returncode, output = self.execute(cmd, root)
+            result.append(returncode)
+            for line in output.splitlines(keepends=True):
+                yield line.encode()
+
+        return commands.StreamedProcess(cmd, lines(), lambda: result[0])
+
+    def write_root_file(self, path: Path, content: str, mode: str = "644") -> subprocess.CompletedProcess:
+        self.execute(["install", "-m", mode, "-", str(path)], root=True)
+        self.files[path] = content
+        return subprocess.CompletedProcess(["install", "-m", mode, "-", str(path)], 0)
+
+    def drop_to_shell(self, enable_debug: bool = False) -> None:
+        self.execute("exec ${SHELL}", root=False)
+
+    def command_exists(self, cmd: str) -> bool:
+        parts = cmd.split()
+        executable = parts[0] if parts[0] not in ("sudo", "source", ".") else parts[1]
+        return executable in self.available_commands
+
+    # Network
+
+    def _has_carrier(self, name: str) -> bool:
+        interface = self.interfaces.get(name)
+        if interface is None or not interface.is_up or interface.carrier_after is None:
+            return False
+        return self.elapsed() >= interface.carrier_after
+
+    def check_connection(self, host: Optional[str] = None, use_cache: bool = True) -> bool:
+        self.sleep(self.network.check_latency)
+        if not self.connected and self.network.dhcp_delay is not None:
+            # A physical link gets the machine connected (once DHCP is done)
+            for interface in self.interfaces.values():
+                if (
+                    interface.type == inventory.InterfaceType.PHYSICAL and interface.carrier_after is not None
+                    and self.elapsed() >= interface.carrier_after + self.network.dhcp_delay
+                ):
+                    self.connected = True
+        return self.connected and self.random.random() >= self.network.flakiness
+
+    async def probe_mirror(self, server: str, sample_size: int = mirrors.SAMPLE_SIZE) -> Optional[mirrors.MirrorResult]:
+        latency = self.network.probe_latency * (0.5 + self.random.random())
+        await asyncio.sleep(latency * self.latency_scale)
+        if self.random.random() < self.network.flakiness:
+            return None
+        return mirrors.MirrorResult(server, latency, self.random.uniform(1, 50) * 1024 ** 2, int(time.time()) - 600)
+
+    def read_mirrorlist(self, path: Path = constants.MIRRORLIST, include_commented: bool = False) -> list[str]:
+        return [
+            f"https://mirror{number}.example.org/archlinux/$repo/os/$arch" for number in range(self.network.mirrors)
+        ]
+
+    # Hardware
+
+    def make_inventory(self) -> inventory.Inventory:
+        snapshot = inventory.Inventory.__new__(inventory.Inventory)
+        snapshot.interfaces = {
+            name: inventory.NetInterface(
+                name, index, interface.type, f"52:54:00:00:00:{index:02x}", interface.is_up, self._has_carrier(name)
+            )
+            for index, (name, interface) in enumerate(self.interfaces.items(), start=2)
+        }
+        snapshot.disks = {}
+        for disk in self.disks:
+            device = inventory.BlockDevice(disk.name, disk.size, model="Simulated disk", rotational=disk.rotational)
+            for number, size in enumerate(disk.partitions, start=1):
+                name = partitioning.partition_path(device.path, number).name
+                device.partitions.append(inventory.BlockDevice(
+                    name, size, model=device.model, rotational=disk.rotational, parent=disk.name
+                ))
+            snapshot.disks[disk.name] = device
+        return snapshot
+
+    def _find_disk(self, device: Path) -> Optional[SimulatedDisk]:
+        for disk in self.disks:
+            if device == Path("/dev", disk.name) or device.name.startswith(disk.name):
+                return disk
+        return None
+
+    def is_block_device(self, device: Path) -> bool:
+        return self._find_disk(device) is not None
+
+    def read_geometry(self, device: Path) -> partitioning.DeviceGeometry:
+        disk = self._find_disk(device)
+        if disk is None:
+            raise FileNotFoundError(f"Simulated machine has no disk {device}")
+        return partitioning.DeviceGeometry(size=disk.size, physical_block_size=4096, minimum_io_size=4096)
+
+    def read_profile(self, device: Path) -> filesystems.DeviceProfile:
+        disk = self._find_disk(device)
+        rotational = disk is None or disk.rotational
+        return filesystems.DeviceProfile(rotational=rotational, discard_granularity=0 if rotational else 4096)
+
+    def make_link_watcher(self) -> "SimulatedLinkWatcher":
+        return SimulatedLinkWatcher(self)
+
+    # Packages
+
+    def start_prefetch(self, packages: list[str] = constants.BASE_PACKAGES) -> Optional["SimulatedPrefetch"]:
+        rule = self._match(shlex.join(["pacman", "--sync", "--downloadonly", *packages]))
+        return SimulatedPrefetch(self, rule.latency)
+
+    def make_config(self, *args, **kwargs) -> str:
+        assert self._tmp_dir is not None
+        base_config = Path(self._tmp_dir.name, "pacman.conf")
+        return self._original(pacman, "make_config")(*args, **{**kwargs, "base_config": base_config})
+
+    def configure_target(self, root: Path, parallel_downloads: int = constants.PARALLEL_DOWNLOADS):
+        config = pacman.set_options(STOCK_PACMAN_CONF, {"ParallelDownloads": [str(parallel_downloads)]})
+        return commands.write_root_file(root / constants.PACMAN_CONF.relative_to("/"), config)
+
+    # Installation of the fakes
+
+    def _patch(self, target: Any, name: str, value: Any) -> None:
+        self._originals.append((target, name, getattr(target, name)))
+        setattr(target, name, value)
+
+    def _original(self, target: Any, name: str) -> Any:
+        for patched_target, patched_name, value in self._originals:
+            if patched_target is target and patched_name == name:
+                return value
+        return getattr(target, name)
+
+    def install(self) -> None:
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix="archdeploy-simulation-")
+        Path(self._tmp_dir.name, "pacman.conf").write_text(STOCK_PACMAN_CONF)
+        answer_path = Path(self._tmp_dir.name, "answers.json")
+        answer_path.write_text(json.dumps(self.answers))
+        self.start = time.monotonic()
+
+        for name in ("run_cmd", "run_root_cmd", "stream_cmd", "write_root_file", "drop_to_shell", "command_exists"):
+            self._patch(commands, name, getattr(self, name))
+        self._patch(internet, "check_connection", self.check_connection)
+        self._patch(inventory, "get", self.make_inventory)
+        self._patch(linkwatch, "is_up", lambda name: name in self.interfaces and self.interfaces[name].is_up)
+        self._patch(linkwatch, "has_carrier", self._has_carrier)
+        self._patch(linkwatch, "LinkWatcher", self.make_link_watcher)
+        # The native operations and iwd's bus belong to the host, go through the (simulated) commands instead
+        self._patch(native, "read_rfkill", lambda: None)
+        self._patch(native, "rfkill_unblock", lambda type_name: False)
+        self._patch(native, "set_link_up", lambda interface_name: False)
+        self._patch(wifi, "watch_station", wifi.PolledStation)
+        self._patch(partitioning, "is_block_device", self.is_block_device)
+        self._patch(partitioning, "read_geometry", self.read_geometry)
+        self._patch(filesystems, "read_profile", self.read_profile)
+        self._patch(mirrors, "probe_mirror", self.probe_mirror)
+        self._patch(mirrors, "read_mirrorlist", self.read_mirrorlist)
+        self._patch(prefetch, "start_prefetch", self.start_prefetch)
+        self._patch(pacman, "make_config", self.make_config)
+        self._patch(pacman, "configure_target", self.configure_target)
+        self._patch(constants, "IS_EFI", self.is_efi)
+
+        # Scripted answers go through the regular answer file handling, optionally with some "thinking" time
+        answer_file = answers.AnswerFile(answer_path, host_ids=[])
+        lookup = answers.lookup
+        self._patch(answers, "_answer_file", answer_file)
+
+        def slow_lookup(key: Optional[str], message: str, sequence: bool = True) -> Any:
+            self.sleep(self.answer_latency)
+            return lookup(key, message, sequence)
+
+        self._patch(answers, "lookup", slow_lookup)
+
+    def uninstall(self) -> None:
+        while len(self._originals) != 0:
+            target, name, value = self._originals.pop()
+            setattr(target, name, value)
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
+            self._tmp_dir = None
+
+    def __enter__(self) -> "Simulation":
+        self.install()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.uninstall()
+
+
+class SimulatedLinkWatcher:
+    """Link watcher reporting the link state of the simulated interfaces."""
+
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, simulation: Simulation):
+        self.simulation = simulation
+
+    def __enter__(self) -> "SimulatedLinkWatcher":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def wait_for_change(self, timeout: float) -> bool:
+        self.simulation.sleep(min(timeout, self.POLL_INTERVAL * 10))
+        return True
+
+    def wait_for_carrier(self, interface_names: list[str], timeout: float) -> Optional[str]:
+        deadline = time.monotonic() + timeout * self.simulation.latency_scale
+        while True:
+            for name in interface_names:
+                if self.simulation._has_carrier(name):
+                    return name
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(self.POLL_INTERVAL)
+
+    def wait_for_up(self, interface_name: str, timeout: float) -> bool:
+        return linkwatch.is_up(interface_name)
+
+
+class SimulatedPrefetch:
+    """Background package download taking the latency of the `pacman --sync --downloadonly` rule."""
+
+    def __init__(self, simulation: Simulation, latency: float):
+        self._done = threading.Event()
+        self._timer = threading.Timer(latency * simulation.latency_scale, self._done.set)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def wait(self) -> None:
+        self._done.wait()
+
+    def cancel(self) -> None:
+        self._timer.cancel()
+        self._done.set()
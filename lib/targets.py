@@ -0,0 +1,149 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Optional
+
+from lib import commands, constants, terminal
+
+# Lines of target process output starting with this are progress reports, not regular output
+PROGRESS_PREFIX = "@@archdeploy "
+# Minimal amount of seconds between two progress displays, unless some target changed its step
+PROGRESS_INTERVAL = 30
+# Where mount roots of the targets are created
+MOUNT_BASE = Path("/mnt/archdeploy")
+# Lines of output kept for each target, shown in the result table when it fails
+TAIL_LINES = 10
+
+
+def report(**fields) -> None:
+    """Report progress from a target process to the process managing it."""
+    # Bypass the color resetting/deferring wrappers, the line has to arrive as it is
+    stream = sys.__stdout__
+    assert stream is not None
+    stream.write(PROGRESS_PREFIX + json.dumps(fields) + "\n")
+    stream.flush()
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m{seconds:02d}s" if minutes else f"{seconds}s"
+
+
+class TargetProcess(threading.Thread):
+    """Install onto a single target device, in its own (root) process, following its progress."""
+
+    def __init__(self, device: Path, script: Path, args: list[str]):
+        super().__init__(name=f"target-{device.name}", daemon=True)
+        self.device = device
+        self.root = MOUNT_BASE / device.name
+        self.log = constants.INSTALL_LOG.with_name(f"{constants.INSTALL_LOG.stem}-{device.name}.log")
+        self.script = script
+        self.args = args
+
+        self.step = "starting"
+        self.step_start = time.monotonic()
+        self.start_time = time.monotonic()
+        self.end_time: Optional[float] = None
+        self.error: Optional[str] = None
+        self.returncode: Optional[int] = None
+        self.tail: deque[str] = deque(maxlen=TAIL_LINES)
+        self.changed = threading.Event()
+
+    def _env(self) -> list[str]:
+        """Get the environment for the target process, root escalation may not keep ours."""
+        env = {key: value for key, value in os.environ.items() if key.startswith("ARCHDEPLOY_")}
+        env.update({
+            "ARCHDEPLOY_CACHE_DIR": str(constants.CACHE_DIR),
+            "ARCHDEPLOY_PACKAGE_CACHE": str(constants.PACKAGE_CACHE_DIR),
+            "ARCHDEPLOY_LOG": str(self.log),
+            "PYTHONUNBUFFERED": "1",
+        })
+        if constants.TRACE_FILE is not None:
+            trace_file = constants.TRACE_FILE.with_name(f"{self.device.name}-{constants.TRACE_FILE.name}")
+            env["ARCHDEPLOY_TRACE"] = str(trace_file)
+        return [f"{key}={value}" for key, value in env.items()]
+
+    def run(self) -> None:
+        argv = [
+            "env", *self._env(), sys.executable, str(self.script), "target",
+            "--device", str(self.device), "--root", str(self.root), *self.args,
+        ]
+        # Nobody can answer DEBUG confirmations of the target process, it runs unattended
+        proc = commands.stream_cmd(argv, root=True, enable_debug=False)
+        for line in proc:
+            # Color resets of the previous output can end up in front of the report
+            index = line.find(PROGRESS_PREFIX)
+            if index == -1:
+                self.tail.append(line)
+                continue
+            message, _ = json.JSONDecoder().raw_decode(line[index + len(PROGRESS_PREFIX):])
+            if "step" in message:
+                self.step = message["step"]
+                self.step_start = time.monotonic()
+            if "error" in message:
+                self.error = message["error"]
+            self.changed.set()
+
+        self.returncode = proc.returncode
+        self.end_time = time.monotonic()
+        if self.returncode != 0 and self.error is None:
+            self.error = f"exited with code {self.returncode}"
+        self.step = "done" if self.returncode == 0 else "failed"
+        self.changed.set()
+
+    @property
+    def duration(self) -> float:
+        return (self.end_time or time.monotonic()) - self.start_time
+
+    def status(self) -> str:
+        if self.end_time is not None:
+            return f"{self.device.name}: {self.step}"
+        return f"{self.device.name}: {self.step} {_format_duration(time.monotonic() - self.step_start)}"
+
+
+def start_targets(devices: list[Path], script: Path, args: list[str]) -> list[TargetProcess]:
+    """Start installing onto all of the devices at the same time."""
+    targets = [TargetProcess(device, script, args) for device in devices]
+    for target in targets:
+        target.start()
+    return targets
+
+
+def print_progress(targets: list[TargetProcess]) -> None:
+    terminal.print_status("[targets] " + " | ".join(target.status() for target in targets))
+
+
+def wait_for_targets(targets: list[TargetProcess]) -> None:
+    """Wait for all targets to finish, showing their progress whenever some of them moves to another step."""
+    last_display = 0.0
+    while any(target.is_alive() for target in targets):
+        changed = any(target.changed.is_set() for target in targets)
+        if changed or time.monotonic() - last_display >= PROGRESS_INTERVAL:
+            for target in targets:
+                target.changed.clear()
+            print_progress(targets)
+            last_display = time.monotonic()
+        time.sleep(0.5)
+    print_progress(targets)
+
+
+def print_results(targets: list[TargetProcess]) -> None:
+    """Print the table of results of all the targets, with the last output of the failed ones."""
+    print(f"{constants.INFO_COLOR}Results:")
+    name_width = max(len(str(target.device)) for target in targets)
+    for target in targets:
+        color = constants.SUCCESS_COLOR if target.returncode == 0 else constants.ERROR_COLOR
+        result = "OK" if target.returncode == 0 else f"FAILED ({target.error})"
+        print(
+            f"    {color}{str(target.device):<{name_width}}  {_format_duration(target.duration):>7}  "
+            f"{result}{constants.NOTE_COLOR}  log: {target.log}"
+        )
+    for target in targets:
+        if target.returncode != 0 and len(target.tail) != 0:
+            print(f"{constants.ERROR_COLOR}Last output of {target.device}:")
+            for line in target.tail:
+                print(f"    {line}")
@@ -0,0 +1,98 @@
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Iterator, TextIO
+
+from lib import constants
+
+_lock = threading.RLock()
+_busy_count = 0
+_background = threading.local()
+_deferred: list[str] = []
+
+
+class DeferringStream:
+    """
+    Wrap sys.stdout, deferring writes from background threads while the terminal is busy.
+
+    Deferred output is written once the terminal stops being busy, so that background
+    work can print freely without writing over questions or interactive commands.
+    """
+
+    def __init__(self, wrapped: TextIO):
+        self.__wrapped = wrapped
+
+    def __getattr__(self, name: str):
+        return getattr(self.__wrapped, name)
+
+    def write(self, text: str):
+        with _lock:
+            if _busy_count != 0 and in_background():
+                _deferred.append(text)
+                return
+            self.__wrapped.write(text)
+
+    def flush_deferred(self) -> None:
+        with _lock:
+            for text in _deferred:
+                self.__wrapped.write(text)
+            _deferred.clear()
+            self.__wrapped.flush()
+
+
+@contextmanager
+def background() -> Iterator[None]:
+    """Mark the current thread as doing background work, its output is deferred while the terminal is busy."""
+    _background.active = True
+    try:
+        yield
+    finally:
+        _background.active = False
+
+
+def in_background() -> bool:
+    """Check if the current thread is doing background work."""
+    return getattr(_background, "active", False)
+
+
+@contextmanager
+def busy() -> Iterator[None]:
+    """
+    Mark the terminal as busy (a question is being asked, a command is writing to it, ...).
+
+    While the terminal is busy, status messages from background workers are suppressed.
+    """
+    global _busy_count
+    # Background threads running their own commands don't make the terminal busy for others
+    if in_background():
+        yield
+        return
+
+    with _lock:
+        _busy_count += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _busy_count -= 1
+            if _busy_count == 0 and isinstance(sys.stdout, DeferringStream):
+                sys.stdout.flush_deferred()
+
+
+def is_busy() -> bool:
+    return _busy_count != 0
+
+
+def print_status(message: str) -> bool:
+    """Print a status message from a background worker, unless the terminal is busy. Return whether it was shown."""
+    # Holding the lock while printing makes sure no prompt can start in the middle of the message
+    with _lock:
+        if _busy_count != 0:
+            return False
+        sys.stdout.write(f"{constants.NOTE_COLOR}{message}\n")
+        sys.stdout.flush()
+        return True
+
+
+if not isinstance(sys.stdout, DeferringStream):
+    sys.stdout = DeferringStream(sys.stdout)  # type: ignore
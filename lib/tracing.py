@@ -0,0 +1,121 @@
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, NamedTuple, Optional
+
+from lib import constants, redaction
+
+# Span categories
+STEP = "step"
+COMMAND = "command"
+USER_WAIT = "user-wait"
+
+# How many of the slowest spans are shown in the summary
+SUMMARY_SIZE = 10
+
+
+class Span(NamedTuple):
+    name: str
+    category: str
+    start: float  # seconds, from time.perf_counter()
+    end: float
+    thread_id: int
+    args: dict[str, Any]
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+_spans: list[Span] = []
+_spans_lock = threading.Lock()
+_origin = time.perf_counter()
+
+
+def is_enabled() -> bool:
+    return constants.TRACE_FILE is not None
+
+
+def record_span(name: str, category: str, start: float, end: float, **args: Any) -> None:
+    """Record an already finished span."""
+    if not is_enabled():
+        return
+    args = {key: redaction.redact_value(value) for key, value in args.items()}
+    with _spans_lock:
+        _spans.append(Span(redaction.redact(name), category, start, end, threading.get_ident(), args))
+
+
+@contextmanager
+def span(name: str, category: str, **args: Any) -> Iterator[dict[str, Any]]:
+    """
+    Record a span around the body of the with block.
+
+    The yielded dict are the span's arguments, the body can add more of them (e.g. the exit code).
+    """
+    if not is_enabled():
+        yield args
+        return
+
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        record_span(name, category, start, time.perf_counter(), **args)
+
+
+def to_chrome_trace() -> dict:
+    """Convert the recorded spans to Chrome trace event format (loadable in Perfetto or chrome://tracing)."""
+    pid = os.getpid()
+    with _spans_lock:
+        spans = list(_spans)
+    events = [
+        {
+            "name": span.name,
+            "cat": span.category,
+            "ph": "X",
+            "ts": (span.start - _origin) * 1_000_000,
+            "dur": span.duration * 1_000_000,
+            "pid": pid,
+            "tid": span.thread_id,
+            "args": span.args,
+        }
+        for span in spans
+    ]
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def export(path: Path) -> None:
+    path.write_text(json.dumps(to_chrome_trace(), default=str))
+
+
+def print_summary(limit: int = SUMMARY_SIZE) -> None:
+    """Print the slowest steps and commands, along with the time spent waiting on the user."""
+    with _spans_lock:
+        spans = list(_spans)
+    total = time.perf_counter() - _origin
+    user_wait = sum(span.duration for span in spans if span.category == USER_WAIT)
+
+    print(f"{constants.INFO_COLOR}Slowest steps:")
+    slowest = sorted(
+        (span for span in spans if span.category in (STEP, COMMAND)),
+        key=lambda span: span.duration,
+        reverse=True,
+    )
+    for span in slowest[:limit]:
+        print(f"    {span.duration:8.2f}s  [{span.category}] {span.name}")
+    print(f"    Total: {total:.2f}s, of which {user_wait:.2f}s was spent waiting for user input")
+
+
+def _finish(path: Optional[Path]) -> None:
+    if path is None:
+        return
+    export(path)
+    print_summary()
+    print(f"{constants.NOTE_COLOR}Trace written to {path}")
+
+
+atexit.register(lambda: _finish(constants.TRACE_FILE))
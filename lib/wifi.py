@@ -0,0 +1,226 @@
+"""
+Wi-Fi networks and station state of iwd, waiting only as long as iwd actually needs.
+
+Changes of the station (scan finished, connected) are received from iwd's D-Bus signals
+when the bus is available, otherwise `iwctl station ... show` is polled with a backoff.
+"""
+import os
+import re
+import time
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional, Union
+
+from lib import commands, dbus
+
+# Bus iwd is reached on, point this to another bus (e.g. a session bus with a stand-in service) for testing
+IWD_BUS_ADDRESS = os.getenv("ARCHDEPLOY_IWD_BUS", dbus.SYSTEM_BUS_ADDRESS)
+IWD_SERVICE = "net.connman.iwd"
+DEVICE_INTERFACE = "net.connman.iwd.Device"
+STATION_INTERFACE = "net.connman.iwd.Station"
+
+# Known network profiles, iwd picks up new ones from here without a restart
+IWD_STORAGE_DIR = Path("/var/lib/iwd")
+# SSIDs made of only these characters are used as profile names directly, others are hex-encoded
+PROFILE_NAME_RE = re.compile(r"^[A-Za-z0-9 _-]+$")
+
+# How long (in seconds) a scan or a connection attempt may take
+SCAN_TIMEOUT = 15
+CONNECT_TIMEOUT = 30
+# First and longest interval between two polls of the station state
+POLL_INTERVAL = 0.1
+POLL_INTERVAL_MAX = 1.0
+
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+# Row of `iwctl station ... get-networks`, the SSID can contain spaces, the connected one is marked with `>`
+NETWORK_ROW = re.compile(r"^\s*(?P<connected>>\s+)?(?P<ssid>\S.*?)\s+(?P<security>\S+)\s+(?P<signal>-?\d+|\*+)\s*$")
+# Row of `iwctl station ... show`, settable properties are marked with `*`
+STATION_ROW = re.compile(r"^\s*\*?\s*(?P<property>Scanning|State)\s+(?P<value>\S+)\s*$")
+
+
+def strip_ansi(text: str) -> str:
+    return ANSI_ESCAPE.sub("", text)
+
+
+class WifiNetwork(NamedTuple):
+    ssid: str
+    security: str
+    # Signal strength in dBm, `None` if iwctl only showed it as stars
+    signal: Optional[float]
+    connected: bool = False
+
+    def describe(self) -> str:
+        signal = "unknown signal" if self.signal is None else f"{self.signal:.0f} dBm"
+        return f"{self.ssid} ({self.security}, {signal}{', connected' if self.connected else ''})"
+
+
+def parse_networks(output: str) -> list[WifiNetwork]:
+    """Parse the output of `iwctl station ... get-networks rssi-dbms`, strongest networks first."""
+    networks = []
+    for line in strip_ansi(output).splitlines():
+        match = NETWORK_ROW.match(line)
+        if match is None:
+            # Title, header and separator rows
+            continue
+        signal = match["signal"]
+        networks.append(WifiNetwork(
+            ssid=match["ssid"],
+            security=match["security"],
+            # rssi-dbms shows hundredths of dBm
+            signal=None if signal.startswith("*") else int(signal) / 100,
+            connected=match["connected"] is not None,
+        ))
+    return sorted(networks, key=lambda network: float("-inf") if network.signal is None else network.signal,
+                  reverse=True)
+
+
+class StationState(NamedTuple):
+    state: Optional[str]
+    scanning: bool
+
+
+def parse_station(output: str) -> StationState:
+    """Parse the output of `iwctl station ... show`."""
+    properties = {}
+    for line in strip_ansi(output).splitlines():
+        match = STATION_ROW.match(line)
+        if match is not None:
+            properties[match["property"]] = match["value"]
+    return StationState(properties.get("State"), properties.get("Scanning") == "yes")
+
+
+class PolledStation:
+    """Station state read with iwctl, polled with an increasing interval."""
+
+    def __init__(self, interface_name: str):
+        self.interface_name = interface_name
+
+    def __enter__(self) -> "PolledStation":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        pass
+
+    def read_state(self) -> StationState:
+        proc = commands.run_cmd(f"iwctl station {self.interface_name} show", capture_out=True, read_only=True)
+        if proc.returncode != 0:
+            return StationState(None, False)
+        return parse_station(proc.stdout.decode(errors="replace"))
+
+    def wait_for(self, condition: Callable[[StationState], bool], timeout: float) -> Optional[StationState]:
+        """Wait until `condition(state)` holds, return the state or `None` on timeout."""
+        deadline = time.monotonic() + timeout
+        interval = POLL_INTERVAL
+        while True:
+            state = self.read_state()
+            if condition(state):
+                return state
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, POLL_INTERVAL_MAX)
+
+
+class DBusStation:
+    """Station state followed through the PropertiesChanged signals of iwd."""
+
+    def __init__(self, interface_name: str, bus_address: str = IWD_BUS_ADDRESS):
+        self.interface_name = interface_name
+        self.bus = dbus.Connection(bus_address)
+        try:
+            # Subscribe first, so that no change after reading the initial state is missed
+            self.bus.add_match(
+                type="signal", sender=IWD_SERVICE, interface=dbus.PROPERTIES_INTERFACE,
+                member="PropertiesChanged", arg0=STATION_INTERFACE,
+            )
+            self.path = self._find_station()
+        except (OSError, dbus.DBusError):
+            self.bus.close()
+            raise
+
+    def _find_station(self) -> str:
+        objects = self.bus.get_managed_objects(IWD_SERVICE)
+        for path, interfaces in objects.items():
+            device = interfaces.get(DEVICE_INTERFACE)
+            if device is not None and device.get("Name") == self.interface_name and STATION_INTERFACE in interfaces:
+                return path
+        raise dbus.DBusError(f"iwd has no station for {self.interface_name}")
+
+    def __enter__(self) -> "DBusStation":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.bus.close()
+
+    def read_state(self) -> StationState:
+        properties = self.bus.call(
+            IWD_SERVICE, self.path, dbus.PROPERTIES_INTERFACE, "GetAll", "s", (STATION_INTERFACE,)
+        )[0]
+        return StationState(properties.get("State"), bool(properties.get("Scanning", False)))
+
+    def wait_for(self, condition: Callable[[StationState], bool], timeout: float) -> Optional[StationState]:
+        """Wait until `condition(state)` holds, return the state or `None` on timeout."""
+        deadline = time.monotonic() + timeout
+        state = self.read_state()
+        while not condition(state):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            message = self.bus.receive(remaining)
+            if message is None:
+                return None
+            if message.member != "PropertiesChanged" or message.path != self.path:
+                continue
+            _, changed, invalidated = message.body
+            if invalidated:
+                state = self.read_state()
+            else:
+                state = StationState(changed.get("State", state.state), bool(changed.get("Scanning", state.scanning)))
+        return state
+
+
+def watch_station(interface_name: str) -> Union[DBusStation, PolledStation]:
+    """
+    Start following the state of the station of given wireless interface.
+
+    The returned watcher (`DBusStation` or `PolledStation`) should be created before the
+    action whose result is waited for, so that the D-Bus signals of it can't be missed.
+    """
+    try:
+        return DBusStation(interface_name)
+    except (OSError, dbus.DBusError):
+        return PolledStation(interface_name)
+
+
+def profile_path(ssid: str, security: str = "psk") -> Path:
+    """Get the path of the iwd profile of given network."""
+    name = ssid if PROFILE_NAME_RE.match(ssid) else "=" + ssid.encode().hex()
+    return IWD_STORAGE_DIR / f"{name}.{security}"
+
+
+def store_passphrase(ssid: str, passphrase: str) -> bool:
+    """
+    Save the passphrase of given network in its iwd profile, return whether it was saved.
+
+    iwd then connects without asking for it, so the passphrase doesn't have to be on
+    the command line of iwctl (where anyone could see it, e.g. with `ps`).
+    """
+    if "\n" in passphrase:
+        return False
+    proc = commands.write_root_file(profile_path(ssid), f"[Security]\nPassphrase={passphrase}\n", mode="600")
+    return proc.returncode == 0
+
+
+def scan_done(state: StationState) -> bool:
+    return not state.scanning
+
+
+def connection_done(state: StationState) -> bool:
+    """Check if the station is done connecting (successfully or not)."""
+    return state.state not in ("connecting", "roaming")
@@ -1,30 +1,477 @@
 #!/usr/bin/env python3
+import argparse
+import sys
+import tempfile
+import threading
+import time
 from pathlib import Path
+from typing import Any, Callable, Optional
 
-from lib import constants, internet, commands, disk, questions
+from lib import (
+    answers, cacheserver, constants, internet, commands, disk, image, installplan, journal, mirrors, offline, pacman,
+    prefetch, questions, targets,
+)
+from lib.journal import Checkpoint, Journal
+from lib.scheduler import NETWORK, TERMINAL, Results, Scheduler, Step, StepFailed, disk_resource
 
 
-def main():
-    commands.run_cmd("clear", enable_debug=False)
-    internet.connect_internet()
+def partition_disks(results: Results) -> set[str]:
+    """Get the disk resources used by the partition scheme."""
+    return {disk_resource(partition.get_device()) for partition in results["scheme"]}
+
+
+def connect(results: Results) -> bool:
+    commands.run_cmd("clear", enable_debug=False, read_only=True)
+    return internet.connect_internet()
+
+
+def enable_ntp(results: Results) -> None:
     commands.run_root_cmd("timedatectl set-ntp true")
 
-    disk.partition_disk()
-    partition_scheme = disk.get_partition_scheme()
-    disk.format_partitions(partition_scheme)
-    disk.mount_partitions(Path("/mnt"), partition_scheme)
 
+def rank_mirrors(results: Results) -> None:
+    if results["connect"]:
+        mirrors.rank_mirrors()
+        use_cache_server()
+
+
+def use_cache_server() -> None:
+    """Put the package cache server (if configured) at the top of the mirrorlist."""
+    server = constants.CACHE_SERVER
+    if server == "auto":
+        server = cacheserver.discover()
+        if server is None:
+            print(f"{constants.NOTE_COLOR}No package cache server found on the local network.")
+            return
+    if server is not None:
+        print(f"{constants.INFO_COLOR}Using package cache server {constants.CMD_COLOR}{server}")
+        mirrors.prepend_server(server)
+
+
+def refresh_keyring(results: Results) -> None:
+    if results["connect"]:
+        # The keyring on the live ISO may be outdated, making pacstrap fail on newer signatures
+        commands.run_root_cmd("pacman -Sy --noconfirm archlinux-keyring")
+
+
+def start_prefetch(results: Results):
+    # Packages downloaded now wouldn't be on the machine the install plan runs on
+    if results["connect"] and not installplan.is_active():
+        return prefetch.start_prefetch()
+    return None
+
+
+def run_pacstrap(results: Results) -> None:
+    if results.get("prefetch") is not None:
+        results["prefetch"].wait()
+    config = None
+    if results.get("offline") is not None:
+        config = pacman.write_install_config(
+            constants.CACHE_DIR / "pacman-offline.conf", offline_repo=results["offline"]
+        )
     print(f"{constants.NOTE_COLOR}Running pacstrap...")
-    commands.run_root_cmd("pacstrap /mnt base linux linux-firmware python")
+    proc = pacman.pacstrap(Path("/mnt"), config=config)
+    if proc.returncode != 0:
+        # Failing the step keeps it out of the journal, so that a resumed install runs pacstrap again
+        raise OSError(f"pacstrap failed with exit code {proc.returncode}")
+    pacman.configure_target(Path("/mnt"))
+
+
+def build_image(results: Results) -> Path:
+    if results["prefetch"] is not None:
+        results["prefetch"].wait()
+    print(f"{constants.NOTE_COLOR}Building system image...")
+    return image.build()
+
+
+def deploy_image(image_path: Path) -> None:
+    image.deploy(Path("/mnt"), image_path)
+
+
+def fixup_deployed(results: Results) -> None:
+    hostname = questions.text("Enter the hostname for this machine", default="archlinux", key="install.hostname")
+    image.fixup(Path("/mnt"), hostname)
+
+
+def generate_fstab(results: Results) -> None:
     print(f"{constants.NOTE_COLOR}Generating fstab...")
-    commands.run_root_cmd("genfstab -U /mnt >> /mnt/etc/fstab")
+    disk.write_fstab(Path("/mnt"), results["mount"])
+
+
+def serialize_scheme(scheme: Optional[list[disk.Partition]]) -> Optional[list[dict]]:
+    return None if scheme is None else [partition.to_dict() for partition in scheme]
+
+
+def deserialize_scheme(data: Optional[list[dict]]) -> Optional[list[disk.Partition]]:
+    return None if data is None else [disk.Partition.from_dict(partition) for partition in data]
+
+
+SCHEME_CHECKPOINT = Checkpoint(
+    outputs=lambda results, scheme: [partition.path.exists() for partition in scheme or []],
+    serialize=serialize_scheme,
+    deserialize=deserialize_scheme,
+)
+FORMAT_CHECKPOINT = Checkpoint(
+    inputs=lambda results: serialize_scheme(results["scheme"]),
+    outputs=lambda results, result: [partition.get_filesystem_info() for partition in results["scheme"]],
+)
+PACSTRAP_CHECKPOINT = Checkpoint(
+    inputs=lambda results: [constants.BASE_PACKAGES, serialize_scheme(results["scheme"])],
+    outputs=lambda results, result: [
+        journal.hash_listing(Path("/mnt/var/lib/pacman/local")),
+        journal.hash_file(Path("/mnt/etc/pacman.conf")),
+    ],
+)
+
+
+def deploy_checkpoint(image_path: Path) -> Checkpoint:
+    return Checkpoint(
+        inputs=lambda results: [image_path.name, serialize_scheme(results["scheme"])],
+        outputs=lambda results, result: journal.hash_listing(Path("/mnt/var/lib/pacman/local")),
+    )
+
+
+FSTAB_CHECKPOINT = Checkpoint(
+    inputs=lambda results: serialize_scheme(results["scheme"]),
+    outputs=lambda results, result: journal.hash_file(Path("/mnt/etc/fstab")),
+)
+
+
+def get_network_steps() -> list[Step]:
+    """Get the steps preparing for package installation (connection, mirrors, keyring and prefetch)."""
+    return [
+        Step("connect", connect, resources=[TERMINAL, NETWORK]),
+        Step("ntp", enable_ntp, depends=["connect"], resources=[NETWORK]),
+        Step("mirrors", rank_mirrors, depends=["connect"], resources=[NETWORK]),
+        Step("keyring", refresh_keyring, depends=["mirrors"], resources=[NETWORK]),
+        Step("prefetch", start_prefetch, depends=["mirrors"]),
+    ]
+
+
+def get_offline_steps(source: Path) -> list[Step]:
+    """Get the steps preparing for package installation without network (the local repository)."""
+    return [Step("offline", lambda results: offline.prepare_repo(source))]
+
+
+def get_disk_steps() -> list[Step]:
+    """Get the steps preparing the disks (partitioning, formatting and mounting)."""
+    return [
+        Step("partition", lambda results: disk.partition_disk(), resources=[TERMINAL], checkpoint=SCHEME_CHECKPOINT),
+        Step(
+            "scheme", lambda results: disk.get_partition_scheme(results["partition"]), depends=["partition"],
+            resources=[TERMINAL], checkpoint=SCHEME_CHECKPOINT,
+        ),
+        Step(
+            "format", lambda results: disk.format_partitions(results["scheme"]), depends=["scheme"],
+            resources=lambda results: {TERMINAL, *partition_disks(results)}, checkpoint=FORMAT_CHECKPOINT,
+        ),
+        Step(
+            "mount", lambda results: disk.mount_partitions(Path("/mnt"), results["scheme"]), depends=["format"],
+            resources=partition_disks,
+        ),
+    ]
+
+
+def get_install_steps(image_path: Optional[Path] = None, offline_source: Optional[Path] = None) -> list[Step]:
+    """
+    Get the install steps, along with their dependencies and resources.
+
+    With `image_path`, the system is deployed from a prebuilt image instead of running pacstrap,
+    which doesn't need network at all. Neither does pacstrap from the local repository made
+    out of the packages in `offline_source`.
+    """
+    if image_path is None:
+        if offline_source is None:
+            package_steps = get_network_steps()
+            package_depends = ["ntp", "keyring", "prefetch"]
+        else:
+            package_steps = get_offline_steps(offline_source)
+            package_depends = ["offline"]
+        return [
+            *package_steps,
+            *get_disk_steps(),
+            Step(
+                "pacstrap", run_pacstrap, depends=["mount", *package_depends],
+                resources=[NETWORK, TERMINAL] if offline_source is None else [TERMINAL], checkpoint=PACSTRAP_CHECKPOINT,
+            ),
+            Step("fstab", generate_fstab, depends=["mount", "pacstrap"], checkpoint=FSTAB_CHECKPOINT),
+        ]
+    return [
+        *get_disk_steps(),
+        Step(
+            "deploy", lambda results: deploy_image(image_path), depends=["mount"],
+            resources=partition_disks, checkpoint=deploy_checkpoint(image_path),
+        ),
+        Step("fixup", fixup_deployed, depends=["deploy"], resources=[TERMINAL]),
+        Step("fstab", generate_fstab, depends=["mount", "deploy"], checkpoint=FSTAB_CHECKPOINT),
+    ]
+
+
+def get_build_steps() -> list[Step]:
+    """Get the steps for building a system image."""
+    return [
+        *get_network_steps(),
+        Step("build", build_image, depends=["ntp", "keyring", "prefetch"], resources=[NETWORK, TERMINAL]),
+    ]
+
+
+def load_journal() -> Journal:
+    """Load the journal of a previous install, letting the user decide whether to resume it."""
+    install_journal = Journal()
+    if len(install_journal.steps) != 0:
+        print(
+            f"{constants.INFO_COLOR}Found a previous unfinished install, completed steps: "
+            + ", ".join(install_journal.steps)
+        )
+        if not questions.confirm(
+            "Do you wish to resume it (skipping the steps which are still valid)?", default=True, key="install.resume"
+        ):
+            install_journal.clear()
+    return install_journal
+
+
+# Contents of the file which tells multi-install targets that the shared download is over
+PACKAGES_DOWNLOADED = "downloaded"
+PACKAGES_MISSING = "missing"
+
+
+def install_target(
+    device: Path,
+    root: Path,
+    image_path: Optional[Path],
+    pacman_config: Optional[Path],
+    packages_ready: Optional[Path],
+    offline_repo: Optional[Path] = None,
+) -> None:
+    """Install onto a single target device without asking anything, reporting progress to the managing process."""
+    def step(name: str, func: Callable[[], Any]) -> Any:
+        targets.report(step=name)
+        return func()
+
+    partitions = step("partition", lambda: disk.partition_target(device))
+    step("format", lambda: disk.format_target(partitions))
+    plan = step("mount", lambda: disk.mount_partitions(root, partitions))
+    if image_path is None:
+        cache_dir = constants.PACKAGE_CACHE_DIR
+        if offline_repo is not None:
+            # Packages are copied from the repository into the cache, targets would race on the files in a shared one
+            cache_dir = constants.PACKAGE_CACHE_DIR / device.name
+            pacman_config = pacman.write_install_config(
+                constants.CACHE_DIR / f"pacman-{device.name}.conf", cache_dir=cache_dir, offline_repo=offline_repo
+            )
+        elif packages_ready is not None:
+            # The managing process downloads packages for all of the targets at once
+            if not step("download", lambda: _wait_for_packages(packages_ready)):
+                # Targets download on their own then, each into its own cache so that they don't race on the files
+                cache_dir = constants.PACKAGE_CACHE_DIR / device.name
+                pacman_config = pacman.write_install_config(
+                    constants.CACHE_DIR / f"pacman-{device.name}.conf", cache_dir=cache_dir
+                )
+        proc = step("pacstrap", lambda: pacman.pacstrap(root, config=pacman_config, cache_dir=cache_dir))
+        if proc.returncode != 0:
+            raise OSError(f"pacstrap failed with exit code {proc.returncode}")
+        pacman.configure_target(root)
+    else:
+        step("deploy", lambda: image.deploy(root, image_path))
+        step("fixup", lambda: image.fixup(root, answers.get("install.hostname", "archlinux")))
+    step("fstab", lambda: disk.write_fstab(root, plan))
+
+
+def _wait_for_packages(packages_ready: Path) -> bool:
+    """Wait for the managing process to finish the shared download, return whether all packages were downloaded."""
+    while not packages_ready.exists():
+        time.sleep(1)
+    return packages_ready.read_text() == PACKAGES_DOWNLOADED
+
+
+def _mark_packages_ready(packages_ready: Path, downloaded: bool) -> None:
+    # Renamed into place, so that the targets never read a partially written file
+    tmp_path = packages_ready.with_suffix(".tmp")
+    tmp_path.write_text(PACKAGES_DOWNLOADED if downloaded else PACKAGES_MISSING)
+    tmp_path.rename(packages_ready)
+
+
+def run_target(args: argparse.Namespace) -> None:
+    try:
+        install_target(args.device, args.root, args.image, args.pacman_config, args.packages_ready, args.offline_repo)
+    except Exception as exc:
+        print(f"{constants.ERROR_COLOR}{exc!r}")
+        targets.report(error=str(exc))
+        sys.exit(1)
+
+
+def run_multi(args: argparse.Namespace) -> None:
+    """Install onto multiple devices at once, doing the shared work (mirrors, downloads) only once."""
+    image_path = image.find_image(args.image) if args.image is not None else None
+    offline_source = args.offline_source if args.offline and image_path is None else None
+    # Escalate once up front, all of the target processes run through the same root worker
+    commands.run_root_cmd(["true"], enable_debug=False)
+
+    target_args = []
+    packages_ready = Path(tempfile.mkdtemp(prefix="archdeploy-multi-")) / "packages-ready"
+    if image_path is not None:
+        target_args += ["--image", str(image_path)]
+    elif offline_source is not None:
+        # Before touching any of the devices, there's no point in partitioning them if packages are missing
+        target_args += ["--offline-repo", str(offline.prepare_repo(offline_source))]
+    else:
+        target_args += [
+            "--pacman-config", str(pacman.write_install_config()),
+            "--packages-ready", str(packages_ready),
+        ]
+    started = targets.start_targets(args.devices, Path(__file__).resolve(), target_args)
+    display = threading.Thread(target=targets.wait_for_targets, args=(started,), name="target-progress", daemon=True)
+    display.start()
+
+    if image_path is None and offline_source is None:
+        # Targets partition, format and mount in the meantime, they only wait for the packages before pacstrap
+        downloaded = False
+        try:
+            results = Scheduler(get_network_steps()).run()
+            downloaded = results["prefetch"] is not None and results["prefetch"].wait()
+        except StepFailed as exc:
+            print(f"{constants.ERROR_COLOR}{exc}")
+        finally:
+            if not downloaded:
+                print(f"{constants.WARN_COLOR}Targets will download the packages themselves, each into its own cache.")
+            _mark_packages_ready(packages_ready, downloaded)
+
+    display.join()
+    targets.print_results(started)
+    if any(target.returncode != 0 for target in started):
+        sys.exit(1)
+
+
+def run_plan(args: argparse.Namespace) -> None:
+    """Record the commands of the install into a plan instead of running them, then show or save the plan."""
+    image_path = image.find_image(args.image) if args.image is not None else None
+    offline_source = args.offline_source if args.offline else None
+    plan = installplan.start()
+    # One step at a time, so that the plan is the same on every run (and commands belong to their steps)
+    Scheduler(get_install_steps(image_path, offline_source), max_workers=1).run()
+
+    if args.format == "text":
+        plan.print()
+        return
+    output = plan.to_json() if args.format == "json" else plan.to_script()
+    secret = args.format == "script" and plan.has_secrets()
+    if secret:
+        # Not to stdout, it could be the script itself
+        print(
+            f"{constants.WARN_COLOR}The script contains secrets from the answer file (like the Wi-Fi passphrase), "
+            "keep it private.",
+            file=sys.stderr,
+        )
+    if args.output is None:
+        # Bypass the color resetting wrapper, the output has to stay as it is
+        assert sys.__stdout__ is not None
+        sys.__stdout__.write(output)
+        return
+    if args.format == "script":
+        # Before writing, so that the secrets are never readable by others
+        args.output.touch()
+        args.output.chmod(0o700 if secret else 0o755)
+    args.output.write_text(output)
+    print(f"{constants.SUCCESS_COLOR}Install plan written to {args.output}")
+
+
+def run_cache_server(args: argparse.Namespace) -> None:
+    cacheserver.serve(args.dir, int(args.max_size * 1024 ** 3), args.port, args.upstream)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Install Arch Linux (before chrooting into the new system).")
+    parser.add_argument(
+        "--offline", action="store_true", default=constants.OFFLINE_SOURCE is not None,
+        help="install without network, from the packages of --offline-source",
+    )
+    parser.add_argument(
+        "--offline-source", type=Path, default=constants.OFFLINE_SOURCE or constants.PACKAGE_CACHE_DIR,
+        help="directory or partition with the packages for offline installs (default: the package cache)",
+    )
+    parser.add_argument(
+        "--cache-server", default=constants.CACHE_SERVER,
+        help="mirrorlist URL of a package cache server to download through, or auto to discover one",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("install", help="install the system with pacstrap (default)")
+    subparsers.add_parser("build", help="install the system once into a staging root and pack it into an image")
+    deploy_parser = subparsers.add_parser("deploy", help="install the system from a prebuilt image, without network")
+    deploy_parser.add_argument("--image", type=Path, help="image to deploy (default: the most recently built one)")
+
+    multi_parser = subparsers.add_parser("multi", help="install onto multiple devices at once, without questions")
+    multi_parser.add_argument("devices", type=Path, nargs="+", help="devices to install onto (erased completely)")
+    multi_parser.add_argument("--image", type=Path, help="deploy this image instead of running pacstrap")
+
+    plan_parser = subparsers.add_parser("plan", help="show the commands the install would run, without running them")
+    plan_parser.add_argument("--image", type=Path, help="plan deploying this image instead of running pacstrap")
+    plan_parser.add_argument(
+        "--format", choices=["text", "json", "script"], default="text",
+        help="text for review, json for diffing plans, script for a standalone shell script running the plan",
+    )
+    plan_parser.add_argument("--output", "-o", type=Path, help="file to write the plan to (default: stdout)")
+
+    serve_parser = subparsers.add_parser("cache-serve", help="serve a package cache for installs on the local network")
+    serve_parser.add_argument("--port", type=int, default=cacheserver.DEFAULT_PORT)
+    serve_parser.add_argument(
+        "--dir", type=Path, default=constants.CACHE_DIR / "serve", help="directory to store the cached packages in"
+    )
+    serve_parser.add_argument(
+        "--max-size", type=float, default=cacheserver.DEFAULT_MAX_SIZE / 1024 ** 3,
+        help="size limit of the cache in GiB, least recently used packages are evicted over it",
+    )
+    serve_parser.add_argument(
+        "--upstream", action="append",
+        help="mirror to fetch packages from, as in a mirrorlist (default: the servers of the host's mirrorlist)",
+    )
+
+    # Used by multi for each of the devices
+    target_parser = subparsers.add_parser("target", help="install onto a single device, without questions")
+    target_parser.add_argument("--device", type=Path, required=True)
+    target_parser.add_argument("--root", type=Path, required=True)
+    target_parser.add_argument("--image", type=Path)
+    target_parser.add_argument("--pacman-config", type=Path)
+    target_parser.add_argument("--packages-ready", type=Path)
+    target_parser.add_argument("--offline-repo", type=Path)
+
+    args = parser.parse_args()
+    # ARCHDEPLOY_OFFLINE also reaches the other commands (like target processes of multi), only the flag is an error
+    if args.offline and args.command not in (None, "install", "multi", "plan") and constants.OFFLINE_SOURCE is None:
+        parser.error("--offline only applies to install, multi and plan")
+    return args
+
+
+def main():
+    args = parse_args()
+    constants.CACHE_SERVER = args.cache_server
+    if args.command == "cache-serve":
+        return run_cache_server(args)
+    if args.command == "multi":
+        return run_multi(args)
+    if args.command == "target":
+        return run_target(args)
+    if args.command == "plan":
+        return run_plan(args)
+    if args.command == "build":
+        scheduler = Scheduler(get_build_steps())
+        scheduler.run()
+        scheduler.print_critical_path()
+        return
+
+    image_path = image.find_image(args.image) if args.command == "deploy" else None
+    install_journal = load_journal()
+    offline_source = args.offline_source if args.offline else None
+    scheduler = Scheduler(get_install_steps(image_path, offline_source), journal=install_journal)
+    scheduler.run()
+    scheduler.print_critical_path()
 
-    if questions.confirm("Do you wish to drop to shell before chrooting?"):
+    if questions.confirm("Do you wish to drop to shell before chrooting?", key="install.drop_to_shell"):
         commands.drop_to_shell()
 
     cwd = Path.cwd()
     commands.run_root_cmd(f"cp -r '{str(cwd)}' /mnt/opt/ArchDeploy")
-    commands.run_root_cmd("arch-chroot /mnt /opt/ArchDeploy/post-chroot.py")
+    if commands.run_root_cmd("arch-chroot /mnt /opt/ArchDeploy/post-chroot.py").returncode == 0:
+        install_journal.clear()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+import shutil
+import subprocess
+import threading
+from typing import Any, Callable
+
+import pytest
+
+from lib import dbus
+
+
+@pytest.fixture
+def bus_address():
+    """Address of a private session bus, started for the test."""
+    daemon = shutil.which("dbus-daemon")
+    if daemon is None:
+        pytest.skip("dbus-daemon isn't installed")
+    proc = subprocess.Popen(
+        [daemon, "--session", "--nofork", "--print-address"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    assert proc.stdout is not None
+    address = proc.stdout.readline().strip()
+    yield address
+    proc.terminate()
+    proc.wait()
+
+
+class FakeService:
+    """
+    Service on a test bus, answering method calls with handlers (by member name) in a thread.
+
+    A handler gets the arguments of the call and returns the signature and arguments of the reply.
+    """
+
+    def __init__(self, address: str, name: str, handlers: dict[str, Callable[..., tuple[str, tuple]]]):
+        self.handlers = handlers
+        self.bus = dbus.Connection(address)
+        self.bus.call(dbus.BUS_NAME, dbus.BUS_PATH, dbus.BUS_NAME, "RequestName", "su", (name, 0))
+        self._send_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _send(self, message_type: int, fields: dict[int, Any], signature: str = "", args: tuple = ()) -> None:
+        with self._send_lock:
+            self.bus.send(message_type, fields, signature, args)
+
+    def _serve(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                message = self.bus.receive(0.05)
+            except (OSError, dbus.DBusError):
+                return
+            if message is None or message.type != dbus.METHOD_CALL:
+                continue
+            reply_fields = {dbus.FIELD_REPLY_SERIAL: message.serial, dbus.FIELD_DESTINATION: message.sender}
+            handler = self.handlers.get(message.member or "")
+            try:
+                if handler is None:
+                    raise LookupError(f"no method {message.member}")
+                signature, args = handler(*message.body)
+            except Exception as exc:
+                self._send(dbus.ERROR, {**reply_fields, dbus.FIELD_ERROR_NAME: "org.example.Error"}, "s", (str(exc),))
+            else:
+                self._send(dbus.METHOD_RETURN, reply_fields, signature, args)
+
+    def emit(self, path: str, interface: str, member: str, signature: str = "", args: tuple = ()) -> None:
+        fields = {dbus.FIELD_PATH: path, dbus.FIELD_INTERFACE: interface, dbus.FIELD_MEMBER: member}
+        self._send(dbus.SIGNAL, fields, signature, args)
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+        self.bus.close()
+
+
+@pytest.fixture
+def make_service(bus_address):
+    services = []
+
+    def make(name: str, handlers: dict[str, Callable[..., tuple[str, tuple]]]) -> FakeService:
+        services.append(FakeService(bus_address, name, handlers))
+        return services[-1]
+
+    yield make
+    for service in services:
+        service.close()
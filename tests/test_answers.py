@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+from lib import answers, internet, questions
+
+ANSWERS = """
+[install]
+hostname = "archlinux"
+
+[partitions]
+auto_swap_size = "8G"
+scheme.root = "/dev/sda2"
+
+[network.wifi]
+ssid = ["Missing", "HomeNet"]
+
+[hosts."52:54:00:12:34:56".install]
+hostname = "build-1"
+
+[hosts.SERIAL-2.install]
+hostname = "build-2"
+"""
+
+
+@pytest.fixture
+def answer_file(tmp_path, monkeypatch):
+    def load(host_ids: list[str]) -> answers.AnswerFile:
+        path = tmp_path / "answers.toml"
+        path.write_text(ANSWERS)
+        answer_file = answers.AnswerFile(path, host_ids)
+        monkeypatch.setattr(answers, "_answer_file", answer_file)
+        return answer_file
+    return load
+
+
+def test_nested_keys_flattened(answer_file):
+    loaded = answer_file([])
+    assert loaded.get("partitions.auto_swap_size") == "8G"
+    assert loaded.get("partitions.scheme.root") == "/dev/sda2"
+    assert loaded.get("partitions") is answers._MISSING
+    assert loaded.host_id is None
+    assert loaded.get("install.hostname") == "archlinux"
+
+
+def test_json_answer_file(tmp_path):
+    path = tmp_path / "answers.json"
+    path.write_text(json.dumps({"install": {"hostname": "from-json"}}))
+    assert answers.AnswerFile(path, []).get("install.hostname") == "from-json"
+
+
+def test_host_overrides(answer_file):
+    # MAC addresses are matched regardless of their case
+    loaded = answer_file(["00:11:22:33:44:55", "52:54:00:12:34:56".upper()])
+    assert loaded.host_id == "52:54:00:12:34:56".upper()
+    assert loaded.get("install.hostname") == "build-1"
+    # Only the overridden answers change
+    assert loaded.get("partitions.auto_swap_size") == "8G"
+
+    assert answer_file(["serial-2"]).get("install.hostname") == "build-2"
+
+
+def test_list_answers_consumed_in_order(answer_file):
+    loaded = answer_file([])
+    assert loaded.get("network.wifi.ssid") == "Missing"
+    assert loaded.get("network.wifi.ssid") == "HomeNet"
+    assert loaded.get("network.wifi.ssid") is answers._MISSING
+    # Raw answers get the whole list
+    assert answers.get("network.wifi.ssid") == ["Missing", "HomeNet"]
+
+
+def test_questions_answered(answer_file):
+    answer_file([])
+    assert questions.choice("Pick a network", ["HomeNet", "Missing"], key="network.wifi.ssid") == "Missing"
+    assert questions.choice("Pick a network", ["HomeNet", "Missing"], key="network.wifi.ssid") == "HomeNet"
+    with pytest.raises(questions.MissingAnswerError, match="network.wifi.ssid"):
+        questions.choice("Pick a network", ["HomeNet", "Missing"], key="network.wifi.ssid")
+
+
+def test_missing_answer(answer_file):
+    answer_file([])
+    with pytest.raises(questions.MissingAnswerError, match="install.timezone"):
+        questions.text("Enter the timezone", key="install.timezone")
+    # The default of `confirm` is only for pressing enter, an explicit one is needed
+    with pytest.raises(questions.MissingAnswerError):
+        questions.confirm("Continue?", key="install.continue")
+    with pytest.raises(questions.MissingAnswerError, match="no key"):
+        questions.text("Enter anything")
+
+
+def test_missing_answer_with_default(answer_file):
+    answer_file([])
+    assert questions.text("Enter the swap size", default="4G", key="partitions.swap_size") == "4G"
+    assert questions.confirm("Resume?", default=True, key="install.resume") is True
+    # An answer wins over the default
+    assert questions.text("Enter the swap size", default="4G", key="partitions.auto_swap_size") == "8G"
+
+
+def test_invalid_answer(answer_file):
+    answer_file([])
+    with pytest.raises(ValueError, match="install.hostname"):
+        questions.confirm("Continue?", key="install.hostname")
+
+
+def test_unattended_wifi_never_opens_a_shell(tmp_path, monkeypatch):
+    path = tmp_path / "answers.toml"
+    path.write_text('[network.wifi]\niwctl_failed = "Drop to shell and connect manually"\n')
+    monkeypatch.setattr(answers, "_answer_file", answers.AnswerFile(path, []))
+    ran = []
+    monkeypatch.setattr(internet, "_ensure_active_interface", lambda interface_type: True)
+    monkeypatch.setattr(internet, "_pick_wireless_interface", lambda: "wlan0")
+    monkeypatch.setattr(internet, "_iwctl_connect", lambda interface: ran.append("iwctl connect") or False)
+    monkeypatch.setattr(internet, "connect_ethernet", lambda: False)
+    monkeypatch.setattr(internet.commands, "command_exists", lambda cmd: True)
+    monkeypatch.setattr(internet.commands, "run_cmd", lambda cmd, **kwargs: ran.append(cmd))
+    monkeypatch.setattr(internet.commands, "drop_to_shell", lambda: ran.append("shell"))
+
+    with pytest.raises(questions.MissingAnswerError, match="network.wifi.iwctl_failed"):
+        internet.connect_wifi()
+    # Straight to iwctl, without nmtui
+    assert ran == ["iwctl connect"]
@@ -0,0 +1,193 @@
+import http.server
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import pytest
+
+from lib import cacheserver
+
+PACKAGE = "core/os/x86_64/linux-6.9-1-x86_64.pkg.tar.zst"
+
+
+def _package_content(name: str, size: int = 64 * 1024) -> bytes:
+    return (name.encode() * (size // len(name) + 1))[:size]
+
+
+class FakeMirror(http.server.ThreadingHTTPServer):
+    """Upstream mirror serving files from a dict, counting the requests of every file."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeMirrorHandler)
+        self.files: dict[str, bytes] = {}
+        self.requests: dict[str, int] = {}
+        # Seconds to wait before answering, keeps downloads in flight long enough to overlap
+        self.delay = 0.0
+        # Files whose content is cut short after the headers (announcing the full length)
+        self.truncated: set[str] = set()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/$repo/os/$arch"
+
+
+class FakeMirrorHandler(http.server.BaseHTTPRequestHandler):
+    server: FakeMirror
+
+    def do_GET(self) -> None:
+        name = self.path.lstrip("/")
+        self.server.requests[name] = self.server.requests.get(name, 0) + 1
+        time.sleep(self.server.delay)
+        content = self.server.files.get(name)
+        if content is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if name in self.server.truncated:
+            content = content[:len(content) // 2]
+            self.close_connection = True
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def mirror():
+    server = FakeMirror()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_cache(tmp_path):
+    servers = []
+
+    def make(mirror: FakeMirror, max_size: int = cacheserver.DEFAULT_MAX_SIZE) -> cacheserver.CacheServer:
+        store = cacheserver.PackageStore(tmp_path / "cache", max_size)
+        server = cacheserver.CacheServer(("127.0.0.1", 0), store, [mirror.url])
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _get(server: cacheserver.CacheServer, name: str, headers: Optional[dict] = None) -> tuple[int, bytes]:
+    request = urllib.request.Request(f"http://127.0.0.1:{server.server_port}/{name}", headers=headers or {})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as exc:
+        return exc.code, b""
+
+
+def test_concurrent_requests_download_once(mirror, make_cache):
+    mirror.files[PACKAGE] = _package_content(PACKAGE)
+    mirror.delay = 0.3
+    cache = make_cache(mirror)
+
+    with ThreadPoolExecutor(8) as executor:
+        responses = list(executor.map(lambda _: _get(cache, PACKAGE), range(8)))
+
+    assert responses == [(200, mirror.files[PACKAGE])] * 8
+    assert mirror.requests[PACKAGE] == 1
+    assert cache.misses == 1
+    # Served from the disk from now on
+    assert _get(cache, PACKAGE) == (200, mirror.files[PACKAGE])
+    assert mirror.requests[PACKAGE] == 1
+
+
+def test_range_resumes_download(mirror, make_cache):
+    content = mirror.files[PACKAGE] = _package_content(PACKAGE)
+    cache = make_cache(mirror)
+
+    assert _get(cache, PACKAGE, {"Range": "bytes=1000-"}) == (206, content[1000:])
+    assert _get(cache, PACKAGE, {"Range": f"bytes={len(content)}-"})[0] == 416
+    assert mirror.requests[PACKAGE] == 1
+
+
+def test_least_recently_used_evicted(mirror, make_cache):
+    names = [f"extra/os/x86_64/{name}-1.0-1-x86_64.pkg.tar.zst" for name in ("first", "second", "third")]
+    for name in names:
+        mirror.files[name] = _package_content(name, 1000)
+    cache = make_cache(mirror, max_size=2500)
+
+    _get(cache, names[0])
+    _get(cache, names[1])
+    # Using the first package again makes the second one the least recently used
+    _get(cache, names[0])
+    _get(cache, names[2])
+
+    assert cache.store.lookup(names[1]) is None
+    assert cache.store.lookup(names[0]) is not None
+    assert cache.store.size <= 2500
+    assert len(list(cache.store.objects_dir.glob("*/*"))) == 2
+
+
+def test_truncated_upstream_not_stored(mirror, make_cache):
+    mirror.files[PACKAGE] = _package_content(PACKAGE)
+    mirror.truncated.add(PACKAGE)
+    mirror.delay = 0.3
+    cache = make_cache(mirror)
+
+    with ThreadPoolExecutor(4) as executor:
+        statuses = [status for status, _ in executor.map(lambda _: _get(cache, PACKAGE), range(4))]
+
+    # The waiting requests get the error of the download too, not a misleading 503
+    assert statuses == [502] * 4
+    assert cache.store.lookup(PACKAGE) is None
+    assert list(cache.store.tmp_dir.iterdir()) == []
+
+    # Nothing broken was kept, the next request downloads again
+    mirror.truncated.clear()
+    mirror.delay = 0
+    assert _get(cache, PACKAGE) == (200, mirror.files[PACKAGE])
+
+
+def test_missing_package(mirror, make_cache):
+    cache = make_cache(mirror)
+    assert _get(cache, PACKAGE)[0] == 404
+    assert list(cache.store.tmp_dir.iterdir()) == []
+
+
+def test_concurrent_requests_for_different_packages(mirror, make_cache, monkeypatch):
+    # Every add saves the index, so that they race
+    monkeypatch.setattr(cacheserver, "INDEX_SAVE_INTERVAL", 0)
+    names = [f"extra/os/x86_64/package{index}-1.0-1-x86_64.pkg.tar.zst" for index in range(16)]
+    for name in names:
+        mirror.files[name] = _package_content(name, 1000)
+    mirror.delay = 0.2
+    cache = make_cache(mirror)
+
+    with ThreadPoolExecutor(len(names)) as executor:
+        responses = list(executor.map(lambda name: _get(cache, name), names))
+
+    assert responses == [(200, mirror.files[name]) for name in names]
+    assert cache.misses == len(names)
+    assert list(cache.store.directory.glob("*.tmp")) == []
+    cache.store.save()
+    reloaded = cacheserver.PackageStore(cache.store.directory)
+    assert all(reloaded.lookup(name) is not None for name in names)
+
+
+def test_index_saved_periodically(mirror, make_cache):
+    mirror.files[PACKAGE] = _package_content(PACKAGE)
+    cache = make_cache(mirror)
+
+    assert _get(cache, PACKAGE)[0] == 200
+    # Not rewritten for every package, but on shutdown (or after a while)
+    assert not cache.store.index_file.exists()
+    cache.store.save()
+    assert cacheserver.PackageStore(cache.store.directory).lookup(PACKAGE) is not None
@@ -0,0 +1,177 @@
+import http.server
+import socket
+import threading
+import time
+
+import pytest
+
+from lib import connectivity
+
+
+class FakeProbe(connectivity.Probe):
+    def __init__(self, result: bool, delay: float = 0.0):
+        self.result = result
+        self.delay = delay
+        self.runs = 0
+
+    def run(self, timeout: float) -> bool:
+        self.runs += 1
+        time.sleep(self.delay)
+        return self.result
+
+
+class FailingProbe(connectivity.Probe):
+    def run(self, timeout: float) -> bool:
+        raise RuntimeError("broken probe")
+
+
+def test_probe_must_implement_run():
+    with pytest.raises(TypeError):
+        connectivity.Probe()
+
+
+def test_first_success_wins():
+    slow = FakeProbe(True, delay=5)
+    checker = connectivity.ConnectivityChecker([slow, FakeProbe(False), FakeProbe(True, delay=0.05)], timeout=2)
+    start = time.monotonic()
+    assert checker.check()
+    # The stuck probe isn't waited for
+    assert time.monotonic() - start < 1
+
+
+def test_all_failing():
+    checker = connectivity.ConnectivityChecker([FakeProbe(False), FailingProbe()], timeout=2)
+    assert not checker.check()
+
+
+def test_deadline():
+    checker = connectivity.ConnectivityChecker([FakeProbe(True, delay=5)], timeout=0.2)
+    start = time.monotonic()
+    assert not checker.check()
+    assert time.monotonic() - start < 1
+
+
+def test_success_cached():
+    probe = FakeProbe(True)
+    checker = connectivity.ConnectivityChecker([probe], cache_ttl=60)
+    assert checker.check() and checker.check()
+    assert probe.runs == 1
+    assert checker.check(use_cache=False)
+    assert probe.runs == 2
+    checker.invalidate()
+    assert checker.check()
+    assert probe.runs == 3
+
+
+def test_failure_not_cached():
+    probe = FakeProbe(False)
+    checker = connectivity.ConnectivityChecker([probe], timeout=1)
+    assert not checker.check()
+    probe.result = True
+    assert checker.check()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections: set = set()
+
+    def do_HEAD(self) -> None:
+        self.connections.add(self.client_address)
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def test_http_probe_reuses_connection():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        probe = connectivity.HTTPProbe(f"http://127.0.0.1:{server.server_port}/")
+        assert probe.run(2) and probe.run(2) and probe.run(2)
+        assert len(_Handler.connections) == 1
+        probe.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_tcp_probe():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+        assert connectivity.TCPProbe("127.0.0.1", port).run(1)
+    assert not connectivity.TCPProbe("127.0.0.1", port).run(1)
+
+
+@pytest.fixture
+def silent_server():
+    """Port of a server which accepts connections, but never answers."""
+    listener = socket.create_server(("127.0.0.1", 0))
+    accepted = []
+
+    def accept() -> None:
+        while True:
+            try:
+                accepted.append(listener.accept()[0])
+            except OSError:
+                return
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield listener.getsockname()[1]
+    listener.close()
+    for conn in accepted:
+        conn.close()
+
+
+def test_http_probe_never_answered(silent_server):
+    probe = connectivity.HTTPProbe(f"http://127.0.0.1:{silent_server}/")
+    start = time.monotonic()
+    assert not probe.run(0.3)
+    assert time.monotonic() - start < 0.6
+
+    checker = connectivity.ConnectivityChecker([probe, connectivity.TCPProbe("127.0.0.1", 1)], timeout=0.3)
+    start = time.monotonic()
+    assert not checker.check()
+    assert time.monotonic() - start < 0.6
+
+
+class _StallingHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the first request, then stops answering (but keeps the connection open)."""
+    protocol_version = "HTTP/1.1"
+    stalled = threading.Event()
+    released = threading.Event()
+
+    def do_HEAD(self) -> None:
+        if self.stalled.is_set():
+            self.released.wait(10)
+            return
+        self.stalled.set()
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def test_http_probe_deadline_with_stalled_pooled_connection():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _StallingHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        probe = connectivity.HTTPProbe(f"http://127.0.0.1:{server.server_port}/")
+        assert probe.run(2)
+        start = time.monotonic()
+        # Neither the pooled connection nor a new one get an answer, both within the one timeout
+        assert not probe.run(0.3)
+        assert time.monotonic() - start < 0.5
+        probe.close()
+    finally:
+        _StallingHandler.released.set()
+        server.shutdown()
+        server.server_close()
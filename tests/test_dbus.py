@@ -0,0 +1,96 @@
+import struct
+
+import pytest
+
+from lib import dbus
+from lib.dbus import Variant
+
+SERVICE = "org.example.Test"
+PATH = "/org/example/Test"
+
+
+def _write(signature: str, value) -> bytes:
+    writer = dbus._Writer()
+    writer.write(signature, value)
+    return bytes(writer.data)
+
+
+def test_split_signature():
+    assert dbus.split_signature("a{sv}(ii)sas") == ["a{sv}", "(ii)", "s", "as"]
+    assert dbus.split_signature("") == []
+
+
+def test_wire_format():
+    assert _write("u", 1) == b"\x01\x00\x00\x00"
+    assert _write("s", "ab") == b"\x02\x00\x00\x00ab\x00"
+    assert _write("g", "as") == b"\x02as\x00"
+    # Struct fields are aligned to their own types
+    assert _write("(yt)", (1, 2)) == b"\x01" + bytes(7) + struct.pack("<Q", 2)
+    # The padding between the length and the first element isn't counted in the array length
+    assert _write("at", [5]) == struct.pack("<I", 8) + bytes(4) + struct.pack("<Q", 5)
+    assert _write("v", Variant("b", True)) == b"\x01b\x00\x00\x01\x00\x00\x00"
+
+
+def test_message_round_trip():
+    properties = {
+        "Name": Variant("s", "wlan0"),
+        "Powered": Variant("b", True),
+        "Nested": Variant("a{sv}", {"x": Variant("t", 7)}),
+    }
+    body = (properties, [("/a", 1), ("/b", -2)], 3.5)
+    fields = {dbus.FIELD_PATH: PATH, dbus.FIELD_MEMBER: "Changed"}
+    data = dbus.encode_message(dbus.SIGNAL, 42, fields, "a{sv}a(ox)d", body)
+    assert data.startswith(b"l\x04\x00\x01")
+    assert dbus._message_size(data) == len(data)
+    assert dbus._message_size(data[:8]) is None
+
+    message = dbus.decode_message(data)
+    assert (message.type, message.serial, message.path, message.member) == (dbus.SIGNAL, 42, PATH, "Changed")
+    # Variants are read as their plain values
+    assert message.body == ({"Name": "wlan0", "Powered": True, "Nested": {"x": 7}}, [("/a", 1), ("/b", -2)], 3.5)
+
+
+def test_parse_address():
+    assert dbus._parse_address("unix:path=/run/dbus/system_bus_socket") == ["/run/dbus/system_bus_socket"]
+    assert dbus._parse_address("tcp:host=x;unix:abstract=/tmp/dbus-1,guid=00") == ["\0/tmp/dbus-1"]
+
+
+def test_call(bus_address, make_service):
+    make_service(SERVICE, {"Echo": lambda text, number: ("su", (text, number + 1))})
+    with dbus.Connection(bus_address) as bus:
+        assert bus.unique_name.startswith(":")
+        assert bus.call(SERVICE, PATH, SERVICE, "Echo", "su", ("hello", 1)) == ("hello", 2)
+
+
+def test_error_reply(bus_address, make_service):
+    make_service(SERVICE, {})
+    with dbus.Connection(bus_address) as bus:
+        with pytest.raises(dbus.DBusError, match="org.example.Error: no method Missing"):
+            bus.call(SERVICE, PATH, SERVICE, "Missing")
+        with pytest.raises(dbus.DBusError, match="ServiceUnknown"):
+            bus.call("org.example.Nobody", PATH, SERVICE, "Missing")
+
+
+def test_signals(bus_address, make_service):
+    service = make_service(SERVICE, {"Ping": lambda: ("", ())})
+    with dbus.Connection(bus_address) as bus:
+        bus.add_match(type="signal", sender=SERVICE, interface=SERVICE)
+        service.emit(PATH, SERVICE, "Changed", "s", ("first",))
+        # A signal arriving while waiting for a method reply is kept for later
+        bus.call(SERVICE, PATH, SERVICE, "Ping")
+        service.emit(PATH, SERVICE, "Changed", "s", ("second",))
+
+        received = []
+        while (message := bus.receive(2)) is not None:
+            # The bus sends its own signals too (NameAcquired)
+            if message.interface == SERVICE:
+                received.append((message.member, message.body))
+            if len(received) == 2:
+                break
+        assert received == [("Changed", ("first",)), ("Changed", ("second",))]
+        assert bus.receive(0.1) is None
+
+
+def test_no_bus():
+    with pytest.raises(OSError):
+        dbus.Connection("unix:path=/nonexistent/bus_socket")
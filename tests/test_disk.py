@@ -0,0 +1,33 @@
+from pathlib import Path
+
+from lib import disk, filesystems, installplan, inventory
+
+
+def _inventory(*disks: inventory.BlockDevice) -> inventory.Inventory:
+    snapshot = inventory.Inventory.__new__(inventory.Inventory)
+    snapshot.interfaces = {}
+    snapshot.disks = {device.name: device for device in disks}
+    return snapshot
+
+
+def test_get_parent_disk():
+    snapshot = _inventory(
+        inventory.BlockDevice("sda", 10 ** 9), inventory.BlockDevice("sdaa", 10 ** 9),
+        inventory.BlockDevice("nvme0n1", 10 ** 9),
+    )
+    assert snapshot.get_parent_disk(Path("/dev/sda2")).name == "sda"
+    assert snapshot.get_parent_disk(Path("/dev/sdaa1")).name == "sdaa"
+    assert snapshot.get_parent_disk(Path("/dev/nvme0n1p3")).name == "nvme0n1"
+    assert snapshot.get_parent_disk(Path("/dev/nvme0n11")) is None
+    assert snapshot.get_parent_disk(Path("/dev/sdb1")) is None
+
+
+def test_planned_partition_profile_from_disk(monkeypatch):
+    read = []
+    monkeypatch.setattr(installplan, "_active", installplan.InstallPlan())
+    monkeypatch.setattr(inventory, "get", lambda: _inventory(inventory.BlockDevice("nvme7n1", 10 ** 9)))
+    monkeypatch.setattr(filesystems, "read_profile", lambda device: read.append(device) or filesystems.DeviceProfile())
+
+    # Doesn't exist (yet), like the partitions of an install plan
+    disk.Partition(Path("/dev/nvme7n1p2")).profile
+    assert read == [Path("/dev/nvme7n1")]
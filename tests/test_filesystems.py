@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import pytest
+
+from lib import filesystems
+from lib.filesystems import DeviceProfile
+
+SSD = DeviceProfile(rotational=False, discard_granularity=4096)
+RAID5 = DeviceProfile(raid_chunk_size=512 * 1024, raid_data_disks=3)
+
+
+def test_backends_must_implement_mkfs():
+    class Incomplete(filesystems.Filesystem):
+        name = fstype = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+@pytest.mark.parametrize("name", filesystems.FILESYSTEMS)
+def test_mkfs_argv_ends_with_device(name):
+    for profile in (DeviceProfile(), SSD, RAID5):
+        assert filesystems.get_filesystem(name).mkfs_argv(Path("/dev/sda2"), profile)[-1] == "/dev/sda2"
+
+
+def test_profile_dependent_options():
+    assert "-E" not in filesystems.get_filesystem("ext4").mkfs_argv(Path("/dev/sda2"), DeviceProfile())
+    assert "stride=128,stripe_width=384" in filesystems.get_filesystem("ext4").mkfs_argv(Path("/dev/md0"), RAID5)[-2]
+    assert "ssd" in filesystems.get_filesystem("btrfs").mount_options(SSD)
+    assert "ssd" not in filesystems.get_filesystem("btrfs").mount_options(DeviceProfile())
+    assert "compress_extension=*" in filesystems.get_filesystem("f2fs").mount_options(SSD)
+
+
+def test_unknown_filesystem():
+    with pytest.raises(ValueError):
+        filesystems.get_filesystem("zfs")
@@ -0,0 +1,31 @@
+import time
+
+from lib import linkwatch
+
+
+def _sysfs_watcher() -> linkwatch.LinkWatcher:
+    watcher = linkwatch.LinkWatcher()
+    # As if netlink wasn't available
+    watcher.close()
+    return watcher
+
+
+def test_change_polled_without_netlink(monkeypatch):
+    monkeypatch.setattr(linkwatch, "CHANGE_POLL_INTERVAL", 0.05)
+    watcher = _sysfs_watcher()
+    start = time.monotonic()
+    # Doesn't sleep the whole timeout, the caller re-checks every poll interval
+    assert watcher.wait_for_change(5) is True
+    assert time.monotonic() - start < 1
+    assert watcher.wait_for_change(0) is False
+
+
+def test_wait_for_without_netlink():
+    checks = []
+
+    def condition(name: str) -> bool:
+        checks.append(name)
+        return len(checks) == 3
+
+    assert _sysfs_watcher().wait_for(["eth0"], condition, timeout=5) == "eth0"
+    assert _sysfs_watcher().wait_for(["eth0"], lambda name: False, timeout=0.2) is None
@@ -0,0 +1,159 @@
+import asyncio
+import http.server
+import socket
+import threading
+import time
+
+import pytest
+
+from lib import mirrors
+
+DATABASE = bytes(range(256)) * 512
+
+
+def _write_mirrorlist(path, active: int, commented: int) -> None:
+    lines = [f"Server = https://active{number}.example.org/$repo/os/$arch" for number in range(active)]
+    lines += [f"#Server = https://commented{number}.example.org/$repo/os/$arch" for number in range(commented)]
+    path.write_text("\n".join(lines) + "\n")
+
+
+@pytest.fixture
+def probed(monkeypatch):
+    servers = []
+
+    async def probe_mirrors(candidates):
+        servers.extend(candidates)
+        return [mirrors.MirrorResult(server, 0.1, 1024 ** 2, int(time.time())) for server in candidates]
+
+    monkeypatch.setattr(mirrors, "probe_mirrors", probe_mirrors)
+    monkeypatch.setattr(mirrors.commands, "write_root_file", lambda path, content: None)
+    return servers
+
+
+def test_read_mirrorlist(tmp_path):
+    path = tmp_path / "mirrorlist"
+    _write_mirrorlist(path, active=2, commented=3)
+    assert len(mirrors.read_mirrorlist(path)) == 2
+    assert len(mirrors.read_mirrorlist(path, include_commented=True)) == 5
+
+
+def test_rank_only_active_servers(tmp_path, probed):
+    path = tmp_path / "mirrorlist"
+    _write_mirrorlist(path, active=mirrors.KEEP_MIRRORS + 2, commented=1000)
+    mirrors.rank_mirrors(path, cache_file=tmp_path / "mirrors.json")
+    assert all("active" in server for server in probed)
+    assert len(probed) == mirrors.KEEP_MIRRORS + 2
+
+
+def test_rank_commented_servers_capped(tmp_path, probed):
+    path = tmp_path / "mirrorlist"
+    _write_mirrorlist(path, active=2, commented=1000)
+    ranked = mirrors.rank_mirrors(path, cache_file=tmp_path / "mirrors.json")
+    assert len(probed) == mirrors.MAX_CANDIDATES
+    assert probed[:2] == mirrors.read_mirrorlist(path)
+    assert len(ranked) == mirrors.KEEP_MIRRORS
+
+
+class FakeMirror(http.server.ThreadingHTTPServer):
+    """Mirror serving `lastsync` and a core database, answering after `delay` seconds."""
+    daemon_threads = True
+
+    def __init__(self, delay: float = 0.0, last_sync: int = 0, chunked: bool = False):
+        super().__init__(("127.0.0.1", 0), FakeMirrorHandler)
+        self.delay = delay
+        self.last_sync = last_sync or int(time.time())
+        self.chunked = chunked
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/$repo/os/$arch"
+
+
+class FakeMirrorHandler(http.server.BaseHTTPRequestHandler):
+    server: FakeMirror
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        time.sleep(self.server.delay)
+        if self.path == "/lastsync":
+            body = f"{self.server.last_sync}\n".encode()
+        elif self.path.endswith("/core.db"):
+            body = DATABASE
+        else:
+            self.send_error(404)
+            return
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Connection", "close")
+        if not self.server.chunked:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for offset in range(0, len(body), 10000):
+            chunk = body[offset:offset + 10000]
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def make_mirror():
+    servers = []
+
+    def make(**kwargs) -> FakeMirror:
+        server = FakeMirror(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def silent_mirror():
+    """URL of a mirror which accepts connections, but never answers."""
+    sock = socket.create_server(("127.0.0.1", 0))
+    yield f"http://127.0.0.1:{sock.getsockname()[1]}/$repo/os/$arch"
+    sock.close()
+
+
+def test_dechunk():
+    assert mirrors._dechunk(b"3\r\nabc\r\n2;name=value\r\nde\r\n0\r\n\r\n") == b"abcde"
+    # The body is cut at the sample size, usually in the middle of a chunk
+    assert mirrors._dechunk(b"3\r\nabc\r\n5\r\nde") == b"abcde"
+
+
+def test_http_get(make_mirror):
+    for mirror in (make_mirror(), make_mirror(chunked=True)):
+        url = mirrors._expand_server(mirror.url) + "core.db"
+        _, _, body = asyncio.run(mirrors._http_get(url, len(DATABASE) * 2))
+        assert body == DATABASE
+    # Cut at the sample size, the (chunked) body loses the chunk header
+    _, _, body = asyncio.run(mirrors._http_get(url, 1000))
+    assert body == DATABASE[:1000 - len("2710\r\n")]
+
+
+def test_probe_and_rank(make_mirror, silent_mirror):
+    fast = make_mirror()
+    chunked = make_mirror(delay=0.2, chunked=True)
+    slow = make_mirror(delay=0.4)
+    too_slow = make_mirror(delay=3)
+    stale = make_mirror(last_sync=int(time.time()) - mirrors.MAX_SYNC_LAG - 60)
+    servers = [mirror.url for mirror in (slow, too_slow, stale, chunked, fast)] + [silent_mirror]
+
+    start = time.monotonic()
+    results = asyncio.run(mirrors.probe_mirrors(servers, timeout=1.5, sample_size=64 * 1024))
+    # Probed concurrently, the mirrors which never answer don't hold up the others
+    assert time.monotonic() - start < 3
+    assert {result.server for result in results} == {fast.url, chunked.url, slow.url, stale.url}
+    assert all(result.throughput > 0 for result in results)
+    ranked = mirrors.rank_results(results)
+    assert [result.server for result in ranked] == [fast.url, chunked.url, slow.url]
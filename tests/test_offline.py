@@ -0,0 +1,72 @@
+from lib import installplan, offline, pacman
+
+
+def _desc(name: str, depends: tuple = (), provides: tuple = (), groups: tuple = ()) -> str:
+    lines = [f"%NAME%\n{name}\n", "%VERSION%\n1.0-1\n"]
+    for field, values in (("DEPENDS", depends), ("PROVIDES", provides), ("GROUPS", groups)):
+        if values:
+            lines.append(f"%{field}%\n" + "\n".join(values) + "\n")
+    return "\n".join(lines)
+
+
+def _repo(*descs: str) -> dict[str, offline.RepoPackage]:
+    packages = [offline._to_package(offline.parse_desc(desc)) for desc in descs]
+    return {package.name: package for package in packages}
+
+
+PACKAGES = _repo(
+    _desc("base", depends=("bash", "glibc>=2.38", "filesystem")),
+    _desc("bash", depends=("glibc", "readline>=8.0"), provides=("sh",)),
+    _desc("glibc", depends=("filesystem",)),
+    _desc("filesystem"),
+    _desc("readline", depends=("libfoo.so=1-64",)),
+    _desc("foo", provides=("libfoo.so=1-64",)),
+    _desc("linux", depends=("kmod", "initramfs")),
+    _desc("vim", depends=("sh",), groups=("editors",)),
+    _desc("nano", depends=("libmagic.so",), groups=("editors",)),
+)
+
+
+def test_parse_desc():
+    package = PACKAGES["bash"]
+    assert package == offline.RepoPackage("bash", "1.0-1", ["glibc", "readline>=8.0"], ["sh"], [])
+
+
+def test_dependencies_satisfied():
+    # Versioned dependencies, provided libraries and virtual packages (sh) are all found
+    assert offline.find_missing(PACKAGES, ["base", "vim"]) == {}
+
+
+def test_missing_dependencies():
+    missing = offline.find_missing(PACKAGES, ["base", "linux", "python"])
+    assert missing == {"kmod": ["linux"], "initramfs": ["linux"], "python": ["requested"]}
+
+
+def test_groups_expanded():
+    assert offline.find_missing(PACKAGES, ["editors"]) == {"libmagic.so": ["nano"]}
+
+
+def test_offline_signatures_required(tmp_path):
+    base_config = tmp_path / "pacman.conf"
+    base_config.write_text("[options]\nSigLevel = Required\n\n[core]\nInclude = /etc/pacman.d/mirrorlist\n")
+    config = pacman.make_config(base_config=base_config, offline_repo=tmp_path / f"{offline.REPO_NAME}.db")
+    # The packages are verified with the .sig files linked next to them, the local database isn't signed
+    assert f"[{offline.REPO_NAME}]\nSigLevel = Required DatabaseOptional\n" in config
+    assert "[core]" not in config
+
+
+def test_repository_planned(tmp_path, monkeypatch):
+    for name in ("bash-5.2.026-2-x86_64.pkg.tar.zst", "bash-5.2.026-2-x86_64.pkg.tar.zst.sig"):
+        (tmp_path / name).write_bytes(b"")
+    plan = installplan.InstallPlan()
+    monkeypatch.setattr(installplan, "_active", plan)
+
+    repo_dir = tmp_path / "repo"
+    database = offline.build_repo(tmp_path, repo_dir)
+    assert database == repo_dir / f"{offline.REPO_NAME}.db"
+    # Built where the plan runs, not here
+    assert not repo_dir.exists()
+    link, repo_add = [entry.cmd for entry in plan.entries]
+    package = tmp_path / "bash-5.2.026-2-x86_64.pkg.tar.zst"
+    assert f"ln -s {package} {package}.sig {repo_dir}" in link
+    assert repo_add.startswith("repo-add")
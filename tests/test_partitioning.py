@@ -0,0 +1,115 @@
+import shlex
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from lib import partitioning
+from lib.partitioning import MIB, DeviceGeometry, PartitionSpec, compute_layout, parse_size
+
+GIB = 1024 ** 3
+
+
+def _check_aligned(geometry: DeviceGeometry, specs: list[PartitionSpec]) -> None:
+    sector = geometry.logical_block_size
+    layout = compute_layout(geometry, specs)
+    for partition, spec in zip(layout, specs):
+        start = partition.start * sector
+        size = partition.size * sector
+        assert (start - geometry.alignment_offset) % geometry.alignment == 0
+        assert size % geometry.alignment == 0
+        if spec.size is not None:
+            assert spec.size <= size < spec.size + geometry.alignment
+    for previous, partition in zip(layout, layout[1:]):
+        assert previous.start + previous.size == partition.start
+    last = layout[-1]
+    assert (last.start + last.size) * sector <= geometry.size
+
+
+def test_layout_aligned():
+    specs = [PartitionSpec(512 * MIB, is_efi=True), PartitionSpec(3 * GIB, is_swap=True), PartitionSpec(None)]
+    _check_aligned(DeviceGeometry(size=64 * GIB), specs)
+
+
+def test_layout_with_alignment_offset():
+    # E.g. a 4K sector disk exposing 512 byte sectors, with the first physical sector at byte 3584
+    geometry = DeviceGeometry(
+        size=64 * GIB, physical_block_size=4096, minimum_io_size=4096, alignment_offset=3584
+    )
+    specs = [PartitionSpec(MIB, is_bios_boot=True), PartitionSpec(5 * MIB + 1), PartitionSpec(None)]
+    _check_aligned(geometry, specs)
+    layout = compute_layout(geometry, specs)
+    assert layout[0].size * 512 == MIB
+    assert layout[1].size * 512 == 6 * MIB
+
+
+def test_layout_with_large_optimal_io_size():
+    _check_aligned(DeviceGeometry(size=64 * GIB, optimal_io_size=3 * MIB), [PartitionSpec(GIB), PartitionSpec(None)])
+
+
+def test_layout_does_not_fit():
+    with pytest.raises(ValueError):
+        compute_layout(DeviceGeometry(size=GIB), [PartitionSpec(2 * GIB), PartitionSpec(None)])
+    with pytest.raises(ValueError):
+        compute_layout(DeviceGeometry(size=GIB), [PartitionSpec(None), PartitionSpec(None)])
+
+
+def test_parse_size():
+    assert parse_size("512M") == 512 * MIB
+    assert parse_size("8GiB") == 8 * GIB
+    assert parse_size("rest") is None
+    assert PartitionSpec.from_dict({"size": "1G", "mountpoint": "/home"}).mountpoint == Path("/home")
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def _run_unprivileged(monkeypatch) -> None:
+    # The image file is ours, there's no need to escalate
+    def run_root_cmd(cmd, **kwargs) -> subprocess.CompletedProcess:
+        return partitioning.commands.run_cmd(cmd if isinstance(cmd, str) else shlex.join(cmd), **kwargs)
+    monkeypatch.setattr(partitioning.commands, "run_root_cmd", run_root_cmd)
+
+
+@pytest.mark.skipif(shutil.which("sfdisk") is None, reason="sfdisk isn't installed")
+def test_apply_layout(tmp_path, monkeypatch):
+    image = tmp_path / "disk.img"
+    with image.open("wb") as file:
+        file.truncate(2 * GIB)
+    _run_unprivileged(monkeypatch)
+    # Not attached to a loop device, the table is read from the image itself
+    monkeypatch.setattr(partitioning, "attach_image", lambda path: path)
+
+    geometry = partitioning.read_geometry(image)
+    specs = [PartitionSpec(MIB, is_bios_boot=True), PartitionSpec(5 * MIB + 1), PartitionSpec(None)]
+    layout = compute_layout(geometry, specs)
+    assert partitioning.apply_layout(image, layout) == image
+
+    partitions = partitioning.read_partition_table(image)
+    assert [(partition["start"], partition["size"]) for partition in partitions] == [
+        (planned.start, planned.size) for planned in layout
+    ]
+    for partition in partitions:
+        assert partition["start"] * 512 % geometry.alignment == 0
+    assert partitions[0]["type"] == partitioning.TYPE_BIOS_BOOT
+
+
+def test_grow_last_partition_by_start(monkeypatch):
+    commands = []
+
+    def run_root_cmd(cmd, **kwargs) -> subprocess.CompletedProcess:
+        commands.append(cmd)
+        return subprocess.CompletedProcess(cmd, 0)
+
+    monkeypatch.setattr(partitioning.commands, "run_root_cmd", run_root_cmd)
+    # Partition 3 was created first, partition 1 is the last one on the disk (and there's no 2)
+    monkeypatch.setattr(partitioning, "read_partition_table", lambda device: [
+        {"node": "/dev/nvme0n1p3", "start": 2048, "size": 2048},
+        {"node": "/dev/nvme0n1p1", "start": 8192, "size": 2048},
+        {"node": "/dev/nvme0n1p4", "start": 4096, "size": 2048},
+    ])
+    monkeypatch.setattr(partitioning, "_reread_partitions", lambda device: device)
+    monkeypatch.setattr(partitioning, "blkid_type", lambda device: None)
+
+    partitioning.grow_last_partition(Path("/dev/nvme0n1"))
+    assert commands[-1] == "echo ', +' | sfdisk --no-reread --no-tell-kernel -N 1 /dev/nvme0n1"
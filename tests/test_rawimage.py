@@ -0,0 +1,54 @@
+import errno
+import os
+
+import pytest
+
+from lib import rawimage
+
+MIB = 1024 ** 2
+# Data ranges (offset, content) of the image, the last one is an unaligned tail
+DATA = [(0, b"\xeb\x63\x90" * 1365), (MIB, b"partition" * 910), (4 * MIB, b"tail" * 25)]
+SIZE = 4 * MIB + 100
+
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path / "source.img"
+    with path.open("wb") as file:
+        file.truncate(SIZE)
+        for offset, content in DATA:
+            file.seek(offset)
+            file.write(content)
+    return path
+
+
+def _expected_data_bytes(path) -> int:
+    block_size = os.stat(path).st_blksize
+    # Data is allocated in whole blocks, except for the end of the file
+    return sum(min(-(-len(content) // block_size) * block_size, SIZE - offset) for offset, content in DATA)
+
+
+@pytest.mark.parametrize("direct", [False, True])
+def test_write_sparse_image(image, tmp_path, direct):
+    target = tmp_path / "target.img"
+    # The target is larger than the image, like a disk
+    target.write_bytes(b"old!" * (5 * MIB // 4))
+    try:
+        stats = rawimage.write_image(image, target, direct=direct)
+    except OSError as exc:
+        if direct and exc.errno == errno.EINVAL:
+            pytest.skip("the filesystem of the temporary directory doesn't support O_DIRECT")
+        raise
+
+    written = target.read_bytes()
+    assert written[:SIZE] == image.read_bytes()
+    # Nothing is left of the previous content
+    assert len(written) == 5 * MIB and written[SIZE:] == bytes(5 * MIB - SIZE)
+    assert stats.data_bytes + stats.hole_bytes == SIZE
+    if image.stat().st_blocks * 512 < SIZE:
+        # The filesystem reports the holes
+        assert stats.data_bytes == _expected_data_bytes(image)
+        # Holes of the image stay holes in the target file
+        assert target.stat().st_blocks * 512 < SIZE
+    assert stats.holes_zeroed
+    assert stats.method == ("O_DIRECT" if direct else "copy_file_range")
@@ -0,0 +1,32 @@
+from lib import installplan, redaction, tracing
+
+
+def test_redact_masks_registered_secrets():
+    redaction.add_secret("correct horse")
+    redaction.add_secret("correct horse battery")
+    assert redaction.redact("pass 'correct horse battery' staple") == "pass '<redacted>' staple"
+    assert redaction.redact_value(["iwctl", "correct horse", 3]) == ["iwctl", "<redacted>", 3]
+
+
+def test_plan_and_trace_are_redacted(monkeypatch, tmp_path):
+    redaction.add_secret("s3cret-passphrase")
+    plan = installplan.InstallPlan()
+    plan.add_command(["echo", "s3cret-passphrase"], root=False)
+    plan.add_file(tmp_path / "net.psk", "Passphrase=s3cret-passphrase\n", "600")
+    assert "s3cret-passphrase" not in plan.to_json()
+    assert "s3cret-passphrase" not in "\n".join(entry.describe() for entry in plan.entries)
+    # The script has to write the real passphrase
+    assert plan.has_secrets()
+    assert "Passphrase=s3cret-passphrase\n" in plan.to_script()
+
+    monkeypatch.setattr(tracing.constants, "TRACE_FILE", tmp_path / "trace.json")
+    monkeypatch.setattr(tracing, "_spans", [])
+    with tracing.span("echo s3cret-passphrase", tracing.COMMAND, argv=["echo", "s3cret-passphrase"]):
+        pass
+    assert "s3cret-passphrase" not in repr(tracing._spans)
+
+
+def test_plan_without_secrets():
+    plan = installplan.InstallPlan()
+    plan.add_command(["echo", "hello"], root=False)
+    assert not plan.has_secrets()
@@ -0,0 +1,48 @@
+import base64
+import io
+import json
+
+import pytest
+
+from lib import rootworker
+
+
+def _serve(*requests: str) -> dict:
+    responses = io.StringIO()
+    rootworker.serve(io.StringIO("".join(request + "\n" for request in requests)), responses)
+    messages = [json.loads(line) for line in responses.getvalue().splitlines()]
+    assert messages[0] == {"ready": True}
+    return {message["id"]: message for message in messages[1:] if "returncode" in message}
+
+
+def test_serve_survives_broken_requests():
+    responses = _serve(
+        "{not json",
+        json.dumps({"id": 1, "capture": True}),
+        json.dumps({"id": 2, "argv": ["echo", "nul\0byte"], "capture": True}),
+        json.dumps({"id": 3, "argv": ["/nonexistent/command"], "capture": True}),
+        json.dumps({"id": 4, "argv": ["echo", "still here"], "capture": True}),
+    )
+    assert responses[None]["returncode"] == 1
+    assert responses[1]["returncode"] == 1
+    assert b"KeyError" in base64.b64decode(responses[1]["output"])
+    assert responses[2]["returncode"] == 127
+    assert responses[3]["returncode"] == 127
+    assert responses[4] == {"id": 4, "returncode": 0, "output": base64.b64encode(b"still here\n").decode()}
+
+
+@pytest.fixture
+def worker():
+    # Without escalation, the protocol is the same
+    worker = rootworker.RootWorker([])
+    yield worker
+    worker.close()
+
+
+def test_worker_answers_unexecutable_commands(worker):
+    assert worker.run(["echo", "nul\0byte"], capture_out=True).returncode == 127
+    lines, wait = worker.stream(["echo", "nul\0byte"])
+    assert b"null byte" in b"".join(lines)
+    assert wait() == 127
+    assert worker.run(["echo", "ok"], capture_out=True).stdout == b"ok\n"
+    assert worker.alive
@@ -0,0 +1,139 @@
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from lib import dbus, wifi
+from lib.dbus import Variant
+
+NETWORKS = (
+    "\x1b[1;90m                               Available networks\x1b[0m\n"
+    "\x1b[1;90m--------------------------------------------------------------------------------\x1b[0m\n"
+    "\x1b[1;90m      Network name                      Security            Signal\x1b[0m\n"
+    "\x1b[1;90m--------------------------------------------------------------------------------\x1b[0m\n"
+    "      Neighbour                         psk                 -8800\n"
+    "\x1b[0m  > \x1b[0mHomeNet                           psk                 -5200\n"
+    "      Cafe Free Wi-Fi                   open                ****\n"
+)
+STATION_PATH = "/net/connman/iwd/0/4"
+
+
+def _station_output(scanning: bool, state: str) -> str:
+    return (
+        "\x1b[1;90m                                 Station: wlan0\x1b[0m\n"
+        "\x1b[1;90m  Settable  Property              Value\x1b[0m\n"
+        f"            Scanning              {'yes' if scanning else 'no'}\n"
+        f"            State                 {state}\n"
+    )
+
+
+def test_parse_networks():
+    networks = wifi.parse_networks(NETWORKS)
+    assert [network.ssid for network in networks] == ["HomeNet", "Neighbour", "Cafe Free Wi-Fi"]
+    assert networks[0] == wifi.WifiNetwork("HomeNet", "psk", -52.0, connected=True)
+    assert networks[2].signal is None
+
+
+def test_parse_station():
+    assert wifi.parse_station(_station_output(True, "disconnected")) == wifi.StationState("disconnected", True)
+    assert wifi.parse_station("") == wifi.StationState(None, False)
+
+
+def test_profile_path():
+    assert wifi.profile_path("Home Net_5-G") == Path("/var/lib/iwd/Home Net_5-G.psk")
+    assert wifi.profile_path("kávé") == Path("/var/lib/iwd/=6bc3a176c3a9.psk")
+
+
+def test_polled_station_waits_for_condition(monkeypatch):
+    outputs = iter([_station_output(True, "disconnected")] * 3 + [_station_output(False, "disconnected")])
+    polls = []
+
+    def run_cmd(cmd: str, capture_out: bool = False, read_only: bool = False, **kwargs):
+        polls.append(time.monotonic())
+        return subprocess.CompletedProcess(cmd, 0, next(outputs).encode())
+
+    monkeypatch.setattr(wifi.commands, "run_cmd", run_cmd)
+    state = wifi.PolledStation("wlan0").wait_for(wifi.scan_done, timeout=5)
+    assert state == wifi.StationState("disconnected", False)
+    assert len(polls) == 4
+    # The interval between polls grows
+    gaps = [later - earlier for earlier, later in zip(polls, polls[1:])]
+    assert gaps[-1] > gaps[0]
+
+
+def test_polled_station_timeout(monkeypatch):
+    monkeypatch.setattr(
+        wifi.commands, "run_cmd",
+        lambda cmd, **kwargs: subprocess.CompletedProcess(cmd, 0, _station_output(False, "connecting").encode()),
+    )
+    start = time.monotonic()
+    assert wifi.PolledStation("wlan0").wait_for(wifi.connection_done, timeout=0.3) is None
+    assert time.monotonic() - start < 1
+
+
+class FakeIwd:
+    """Stand-in for iwd with a single station, whose properties are changed by the test."""
+
+    def __init__(self, make_service):
+        self.properties = {"State": "disconnected", "Scanning": True}
+        self.service = make_service(wifi.IWD_SERVICE, {
+            "GetManagedObjects": lambda: ("a{oa{sa{sv}}}", ({
+                STATION_PATH: {
+                    wifi.DEVICE_INTERFACE: {"Name": Variant("s", "wlan0")},
+                    wifi.STATION_INTERFACE: self._variants(),
+                },
+            },)),
+            "GetAll": lambda interface: ("a{sv}", (self._variants(),)),
+        })
+
+    def _variants(self) -> dict[str, Variant]:
+        return {"State": Variant("s", self.properties["State"]), "Scanning": Variant("b", self.properties["Scanning"])}
+
+    def change(self, **changed) -> None:
+        self.properties.update(changed)
+        variants = {key: value for key, value in self._variants().items() if key in changed}
+        self.service.emit(
+            STATION_PATH, dbus.PROPERTIES_INTERFACE, "PropertiesChanged", "sa{sv}as",
+            (wifi.STATION_INTERFACE, variants, []),
+        )
+
+
+def test_dbus_station_follows_signals(bus_address, make_service):
+    iwd = FakeIwd(make_service)
+    with wifi.DBusStation("wlan0", bus_address) as station:
+        assert station.path == STATION_PATH
+        assert station.read_state() == wifi.StationState("disconnected", True)
+
+        threading.Timer(0.2, iwd.change, kwargs={"Scanning": False}).start()
+        start = time.monotonic()
+        assert station.wait_for(wifi.scan_done, timeout=5) == wifi.StationState("disconnected", False)
+        # Woken up by the signal, not by a poll or the timeout
+        assert time.monotonic() - start < 1
+
+        iwd.change(State="connecting")
+        threading.Timer(0.2, iwd.change, kwargs={"State": "connected"}).start()
+        assert station.wait_for(wifi.connection_done, timeout=5) == wifi.StationState("connected", False)
+
+
+def test_dbus_station_timeout(bus_address, make_service):
+    FakeIwd(make_service)
+    with wifi.DBusStation("wlan0", bus_address) as station:
+        assert station.wait_for(wifi.scan_done, timeout=0.2) is None
+
+
+def test_dbus_station_unknown_interface(bus_address, make_service):
+    FakeIwd(make_service)
+    with pytest.raises(dbus.DBusError):
+        wifi.DBusStation("wlan1", bus_address)
+
+
+def test_watch_station_falls_back_to_polling(monkeypatch):
+    dbus_station = wifi.DBusStation
+
+    def no_bus(interface_name: str) -> wifi.DBusStation:
+        return dbus_station(interface_name, "unix:path=/nonexistent/bus_socket")
+
+    monkeypatch.setattr(wifi, "DBusStation", no_bus)
+    assert isinstance(wifi.watch_station("wlan0"), wifi.PolledStation)